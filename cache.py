@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LRUCache
+   base of memory caches with a size budget, and layer revision tracking
+                              -------------------
+        begin                : 2017-07-01
+        copyright            : (C) 2017 Minoru Akagi
+        email                : akaginch@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+
+
+class LRUCache(ABC):
+  """LRU cache with a memory budget in bytes. It is thread-safe.
+  If diskDir is set, items evicted from memory are saved to the directory and loaded again when requested.
+  Sub-classes implement sizeOf(), save() and load() for their item type."""
+
+  EXTENSION = ""    # file extension of items saved to disk
+
+  def __init__(self, maxBytes, diskDir=None):
+    self.maxBytes = maxBytes
+    self.diskDir = diskDir
+    if diskDir and not os.path.exists(diskDir):
+      os.makedirs(diskDir)
+
+    self._items = OrderedDict()
+    self._bytes = 0
+    self._lock = threading.Lock()
+
+    self.hits = self.misses = 0
+
+  def get(self, key):
+    with self._lock:
+      item = self._items.get(key)
+      if item is not None:
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item
+
+    path = self._diskPath(key)
+    if path and os.path.exists(path):
+      item = self.load(path)
+      if item is not None:
+        self.put(key, item)    # items evicted by this put are saved. the file of the reloaded item exists already
+        with self._lock:
+          self.hits += 1
+        return item
+
+    with self._lock:
+      self.misses += 1
+    return None
+
+  def put(self, key, item):
+    """item should not be modified after it is put into cache"""
+    evicted = []
+    with self._lock:
+      old = self._items.pop(key, None)
+      if old is not None:
+        self._bytes -= self.sizeOf(old)
+
+      self._items[key] = item
+      self._bytes += self.sizeOf(item)
+
+      while self._bytes > self.maxBytes and len(self._items) > 1:
+        k, v = self._items.popitem(last=False)
+        self._bytes -= self.sizeOf(v)
+        evicted.append((k, v))
+
+    for k, v in evicted:
+      path = self._diskPath(k)
+      if path and not os.path.exists(path):
+        self.save(path, v)
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
+      self._bytes = 0
+      self.hits = self.misses = 0
+
+    if self.diskDir:
+      for filename in os.listdir(self.diskDir):
+        if filename.endswith(self.EXTENSION) and len(filename) == 32 + len(self.EXTENSION):    # md5 hex digest + extension
+          os.remove(os.path.join(self.diskDir, filename))
+
+  def memoryUsage(self):
+    return self._bytes
+
+  def __len__(self):
+    return len(self._items)
+
+  @abstractmethod
+  def sizeOf(self, item):
+    """returns memory size of the item in bytes"""
+
+  @abstractmethod
+  def save(self, path, item):
+    """saves the item to the file"""
+
+  @abstractmethod
+  def load(self, path):
+    """returns the item loaded from the file, or None if it cannot be loaded"""
+
+  def _diskPath(self, key):
+    if not self.diskDir:
+      return None
+    return os.path.join(self.diskDir, hashlib.md5(repr(key).encode("UTF-8")).hexdigest() + self.EXTENSION)
+
+
+_layerRevisions = {}    # key: layer id, value: [data revision, render revision]
+_layerRevisionsLock = threading.Lock()
+
+
+def _layerChanged(layerId, dataChanged):
+  with _layerRevisionsLock:
+    revs = _layerRevisions[layerId]
+    if dataChanged:
+      revs[0] += 1
+    revs[1] += 1
+
+
+def layerRevision(layer, dataOnly=False):
+  """returns a number that is incremented every time the layer needs to be redrawn (data or style changed).
+  dataOnly: if True, the number is incremented only when features of the layer are changed.
+  Revisions are valid only in the current session."""
+  layerId = layer.id()
+  with _layerRevisionsLock:
+    revs = _layerRevisions.get(layerId)
+    if revs is not None:
+      return revs[0] if dataOnly else revs[1]
+    _layerRevisions[layerId] = [0, 0]
+
+  layer.dataChanged.connect(lambda *args: _layerChanged(layerId, True))
+  layer.repaintRequested.connect(lambda *args: _layerChanged(layerId, False))
+  layer.styleChanged.connect(lambda *args: _layerChanged(layerId, False))
+  return 0
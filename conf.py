@@ -36,6 +36,21 @@ class DefaultSettings:
     # controls
     self.controls = "OrbitControls.js"    # last selected one has priority
 
+    # export
+    self.workers = 1    # number of threads to build DEM blocks
+    self.layerWorkers = 1   # number of layers to export concurrently
+    self.binaryVectorBlocks = False    # write vector feature blocks in binary format
+    self.vectorBlockVertices = 20000   # target number of vertices in a vector feature block
+    self.vectorBlockBytes = 1024 * 1024   # target (estimated) size of a vector feature block in bytes
+    self.vectorSortWindow = 0   # number of vector features sorted along Hilbert curve at a time. 0 keeps layer order
+    self.demPyramidLevels = 0   # levels of DEM tile pyramid to export. 0 exports DEM blocks at single resolution
+    self.demCacheSize = 128   # memory budget of warped DEM grid cache in MB. 0 disables the cache
+    self.demCacheDir = ""   # directory to save grids evicted from the DEM grid cache. empty means no spilling
+    self.textureCacheSize = 64   # memory budget of rendered texture cache in MB. 0 disables the cache
+    self.textureFormat = "PNG"   # PNG, JPEG (used for opaque textures) or WEBP
+    self.textureQuality = 90     # JPEG/WebP quality (0-100)
+    self.textureCompression = -1   # PNG compression level (0-9). -1 is Qt default
+
   def __getattr__(self, name):
     raise AttributeError
 
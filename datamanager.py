@@ -19,15 +19,23 @@
  *                                                                         *
  ***************************************************************************/
 """
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import math
 import os
+import threading
 
-from PyQt5.QtCore import Qt, QSize
-from PyQt5.QtGui import QColor, QImage, QImageReader, QPainter
-from qgis.core import QgsMapLayer
+from PyQt5.QtCore import Qt, QSettings, QSize
+from PyQt5.QtGui import QColor, QImage, QImageWriter, QPainter
+from qgis.core import QgsMapLayer, QgsMapRendererCustomPainterJob, QgsMapRendererParallelJob, QgsMapSettings, QgsPointXY
 
 from . import gdal2threejs
+from .cache import layerRevision
+from .conf import def_vals
 from . import qgis2threejstools as tools
 from .qgis2threejstools import logMessage
+from .rotatedrect import RotatedRect
+from .texturecache import sharedTextureCache
 
 
 class DataManager:
@@ -35,18 +43,56 @@ class DataManager:
 
   def __init__(self):
     self._list = []
+    self._dict = {}     # key: hashable form of item, value: index of item in list
+    self._lock = threading.Lock()   # layers can be exported concurrently
 
   def count(self):
     return len(self._list)
 
   def _index(self, data):
-    if data in self._list:
-      return self._list.index(data)
-
-    index = len(self._list)
-    self._list.append(data)
+    key = hashableKey(data)
+    try:
+      hash(key)
+    except TypeError:
+      key = None      # item that contains unhashable values is searched in the list
+
+    with self._lock:
+      if key is None:
+        if data in self._list:
+          return self._list.index(data)
+      else:
+        index = self._dict.get(key)
+        if index is not None:
+          return index
+
+      index = len(self._list)
+      self._list.append(data)
+      if key is not None:
+        self._dict[key] = index
     return index
 
+def hasPluginLayer(layers):
+  for layer in layers:
+    if layer and layer.type() == QgsMapLayer.PluginLayer:
+      return True
+  return False
+
+
+_LIST = object()    # tags of converted lists and dicts, which never appear in items
+_DICT = object()
+
+
+def hashableKey(data):
+  """returns hashable equivalent of data. lists and dicts are converted to tagged tuples recursively,
+  so that a list and a tuple of the same values are different keys. the result is not hashable
+  if data contains values of other unhashable types."""
+  if isinstance(data, list):
+    return (_LIST,) + tuple(hashableKey(d) for d in data)
+  if isinstance(data, tuple):
+    return tuple(hashableKey(d) for d in data)
+  if isinstance(data, dict):
+    return (_DICT, frozenset((k, hashableKey(v)) for k, v in data.items()))
+  return data
 
 class ImageManager(DataManager):
 
@@ -55,10 +101,14 @@ class ImageManager(DataManager):
   MAP_IMAGE = 3
   LAYER_IMAGE = 4
 
+  MOSAIC_MAX_SIZE = 8192   # max width and height of an image rendered at once in renderImages()
+
   def __init__(self, exportSettings):
     DataManager.__init__(self)
     self.exportSettings = exportSettings
     self._renderer = None
+    self._rendered = {}   # images rendered in advance with renderImages(). key: render key
+    self._textureWriter = None
 
   def imageIndex(self, path):
     img = (self.IMAGE_FILE, path)
@@ -92,22 +142,34 @@ class ImageManager(DataManager):
     return image
 
   def renderedImage(self, width, height, extent, transp_background=False, layerids=None):
-    # render layers with QgsMapRendererCustomPainterJob
-    from qgis.core import QgsMapRendererCustomPainterJob
-    antialias = True
-    settings = self.exportSettings.mapSettings
-
-    # store old map settings
-    old_outputSize = settings.outputSize()
-    old_extent = settings.extent()
-    old_rotation = settings.rotation()
-    old_layerids = settings.layerIds()
-    old_backgroundColor = settings.backgroundColor()
+    """returns a rendered image. images are cached while the layers are not modified."""
+    key = self._renderKey(width, height, extent, transp_background, layerids)
+    image = self._rendered.pop(key, None)
+    if image is not None:
+      return image
+
+    cache = sharedTextureCache()
+    image = cache.get(key) if cache else None
+    if image is None:
+      image = self._renderImage(width, height, extent, transp_background, layerids)
+      if cache:
+        cache.put(key, image)
+    return image
 
-    # map settings
+  def _renderKey(self, width, height, extent, transp_background, layerids):
+    settings = self.exportSettings.mapSettings
+    layers = tools.getLayersByLayerIds(layerids) if layerids else settings.layers()
+    return (tuple((layer.id(), layerRevision(layer)) for layer in layers if layer),
+            width, height, extent.clone(), transp_background,
+            settings.backgroundColor().name(QColor.HexArgb), settings.destinationCrs().toWkt(), settings.outputDpi())
+
+  def _mapSettings(self, width, height, extent, transp_background=False, layerids=None):
+    """returns a copy of map settings for rendering an image. export map settings are not modified."""
+    settings = QgsMapSettings(self.exportSettings.mapSettings)
     settings.setOutputSize(QSize(width, height))
     settings.setExtent(extent.unrotatedRect())
     settings.setRotation(extent.rotation())
+    settings.setFlag(QgsMapSettings.Antialiasing, True)
 
     if layerids:
       settings.setLayers(tools.getLayersByLayerIds(layerids))
@@ -116,12 +178,14 @@ class ImageManager(DataManager):
       settings.setBackgroundColor(QColor(Qt.transparent))
     #else:    #TODO: remove
       #settings.setBackgroundColor(self.exportSettings.canvas.canvasColor())
+    return settings
 
-    has_pluginlayer = False
-    for layer in settings.layers():
-      if layer and layer.type() == QgsMapLayer.PluginLayer:
-        has_pluginlayer = True
-        break
+  def _renderImage(self, width, height, extent, transp_background=False, layerids=None):
+    # render layers with QgsMapRendererCustomPainterJob
+    antialias = True
+    settings = self._mapSettings(width, height, extent, transp_background, layerids)
+
+    has_pluginlayer = hasPluginLayer(settings.layers())
 
     # create an image
     image = QImage(width, height, QImage.Format_ARGB32_Premultiplied)
@@ -139,15 +203,77 @@ class ImageManager(DataManager):
       job.waitForFinished()
     painter.end()
 
-    # restore map settings
-    settings.setOutputSize(old_outputSize)
-    settings.setExtent(old_extent)
-    settings.setRotation(old_rotation)
-    settings.setLayers(tools.getLayersByLayerIds(old_layerids))
-    settings.setBackgroundColor(old_backgroundColor)
-
     return image
 
+  def renderImages(self, items, workers=1):
+    """renders images of items in a batch and keeps them until they are requested with renderedImage().
+    items: list of tuples (width, height, extent, transp_background, layerids)
+    Images that have the same size and whose extents lie on a common grid are rendered into a large image
+    (mosaic) with a parallel render job, and then the mosaic is sliced. Up to workers jobs run concurrently."""
+    cache = sharedTextureCache()
+
+    # group items by size and layers, and then by grid on which extents lie
+    groups = OrderedDict()
+    for item in items:
+      width, height, extent, transp_background, layerids = item
+      key = self._renderKey(*item)
+      if key in self._rendered or (cache and cache.get(key) is not None):
+        continue
+
+      if hasPluginLayer(tools.getLayersByLayerIds(layerids) if layerids else self.exportSettings.mapSettings.layers()):
+        self._rendered[key] = self._renderImage(*item)
+        continue
+
+      grids = groups.setdefault((width, height, extent.width(), extent.height(), extent.rotation(), transp_background, tuple(layerids or [])), [])
+      c = extent.center()
+      for ref, cells in grids:
+        pt = ref.normalizePoint(c.x(), c.y())
+        i, j = round(pt.x() - 0.5), round(pt.y() - 0.5)
+        if abs(pt.x() - 0.5 - i) < 1e-6 and abs(pt.y() - 0.5 - j) < 1e-6:
+          cells.append((key, i, j))
+          break
+      else:
+        grids.append((extent, [(key, 0, 0)]))
+
+    # split grids into mosaics
+    mosaics = []
+    for (width, height, w, h, rotation, transp_background, layerids), grids in groups.items():
+      cols = max(1, self.MOSAIC_MAX_SIZE // width)
+      rows = max(1, self.MOSAIC_MAX_SIZE // height)
+      for ref, cells in grids:
+        tiles = OrderedDict()
+        for cell in cells:
+          tiles.setdefault((cell[1] // cols, cell[2] // rows), []).append(cell)
+
+        for tileCells in tiles.values():
+          i0 = min(cell[1] for cell in tileCells)
+          i1 = max(cell[1] for cell in tileCells)
+          j0 = min(cell[2] for cell in tileCells)
+          j1 = max(cell[2] for cell in tileCells)
+          center = ref.point(QgsPointXY((i0 + i1 + 1) / 2, (j0 + j1 + 1) / 2))
+          extent = RotatedRect(center, (i1 - i0 + 1) * w, (j1 - j0 + 1) * h, rotation)
+          settings = self._mapSettings((i1 - i0 + 1) * width, (j1 - j0 + 1) * height, extent, transp_background, list(layerids))
+          slices = [(key, (i - i0) * width, (j1 - j) * height, width, height) for key, i, j in tileCells]
+          mosaics.append((settings, slices))
+
+    # render mosaics with parallel render jobs
+    workers = max(1, workers)
+    for k in range(0, len(mosaics), workers):
+      jobs = []
+      for settings, slices in mosaics[k:k + workers]:
+        job = QgsMapRendererParallelJob(settings)
+        job.start()
+        jobs.append((job, slices))
+
+      for job, slices in jobs:
+        job.waitForFinished()
+        image = job.renderedImage()
+        for key, x, y, width, height in slices:
+          img = image.copy(x, y, width, height).convertToFormat(QImage.Format_ARGB32_Premultiplied)
+          self._rendered[key] = img
+          if cache:
+            cache.put(key, img)
+
     #if exportSettings.localBrowsingMode:
     #else:
     #  texfilename = os.path.splitext(htmlfilename)[0] + "_%d.png" % plane_index
@@ -186,12 +312,96 @@ class ImageManager(DataManager):
       return tools.base64image(image)
     return None
 
-  def write(self, index, path):
-    self.image(index).save(path)
+  def textureWriter(self):
+    with self._lock:
+      if self._textureWriter is None:
+        self._textureWriter = TextureWriter.fromSettings()
+    return self._textureWriter
+
+  def write(self, index, pathRoot, transparent=False):
+    """encodes the image and writes it to a file in background.
+    pathRoot: file path without extension. returns the file extension."""
+    return self.textureWriter().write(self.image(index), pathRoot, transparent)
 
   def writeAll(self, pathRoot):
     for i in range(self.count()):
-      self.image(i).save("{}_IMG{}.png".format(pathRoot, i))
+      self.write(i, "{}_IMG{}".format(pathRoot, i), True)
+
+  def waitForWrites(self):
+    """waits until all images have been written, and shuts down the texture writer.
+    a new writer is created for the next write."""
+    with self._lock:
+      writer, self._textureWriter = self._textureWriter, None
+    if writer:
+      writer.shutdown()
+
+
+class TextureWriter:
+  """encodes images and writes them to files on a background thread pool.
+  format: PNG, JPEG or WEBP. JPEG is used only for opaque images, and PNG is used for others.
+  quality: JPEG/WebP quality (0-100), compression: PNG compression level (0-9). -1 means default."""
+
+  EXTENSIONS = {"PNG": "png", "JPEG": "jpg", "WEBP": "webp"}
+
+  def __init__(self, format="PNG", quality=-1, compression=-1, workers=2):
+    format = format.upper()
+    if format not in self.EXTENSIONS:
+      logMessage("Unknown texture format: {0}".format(format))
+      format = "PNG"
+    elif format != "PNG" and format.lower().encode("ascii") not in [bytes(f) for f in QImageWriter.supportedImageFormats()]:
+      logMessage("Texture format is not supported: {0}".format(format))
+      format = "PNG"
+
+    self.format = format
+    self.quality = quality
+    self.compression = compression
+    self._executor = ThreadPoolExecutor(max(1, workers))
+    self._futures = []
+
+  @classmethod
+  def fromSettings(cls):
+    settings = QSettings()
+    return cls(settings.value("/Qgis2threejs/textureFormat", def_vals.textureFormat, type=str),
+               settings.value("/Qgis2threejs/textureQuality", def_vals.textureQuality, type=int),
+               settings.value("/Qgis2threejs/textureCompression", def_vals.textureCompression, type=int),
+               settings.value("/Qgis2threejs/workers", def_vals.workers, type=int) + 1)
+
+  def imageFormat(self, transparent=False):
+    if transparent and self.format == "JPEG":
+      return "PNG"
+    return self.format
+
+  def extension(self, transparent=False):
+    return self.EXTENSIONS[self.imageFormat(transparent)]
+
+  def write(self, image, pathRoot, transparent=False):
+    """pathRoot: file path without extension. returns the file extension."""
+    format = self.imageFormat(transparent)
+    if format == "PNG":
+      # Qt maps quality to zlib compression level: level = (100 - quality) * 9 / 91 (truncated)
+      quality = -1 if self.compression < 0 else 100 - math.ceil(min(self.compression, 9) * 91 / 9)
+    else:
+      quality = self.quality
+
+    ext = self.EXTENSIONS[format]
+    self._futures.append(self._executor.submit(self._write, image, "{0}.{1}".format(pathRoot, ext), format, quality))
+    return ext
+
+  def _write(self, image, path, format, quality):
+    writer = QImageWriter(path, format.encode("ascii"))
+    writer.setQuality(quality)
+    if not writer.write(image):
+      logMessage("Failed to write image: {0} ({1})".format(path, writer.errorString()))
+
+  def wait(self):
+    futures, self._futures = self._futures, []
+    for future in futures:
+      future.result()
+
+  def shutdown(self):
+    """waits until all images have been written and stops the worker threads"""
+    self.wait()
+    self._executor.shutdown(wait=True)
 
 
 class MaterialManager(DataManager):
@@ -259,6 +469,7 @@ class MaterialManager(DataManager):
     return self._index(mat)
 
   def build(self, index, imageManager, filepath=None, url=None):
+    """filepath, url: path and url of image file without extension, which is determined by texture format"""
     mat = self._list[index]
     mt = {
       self.WIREFRAME: self.MESH_LAMBERT,
@@ -289,9 +500,9 @@ class MaterialManager(DataManager):
         m["image"] = {"object": imageManager.image(imgIndex)}
         #m["image"] = {"base64": imageManager.base64image(imgIndex)}
       else:
-        m["image"] = {"url": url}
-        # write image to a file
-        imageManager.write(imgIndex, filepath)
+        # write image to a file in background
+        ext = imageManager.write(imgIndex, filepath, transp_background or mat[0] in [self.IMAGE_FILE, self.SPRITE])
+        m["image"] = {"url": "{0}.{1}".format(url, ext)}
     else:
       m["c"] = int(mat[1], 16)    # color
 
@@ -314,11 +525,12 @@ class MaterialManager(DataManager):
 
     return m
 
-  def buildAll(self, imageManager, pathRoot=None, urlRoot=None):
+  def buildAll(self, imageManager, pathRoot=None, urlRoot=None, start=0):
+    """start: index of the first material to build"""
     mList = []
-    for i in range(len(self._list)):
-      filepath = "{0}_IMG{1}.png".format(pathRoot, i)
-      url = "{0}_IMG{1}.png".format(urlRoot, i)
+    for i in range(start, len(self._list)):
+      filepath = "{0}_IMG{1}".format(pathRoot, i)
+      url = "{0}_IMG{1}".format(urlRoot, i)
       mList.append(self.build(i, imageManager, filepath, url))
     return mList
 
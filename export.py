@@ -19,14 +19,17 @@
  *                                                                         *
  ***************************************************************************/
 """
+from functools import partial
 import json
 import os
 
-from PyQt5.QtCore import QDir
+from PyQt5.QtCore import QDir, QSettings
 from qgis.core import QgsMapLayer, QgsProject
 
+from .conf import def_vals
 from .datamanager import ImageManager, ModelManager
 from .exportdem import DEMLayerExporter
+from .exportscheduler import ExportScheduler
 from .exportvector import VectorLayerExporter
 from .exportsettings import ExportSettings
 from .qgis2threejscore import ObjectTreeItem
@@ -37,11 +40,22 @@ from .viewer2 import q3dconst
 
 class ThreeJSExporter:
 
-  def __init__(self, settings, progress=None):
+  def __init__(self, settings, progress=None, workers=None, layerWorkers=None):
+    """workers: number of threads to build DEM blocks concurrently.
+       layerWorkers: number of layers to export concurrently.
+       If None, the values in plugin settings are used."""
     self.settings = settings
     self.progress = progress or dummyProgress
     self.imageManager = ImageManager(settings)
 
+    if workers is None:
+      workers = QSettings().value("/Qgis2threejs/workers", def_vals.workers, type=int)
+    self.workers = max(1, workers)
+
+    if layerWorkers is None:
+      layerWorkers = QSettings().value("/Qgis2threejs/layerWorkers", def_vals.layerWorkers, type=int)
+    self.layerWorkers = max(1, layerWorkers)
+
   def exportScene(self, export_layers=True):
     crs = self.settings.crs
     extent = self.settings.baseExtent
@@ -73,20 +87,59 @@ class ThreeJSExporter:
     return obj
 
   def exportLayers(self):
-    layers = []
-    for index, layer in enumerate(self.settings.data["layers"]):
-      if layer.visible == False:   #TODO: export flag (bool)
-        continue
-
+    """exports layers with an export scheduler. A layer export task depends on earlier tasks:
+      - DEM layer: the previous DEM layer (textures are rendered one layer at a time)
+      - vector layer with heights relative to a DEM layer: the export of the DEM layer (warms caches of DEM provider)
+      - any layer: the previous task that reads the same map layer (as its features, as clip polygons
+        or by rendering it into DEM textures). QGIS map layers must not be read by multiple threads at the same time."""
+    scheduler = ExportScheduler(self.layerWorkers, self.progress)
+
+    lastDEMTask = None
+    demTasks = {}       # key: layer id of DEM layer, value: index of task
+    mapLayerTasks = {}  # key: layer id of map layer read by task, value: index of task
+    layers = [layer for layer in self.settings.data["layers"] if layer.visible != False]   #TODO: export flag (bool)
+    for index, layer in enumerate(layers):
+      properties = layer.properties or {}
+      deps = set()
       if layer.geomType == q3dconst.TYPE_DEM:
-        layers.append(self.exportDEMLayer(layer))
+        func = partial(self.exportDEMLayer, layer, index)
+        if lastDEMTask is not None:
+          deps.add(lastDEMTask)
+        lastDEMTask = demTasks[layer.layerId] = index
+        mapLayerIds = self.textureLayerIds(properties)
+        if properties.get("checkBox_Clip"):
+          mapLayerIds.append(properties.get("comboBox_ClipLayer"))
       else:
-        layers.append(self.exportVectorLayer(layer))
-
-    return layers
-
-  def exportDEMLayer(self, layer):
-    exporter = DEMLayerExporter(self.settings, self.imageManager, layer)
+        func = partial(self.exportVectorLayer, layer, index)
+        if properties.get("radioButton_Relative") and properties.get("comboBox_zDEMLayer") in demTasks:
+          deps.add(demTasks[properties.get("comboBox_zDEMLayer")])
+        mapLayerIds = [layer.layerId]
+
+      for layerId in mapLayerIds:
+        if layerId in mapLayerTasks:
+          deps.add(mapLayerTasks[layerId])
+        mapLayerTasks[layerId] = index
+
+      scheduler.add(layer.name, func, deps)
+
+    # exporters report progress through the scheduler while tasks are running
+    progress = self.progress
+    self.progress = scheduler.progress
+    try:
+      return scheduler.run()
+    finally:
+      self.progress = progress
+
+  def textureLayerIds(self, properties):
+    """returns ids of map layers that are rendered into textures of a DEM layer"""
+    if properties.get("radioButton_MapCanvas", False):
+      return [layer.id() for layer in self.settings.mapSettings.layers()]
+    if properties.get("radioButton_LayerImage", False):
+      return list(properties.get("layerImageIds", []))
+    return []
+
+  def exportDEMLayer(self, layer, index=None):
+    exporter = DEMLayerExporter(self.settings, self.imageManager, layer, progress=self.progress, workers=self.workers)
     return exporter.build()
 
   def demExporters(self, layer):
@@ -96,7 +149,7 @@ class ThreeJSExporter:
     for blockExporter in exporter.blocks():
       yield blockExporter
 
-  def exportVectorLayer(self, layer):
+  def exportVectorLayer(self, layer, index=None):
     exporter = VectorLayerExporter(self.settings, self.imageManager, layer)
     return exporter.build()
 
@@ -110,8 +163,19 @@ class ThreeJSExporter:
 
 class ThreeJSFileExporter(ThreeJSExporter):
 
-  def __init__(self, settings, progress=None):
-    ThreeJSExporter.__init__(self, settings, progress)
+  def __init__(self, settings, progress=None, workers=None, binaryBlocks=None, pyramidLevels=None, layerWorkers=None):
+    """binaryBlocks: write vector feature blocks in binary format.
+       pyramidLevels: number of levels of DEM tile pyramid below the top level. 0 exports DEM blocks at single resolution.
+       If None, the values in plugin settings are used."""
+    ThreeJSExporter.__init__(self, settings, progress, workers, layerWorkers)
+
+    if binaryBlocks is None:
+      binaryBlocks = QSettings().value("/Qgis2threejs/binaryVectorBlocks", def_vals.binaryVectorBlocks, type=bool)
+    self.binaryBlocks = binaryBlocks
+
+    if pyramidLevels is None:
+      pyramidLevels = QSettings().value("/Qgis2threejs/demPyramidLevels", def_vals.demPyramidLevels, type=int)
+    self.pyramidLevels = max(0, pyramidLevels)
 
     self._index = -1
 
@@ -128,6 +192,7 @@ class ThreeJSFileExporter(ThreeJSExporter):
 
     # write scene data to a file in json format
     json_object = self.exportScene()
+    self.imageManager.waitForWrites()   # textures are written in background
     with open(os.path.join(self.settings.outputdatadir, "scene.json"), "w") as f:
       json.dump(json_object, f, indent=2)
 
@@ -165,20 +230,24 @@ class ThreeJSFileExporter(ThreeJSExporter):
     self._index += 1
     return self._index
 
-  def exportDEMLayer(self, layer):
-    title = "L{0}".format(self.nextLayerIndex())
+  def layerTitle(self, index=None):
+    """index: index of layer in exported layers. If None, next index is used."""
+    return "L{0}".format(self.nextLayerIndex() if index is None else index)
+
+  def exportDEMLayer(self, layer, index=None):
+    title = self.layerTitle(index)
     pathRoot = os.path.join(self.settings.outputdatadir, title)
     urlRoot = "./data/{0}/{1}".format(self.settings.htmlfiletitle, title)
 
-    exporter = DEMLayerExporter(self.settings, self.imageManager, layer, pathRoot, urlRoot)
+    exporter = DEMLayerExporter(self.settings, self.imageManager, layer, pathRoot, urlRoot, self.progress, self.workers, self.pyramidLevels)
     return exporter.build(True)
 
-  def exportVectorLayer(self, layer):
-    title = "L{0}".format(self.nextLayerIndex())
+  def exportVectorLayer(self, layer, index=None):
+    title = self.layerTitle(index)
     pathRoot = os.path.join(self.settings.outputdatadir, title)
     urlRoot = "./data/{0}/{1}".format(self.settings.htmlfiletitle, title)
 
-    exporter = VectorLayerExporter(self.settings, self.imageManager, layer, pathRoot, urlRoot)
+    exporter = VectorLayerExporter(self.settings, self.imageManager, layer, pathRoot, urlRoot, self.progress, self.binaryBlocks)
     return exporter.build(True)
 
   def filesToCopy(self):
@@ -232,8 +301,8 @@ class ThreeJSFileExporter(ThreeJSExporter):
     return ['<script src="./%s"></script>' % fn for fn in files]
 
 
-def exportToThreeJS(settings, progress=None):
-  exporter = ThreeJSFileExporter(settings, progress)
+def exportToThreeJS(settings, progress=None, workers=None, binaryBlocks=None, pyramidLevels=None, layerWorkers=None):
+  exporter = ThreeJSFileExporter(settings, progress, workers, binaryBlocks, pyramidLevels, layerWorkers)
   exporter.export()
 
 
@@ -19,28 +19,41 @@
  *                                                                         *
  ***************************************************************************/
 """
-import struct
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+
+import numpy
 from PyQt5.QtCore import QSize
 from qgis.core import QgsPoint, QgsProject, QgsRectangle
 
 from . import gdal2threejs
+from .gdal2threejs import bilinearInterpolation
 from .datamanager import MaterialManager
 from .exportlayer import LayerExporter
-from .geometry import PolygonGeometry, dissolvePolygonsOnCanvas
+from .geometry import PolygonGeometry, dissolvePolygonsOnCanvas, sharedTriangleMesh, zeroZFunc
 from .propertyreader import DEMPropertyReader
 from .qgis2threejscore import GDALDEMProvider
 from . import qgis2threejstools as tools
 from .qgis2threejstools import logMessage
+from .quadtree import DEMQuadTree
 from .rotatedrect import RotatedRect
 
 
 class DEMLayerExporter(LayerExporter):
 
-  def __init__(self, settings, imageManager, layer, pathRoot=None, urlRoot=None, progress=None):
-    """if both pathRoot and urlRoot are None, object is built in all_in_dict mode."""
+  TEXTURE_BATCH_SIZE = 25   # max number of block textures rendered in a batch
+
+  def __init__(self, settings, imageManager, layer, pathRoot=None, urlRoot=None, progress=None, workers=1, pyramidLevels=0):
+    """if both pathRoot and urlRoot are None, object is built in all_in_dict mode.
+       workers: number of threads to build grids of blocks concurrently
+       pyramidLevels: if greater than 0 and pathRoot is set, a tile pyramid of the base extent is exported
+                      instead of blocks (see buildPyramid()), unless clipping or surroundings is enabled"""
     LayerExporter.__init__(self, settings, imageManager, layer, pathRoot, urlRoot, progress)
     self.provider = settings.demProviderByLayerId(layer.layerId)
     self.prop = DEMPropertyReader(layer.layerId, layer.properties)
+    self.workers = workers
+    self.pyramidLevels = pyramidLevels
 
   def build(self, export_blocks=False):
     #if self.settings.exportMode == ExportSettings.PLAIN_SIMPLE:
@@ -67,13 +80,52 @@ class DEMLayerExporter(LayerExporter):
       }
 
     # DEM block
-    if export_blocks:
-      d["data"] = [block.build() for block in self.blocks()]
+    pyramid = export_blocks and self.pyramidLevels > 0 and self.pathRoot is not None
+    if pyramid and (self.properties.get("checkBox_Clip", False) or self.properties.get("checkBox_Surroundings", False)):
+      # tiles of pyramid are neither clipped nor surrounded
+      logMessage("DEM tile pyramid does not support clipping and surroundings. Blocks are exported instead: {0}".format(self.layer.name))
+      pyramid = False
+
+    if pyramid:
+      p["pyramid"] = self.buildPyramid(self.pyramidLevels)
+      d["data"] = []
+    elif export_blocks:
+      d["data"] = self.buildBlocks()
     else:
       d["data"] = []
 
     return d
 
+  def buildBlocks(self, blocks=None):
+    blocks = list(self.blocks() if blocks is None else blocks)
+    count = len(blocks)
+
+    if self.workers > 1 and count > 1 and getattr(self.provider, "threadSafe", False):
+      # grids are built concurrently, and materials (textures) are built in block order in this thread
+      executor = ThreadPoolExecutor(self.workers)
+      grids = [executor.submit(block.buildGrid) for block in blocks]
+    else:
+      executor = None
+      grids = None
+
+    data = []
+    try:
+      for i, block in enumerate(blocks):
+        if i % self.TEXTURE_BATCH_SIZE == 0:
+          # render textures of following blocks in a batch
+          items = [b.textureItem() for b in blocks[i:i + self.TEXTURE_BATCH_SIZE]]
+          items = [item for item in items if item]
+          if len(items) > 1:
+            self.progress(None, "Rendering textures of DEM blocks: {0}".format(self.layer.name))
+            self.imageManager.renderImages(items, self.workers)
+
+        self.progress(None, "Building DEM block {0}/{1}: {2}".format(i + 1, count, self.layer.name))
+        data.append(block.build(grids[i].result() if grids else None))
+    finally:
+      if executor:
+        executor.shutdown()
+    return data
+
   def blocks(self):
     mapTo3d = self.settings.mapTo3d()
     baseExtent = self.settings.baseExtent
@@ -88,7 +140,7 @@ class DEMLayerExporter(LayerExporter):
       clip_layerId = self.properties.get("comboBox_ClipLayer")
       clip_layer = QgsProject.instance().mapLayer(clip_layerId) if clip_layerId else None
       if clip_layer:
-        clip_geometry = dissolvePolygonsOnCanvas(self.settings, clip_layer)
+        clip_geometry = dissolvePolygonsOnCanvas(self.settings, clip_layer, self.workers)
 
     # surroundings
     surroundings = self.properties.get("checkBox_Surroundings", False)    #TODO: if prop.layerId else False   (GSIElevProvider?)
@@ -133,10 +185,65 @@ class DEMLayerExporter(LayerExporter):
                                urlRoot=self.urlRoot)
       yield block
 
+  def buildPyramid(self, levels):
+    """writes grids and textures of quadtree tiles of the base extent to files under data/<title>/tiles/<layer>/z/x/y,
+    and a manifest file in which tile data are keyed by "z/x/y". returns url of the manifest.
+    Every tile has the same grid size as the layer, so resolution doubles with each level."""
+    tileRoot = os.path.join(os.path.dirname(self.pathRoot), "tiles", os.path.basename(self.pathRoot))
+    urlRoot = self.urlRoot.rsplit("/", 1)
+    tileUrlRoot = "{0}/tiles/{1}".format(*urlRoot)
+
+    tiles = list(self.tiles(levels, tileRoot, tileUrlRoot))
+    data = self.buildBlocks(tile for key, tile in tiles)
+
+    manifest = {
+      "type": "pyramid",
+      "levels": levels,
+      "tiles": dict((key, d) for (key, tile), d in zip(tiles, data))
+      }
+    with open(tileRoot + ".json", "w") as f:
+      json.dump(manifest, f, separators=(",", ":"))
+    return tileUrlRoot + ".json"
+
+  def tiles(self, levels, pathRoot, urlRoot):
+    """generator that yields tuples ("z/x/y", DEMBlockExporter) in order of level. x and y are counted from upper-left."""
+    mapTo3d = self.settings.mapTo3d()
+    baseExtent = self.settings.baseExtent
+    grid_size = self.prop.demSize(self.settings.mapSettings.outputSize())
+
+    # subdivide whole the normalized extent
+    quadtree = DEMQuadTree()
+    quadtree.buildTreeByRect(QgsRectangle(0, 0, 1, 1), levels)
+
+    nodes = [quadtree.root]
+    for node in nodes:
+      nodes.extend(node.subNodes)
+
+    for index, node in enumerate(nodes):
+      rect = node.rect
+      n = 2 ** node.height
+      tile = (node.height, int(rect.xMinimum() * n + 0.5), int((1 - rect.yMaximum()) * n + 0.5))
+      block = DEMBlockExporter(self.settings,
+                               self.imageManager,
+                               self.layer,
+                               index,
+                               self.provider,
+                               grid_size,
+                               baseExtent.subrectangle(rect),
+                               mapTo3d.planeWidth / n,
+                               mapTo3d.planeHeight / n,
+                               offsetX=mapTo3d.planeWidth * (rect.center().x() - 0.5),
+                               offsetY=mapTo3d.planeHeight * (rect.center().y() - 0.5),
+                               pathRoot=pathRoot,
+                               urlRoot=urlRoot,
+                               tile=tile)
+      yield "{0}/{1}/{2}".format(*tile), block
+
 
 class DEMBlockExporter:
 
-  def __init__(self, settings, imageManager, layer, blockIndex, provider, grid_size, extent, planeWidth, planeHeight, offsetX=0, offsetY=0, edgeRougheness=1, clip_geometry=None, pathRoot=None, urlRoot=None):
+  def __init__(self, settings, imageManager, layer, blockIndex, provider, grid_size, extent, planeWidth, planeHeight, offsetX=0, offsetY=0, edgeRougheness=1, clip_geometry=None, pathRoot=None, urlRoot=None, tile=None):
+    """tile: tuple (z, x, y) if the block is a tile of pyramid. files of a tile are written to pathRoot/z/x/y.*"""
     self.settings = settings
     self.imageManager = imageManager
     self.materialManager = MaterialManager()
@@ -156,39 +263,53 @@ class DEMBlockExporter:
     self.clip_geometry = clip_geometry
     self.pathRoot = pathRoot
     self.urlRoot = urlRoot
+    self.tile = tile
 
     #TODO: stats
     #self.orig_stats = {"max": max(grid_values), "min": min(grid_values)}
     #self.rect = QgsRectangle(offsetX - plane_width * 0.5, offsetY - plane_height * 0.5,
     #                         offsetX + plane_width * 0.5, offsetY + plane_height * 0.5)
 
-  def build(self):
+  def buildGrid(self):
+    """read grid values and write them to an external binary file if pathRoot is set.
+       this can be called from a worker thread if the provider is thread-safe."""
     mapTo3d = self.settings.mapTo3d()
     shift = mapTo3d.verticalShift
     scale = mapTo3d.multiplierZ
 
+    # shift and scale grid values in place (float32 array)
     grid_values = self.provider.read(self.grid_size.width(), self.grid_size.height(), self.extent)
     if shift != 0:
-      grid_values = [x + shift for x in grid_values]
+      grid_values += shift
 
     if scale != 1:
-      grid_values = [x * scale for x in grid_values]
+      grid_values *= scale
 
     if self.edgeRougheness != 1:
       self.processEdges(grid_values, self.edgeRougheness)
 
     # write grid values to an external binary file
     if self.pathRoot is not None:
-      with open(self.pathRoot + "_DEM{0}.bin".format(self.blockIndex), "wb") as f:
-        f.write(struct.pack("{0}f".format(self.grid_size.width() * self.grid_size.height()), *grid_values))
+      path = self.gridPath(self.pathRoot)
+      if self.tile:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+      with open(path, "wb") as f:
+        grid_values.tofile(f)
+
+    return grid_values
+
+  def build(self, grid_values=None):
+    """grid_values: grid values already built with buildGrid()"""
+    if grid_values is None:
+      grid_values = self.buildGrid()
 
     # block data
     g = {"width": self.grid_size.width(),
          "height": self.grid_size.height()}
 
-    extFileUrl = None if self.urlRoot is None else self.urlRoot + "_DEM{0}.bin".format(self.blockIndex)
+    extFileUrl = None if self.urlRoot is None else self.gridPath(self.urlRoot)
     if extFileUrl is None:
-      g["array"] = grid_values
+      g["array"] = grid_values.tolist()
     else:
       g["url"] = extFileUrl
 
@@ -208,6 +329,10 @@ class DEMBlockExporter:
     if self.clip_geometry:
       b["clip"] = self.clipped()
 
+    if self.tile:
+      b["tile"] = list(self.tile)
+      return b
+
     # sides and bottom
     if self.properties.get("checkBox_Sides", False):
       b["sides"] = True
@@ -218,23 +343,47 @@ class DEMBlockExporter:
 
     return b
 
+  def gridPath(self, root):
+    """root: pathRoot or urlRoot"""
+    if self.tile:
+      return "{0}/{1}/{2}/{3}.bin".format(root, *self.tile)
+    return root + "_DEM{0}.bin".format(self.blockIndex)
+
+  def imagePath(self, root):
+    """root: pathRoot or urlRoot. returns path without extension"""
+    if self.tile:
+      return "{0}/{1}/{2}/{3}".format(root, *self.tile)
+    return "{0}_IMG{1}".format(root, self.blockIndex)
+
+  def textureItem(self):
+    """returns a tuple (width, height, extent, transp_background, layerids) of the texture image
+    to be rendered for this block, or None if the block does not have a rendered texture"""
+    if not (self.properties.get("radioButton_MapCanvas", False) or self.properties.get("radioButton_LayerImage", False)):
+      return None
+
+    texture_scale = self.properties.get("comboBox_TextureSize", 100) // 100
+    transp_background = self.properties.get("checkBox_TransparentBackground", False)
+    canvas_size = self.settings.mapSettings.outputSize()
+    layerids = self.properties.get("layerImageIds", []) if self.properties.get("radioButton_LayerImage", False) else None
+    return (canvas_size.width() * texture_scale, canvas_size.height() * texture_scale, self.extent, transp_background, layerids)
+
   def material(self):
     # properties
-    texture_scale = self.properties.get("comboBox_TextureSize", 100) // 100
     opacity = self.properties.get("spinBox_Opacity", 100) / 100
     transp_background = self.properties.get("checkBox_TransparentBackground", False)
 
     # display type
-    canvas_size = self.settings.mapSettings.outputSize()
+    texture = self.textureItem()
     if self.properties.get("radioButton_MapCanvas", False):
       #if texture_scale == 1:
       #  mi = self.materialManager.getCanvasImageIndex(opacity, transp_background)
       #else:
-      mi = self.materialManager.getMapImageIndex(canvas_size.width() * texture_scale, canvas_size.height() * texture_scale, self.extent, opacity, transp_background)
+      width, height, extent = texture[:3]
+      mi = self.materialManager.getMapImageIndex(width, height, extent, opacity, transp_background)
 
     elif self.properties.get("radioButton_LayerImage", False):
-      layerids = self.properties.get("layerImageIds", [])
-      mi = self.materialManager.getLayerImageIndex(layerids, canvas_size.width() * texture_scale, canvas_size.height() * texture_scale, self.settings.baseExtent, opacity, transp_background)
+      width, height, extent, transp_background, layerids = texture
+      mi = self.materialManager.getLayerImageIndex(layerids, width, height, extent, opacity, transp_background)
 
     elif self.properties.get("radioButton_ImageFile", False):
       filepath = self.properties.get("lineEdit_ImageFile", "")
@@ -247,96 +396,39 @@ class DEMBlockExporter:
     #  mi = self.materialManager.getWireframeIndex(self.properties["lineEdit_Color"], opacity)
 
     # build material
-    filepath = None if self.pathRoot is None else "{0}_IMG{1}.png".format(self.pathRoot, self.blockIndex)
-    url = None if self.urlRoot is None else "{0}_IMG{1}.png".format(self.urlRoot, self.blockIndex)
+    filepath = None if self.pathRoot is None else self.imagePath(self.pathRoot)
+    url = None if self.urlRoot is None else self.imagePath(self.urlRoot)
     return self.materialManager.build(mi, self.imageManager, filepath, url)
 
   def clipped(self):
     mapTo3d = self.settings.mapTo3d()
-    z_func = lambda x, y: 0
-    transform_func = lambda x, y, z: mapTo3d.transform(x, y, z)
+    z_func = zeroZFunc
+    transform_func = mapTo3d.transformArray
 
     geom = PolygonGeometry.fromQgsGeometry(self.clip_geometry, z_func, transform_func)
-    geom.splitPolygon(writer.triangleMesh(self.grid_width, self.grid_height))
-
-    #TODO: geom.toList()
-    polygons = []
-    for polygon in geom.polygons:
-      bnds = []
-      for boundary in polygon:
-        bnds.append([[pt.x, pt.y] for pt in boundary])
-      polygons.append(bnds)
-
-    triangles = Triangles()
-    split_polygons = []
-    for polygon in geom.split_polygons:
-      boundary = polygon[0]
-      if len(polygon) == 1 and len(boundary) == 4:
-        triangles.addTriangle(boundary[0], boundary[2], boundary[1])    # vertex order should be counter-clockwise
-      else:
-        bnds = [[[pt.x, pt.y] for pt in bnd] for bnd in polygon]
-        split_polygons.append(bnds)
+    hw, hh = 0.5 * self.planeWidth, 0.5 * self.planeHeight
+    geom.splitPolygon(sharedTriangleMesh(self.offsetX - hw, self.offsetY - hh, self.offsetX + hw, self.offsetY + hh,
+                                         self.grid_size.width() - 1, self.grid_size.height() - 1))
 
-    return {"polygons": polygons,
-            "triangles": {"v": [[pt.x, pt.y] for pt in triangles.vertices],
-                          "f": triangles.faces},
-            "split_polygons": split_polygons}
+    return {"polygons": geom.asList2(),
+            "triangles": {"v": geom.split_triangles.vertices,
+                          "f": geom.split_triangles.faces},
+            "split_polygons": geom.split_polygons}
 
   def processEdges(self, grid_values, roughness):
-    grid_width = self.grid_size.width()
-    grid_height = self.grid_size.height()
-    rg_grid_width = (grid_width - 1) // roughness + 1
-    rg_grid_height = (grid_height - 1) // roughness + 1
-    ii = range(roughness)[1:]
-
-    for x0 in range(rg_grid_width - 1):
-      # top edge
-      ix0 = x0 * roughness
-      z0 = grid_values[ix0]
-      z1 = grid_values[ix0 + roughness]
-      for i in ii:
-        grid_values[ix0 + i] = (z1 - z0) * i / roughness + z0
-
-      # bottom edge
-      iy0 = grid_width * (grid_height - 1)
-      z0 = grid_values[iy0 + ix0]
-      z1 = grid_values[iy0 + ix0 + roughness]
-      for i in ii:
-        grid_values[iy0 + ix0 + i] = (z1 - z0) * i / roughness + z0
-
-    rw = roughness * grid_width
-    for y0 in range(rg_grid_height - 1):
-      # left edge
-      iy0 = y0 * grid_width
-      z0 = grid_values[iy0]
-      z1 = grid_values[iy0 + rw]
-      for i in ii:
-        grid_values[iy0 + i * grid_width] = (z1 - z0) * i / roughness + z0
-
-      # right edge
-      iy0 += grid_width - 1
-      z0 = grid_values[iy0]
-      z1 = grid_values[iy0 + rw]
-      for i in ii:
-        grid_values[iy0 + i * grid_width] = (z1 - z0) * i / roughness + z0
-
-  def getValue(self, x, y):
-
-    def _getValue(gx, gy):
-      return self.grid_values[gx + self.grid_width * gy]
-
-    if 0 <= x and x <= self.grid_width - 1 and 0 <= y and y <= self.grid_height - 1:
-      ix, iy = int(x), int(y)
-      sx, sy = x - ix, y - iy
-
-      z11 = _getValue(ix, iy)
-      z21 = 0 if x == self.grid_width - 1 else _getValue(ix + 1, iy)
-      z12 = 0 if y == self.grid_height - 1 else _getValue(ix, iy + 1)
-      z22 = 0 if x == self.grid_width - 1 or y == self.grid_height - 1 else _getValue(ix + 1, iy + 1)
-
-      return (1 - sx) * ((1 - sy) * z11 + sy * z12) + sx * ((1 - sy) * z21 + sy * z22)    # bilinear interpolation
-
-    return 0    # as safe null value
+    """interpolate values on the edges linearly between every roughness-th grid point"""
+    grid = grid_values.reshape(self.grid_size.height(), self.grid_size.width())   # view of grid_values
+
+    for edge in [grid[0], grid[-1], grid[:, 0], grid[:, -1]]:   # top, bottom, left and right edges
+      count = (len(edge) - 1) // roughness * roughness + 1
+      anchors = numpy.arange(0, count, roughness)
+      edge[:count] = numpy.interp(numpy.arange(count), anchors, edge[anchors])
+
+  def getValues(self, xs, ys):
+    """xs and ys are numpy arrays of grid coordinates. bilinear interpolation is used"""
+    values = bilinearInterpolation(numpy.asarray(self.grid_values).reshape(self.grid_height, self.grid_width), xs, ys)
+    values[(xs < 0) | (xs > self.grid_width - 1) | (ys < 0) | (ys > self.grid_height - 1)] = 0    # as safe null value
+    return values
 
   def gridPointToPoint(self, x, y):
     x = self.rect.xMinimum() + self.rect.width() / (self.grid_width - 1) * x
@@ -372,26 +464,25 @@ class DEMBlocks:
     center = self.blocks[0]
     blocks = self.blocks[1:ci + 1] + [center] + self.blocks[ci + 1:]
 
-    grid_width, grid_height, grid_values = center.grid_width, center.grid_height, center.grid_values
+    grid_width, grid_height = center.grid_width, center.grid_height
+    grid = numpy.asarray(center.grid_values).reshape(grid_height, grid_width)
     for istop, neighbor in enumerate([blocks[ci - size], blocks[ci + size]]):
       if grid_width == neighbor.grid_width:
         continue
 
       y = grid_height - 1 if not istop else 0
-      for x in range(grid_width):
-        gx, gy = center.gridPointToPoint(x, y)
-        gx, gy = neighbor.pointToGridPoint(gx, gy)
-        grid_values[x + grid_width * y] = neighbor.getValue(gx, gy)
+      gx, gy = center.gridPointToPoint(numpy.arange(grid_width), numpy.full(grid_width, y))
+      grid[y] = neighbor.getValues(*neighbor.pointToGridPoint(gx, gy))
 
     for isright, neighbor in enumerate([blocks[ci - 1], blocks[ci + 1]]):
       if grid_height == neighbor.grid_height:
         continue
 
       x = grid_width - 1 if isright else 0
-      for y in range(grid_height):
-        gx, gy = center.gridPointToPoint(x, y)
-        gx, gy = neighbor.pointToGridPoint(gx, gy)
-        grid_values[x + grid_width * y] = neighbor.getValue(gx, gy)
+      gx, gy = center.gridPointToPoint(numpy.full(grid_height, x), numpy.arange(grid_height))
+      grid[:, x] = neighbor.getValues(*neighbor.pointToGridPoint(gx, gy))
+
+    center.grid_values = grid.ravel()
 
   def stats(self):
     if len(self.blocks) == 0:
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ExportScheduler
+   runs layer export tasks concurrently in dependency order
+                              -------------------
+        begin                : 2017-06-30
+        copyright            : (C) 2017 Minoru Akagi
+        email                : akaginch@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import queue
+import threading
+
+
+class ExportTask:
+
+  def __init__(self, index, name, func, deps):
+    self.index = index
+    self.name = name
+    self.func = func
+    self.deps = set(deps)   # indices of tasks that must finish before this task starts
+
+
+class ExportScheduler:
+  """Runs export tasks on a pool of up to workers threads. A task starts when all the tasks it depends on
+  have finished, and results are returned in the order in which tasks were added.
+  Progress is reported per task, and progress reported by tasks in worker threads is passed to
+  the progress function in the thread that calls run() (progress function may update GUI)."""
+
+  def __init__(self, workers=1, progress=None, percentRange=(0, 90)):
+    self.workers = max(1, workers)
+    self.tasks = []
+    self._progress = progress or dummyProgress
+    self.percentRange = percentRange
+
+    self._thread = None
+    self._messages = queue.Queue()
+
+  def add(self, name, func, deps=()):
+    """adds a task and returns its index. func is called with no arguments.
+    deps: indices of tasks already added that must finish before this task starts"""
+    index = len(self.tasks)
+    for dep in deps:
+      if not 0 <= dep < index:
+        raise ValueError("Invalid dependency: {0}".format(dep))
+
+    self.tasks.append(ExportTask(index, name, func, deps))
+    return index
+
+  def progress(self, percentage=None, statusMsg=None):
+    """progress function for tasks. it can be called from any thread."""
+    if threading.current_thread() is self._thread:
+      self._progress(percentage, statusMsg)
+    else:
+      self._messages.put((percentage, statusMsg))
+
+  def run(self):
+    """runs all tasks and returns a list of their results"""
+    self._thread = threading.current_thread()
+    try:
+      if self.workers == 1:
+        results = []
+        for task in self.tasks:
+          self._taskStarted(task)
+          results.append(task.func())
+          self._taskFinished(len(results))
+        return results
+
+      return self._runConcurrently()
+    finally:
+      self._flushMessages()
+      self._thread = None
+
+  def _runConcurrently(self):
+    results = [None] * len(self.tasks)
+    pending = list(self.tasks)
+    running = {}    # key: future, value: task
+    finished = set()
+
+    with ThreadPoolExecutor(self.workers) as executor:
+      while pending or running:
+        # start tasks whose dependencies have finished, in the order of tasks
+        for task in [t for t in pending if t.deps <= finished]:
+          if len(running) >= self.workers:
+            break
+          pending.remove(task)
+          self._taskStarted(task)
+          running[executor.submit(task.func)] = task
+
+        done, _ = wait(running, timeout=0.1, return_when=FIRST_COMPLETED)
+        self._flushMessages()
+
+        for future in done:
+          task = running.pop(future)
+          try:
+            results[task.index] = future.result()
+          except Exception:
+            # let running tasks finish, and then raise the error
+            pending = []
+            wait(running)
+            raise
+
+          finished.add(task.index)
+          self._taskFinished(len(finished))
+
+    return results
+
+  def _taskStarted(self, task):
+    self._progress(None, "Exporting layer ({0} of {1}): {2}".format(task.index + 1, len(self.tasks), task.name))
+
+  def _taskFinished(self, finishedCount):
+    p0, p1 = self.percentRange
+    self._progress(p0 + (p1 - p0) * finishedCount / len(self.tasks))
+
+  def _flushMessages(self):
+    while True:
+      try:
+        percentage, statusMsg = self._messages.get_nowait()
+      except queue.Empty:
+        return
+      self._progress(percentage, statusMsg)
+
+
+def dummyProgress(progress=None, statusMsg=None):
+  pass
@@ -28,6 +28,7 @@ from .rotatedrect import RotatedRect
 from .qgis2threejscore import ObjectTreeItem, MapTo3D, GDALDEMProvider, FlatDEMProvider, createQuadTree
 from .qgis2threejstools import getLayersInProject, logMessage
 from . import qgis2threejstools as tools
+from .tilecache import sharedTileCache
 from .viewer2 import q3dconst
 
 
@@ -218,6 +219,15 @@ class ExportSettings:
   def get(self, key, default=None):
     return self.data.get(key, default)
 
+  def vectorBlockSize(self):
+    """returns target size of vector feature blocks as a tuple (vertex count, bytes)"""
+    return (int(self.data.get("VectorBlockVertices", def_vals.vectorBlockVertices)),
+            int(self.data.get("VectorBlockBytes", def_vals.vectorBlockBytes)))
+
+  def vectorSortWindow(self):
+    """returns number of vector features sorted along Hilbert curve at a time. 0 keeps layer order"""
+    return int(self.data.get("VectorSortWindow", def_vals.vectorSortWindow))
+
   def checkValidity(self):
     """check validity of export settings. return error message as unicode. return None if valid."""
     if self.exportMode == ExportSettings.PLAIN_MULTI_RES and self.quadtree() is None:
@@ -238,7 +248,8 @@ class ExportSettings:
     else:
       layer = QgsProject.instance().mapLayer(id)
       if layer:
-        return GDALDEMProvider(layer.source(), str(self.crs.toWkt()), source_wkt=str(layer.crs().toWkt()))    # use CRS set to the layer in QGIS
+        return GDALDEMProvider(layer.source(), str(self.crs.toWkt()), source_wkt=str(layer.crs().toWkt()),    # use CRS set to the layer in QGIS
+                               tileCache=sharedTileCache())
 
     return FlatDEMProvider()
 
@@ -25,7 +25,8 @@ from qgis.core import QgsCoordinateTransform, QgsExpressionContext, QgsExpressio
 
 from .datamanager import MaterialManager
 from .exportlayer import LayerExporter
-from .geometry import Geometry, PointGeometry, LineGeometry, PolygonGeometry, TriangleMesh, dissolvePolygonsOnCanvas
+from .geombuffer import writeBinaryBlock
+from .geometry import Geometry, PointGeometry, LineGeometry, PolygonGeometry, dissolvePolygonsOnCanvas, hilbertOrder, sharedTriangleMesh, zeroZFunc
 from .propertyreader import DEMPropertyReader, VectorPropertyReader
 from .qgis2threejscore import ObjectTreeItem
 from . import qgis2threejstools as tools
@@ -35,11 +36,12 @@ from .vectorobject import objectTypeManager
 
 class VectorLayerExporter(LayerExporter):
 
-  def __init__(self, settings, imageManager, layer, pathRoot=None, urlRoot=None, progress=None):
+  def __init__(self, settings, imageManager, layer, pathRoot=None, urlRoot=None, progress=None, binaryBlocks=False):
+    """binaryBlocks: write feature blocks in binary format"""
     LayerExporter.__init__(self, settings, imageManager, layer, pathRoot, urlRoot, progress)
+    self.binaryBlocks = binaryBlocks
 
     self.materialManager = MaterialManager()    #TODO: takes imageManager
-    self.triMesh = {}
 
     self.mapTo3d = settings.mapTo3d()
     self.geomType = self.layer.mapLayer.geometryType()
@@ -88,17 +90,14 @@ class VectorLayerExporter(LayerExporter):
         extent = baseExtent.clone().scale(0.999999)   # clip with slightly smaller extent than map canvas extent
         self.clipGeom = extent.geometry()
 
-    # initialize symbol rendering, and then get features (geometry, attributes, color, etc.)
-    mapLayer.renderer().startRender(renderContext, mapLayer.pendingFields())
-    self.features = layer.features(request)
-    mapLayer.renderer().stopRender(renderContext)
+    # fetch only attributes referenced by the style plan unless all attributes are exported
+    if not layer.writeAttrs:
+      attrNames = self.prop.referencedAttributes()
+      if attrNames is not None:
+        request.setSubsetOfAttributes(attrNames, mapLayer.fields())
 
-    # materials
-    for feat in self.features:
-      #if writer.isCanceled:
-      #  break
-
-      feat.material = self.obj_mod.material(self.settings, layer, feat)
+    self.request = request
+    self.renderContext = renderContext
 
     gt2str = {
       QgsWkbTypes.PointGeometry: "point",
@@ -127,10 +126,10 @@ class VectorLayerExporter(LayerExporter):
                     "height": float(widgetValues.get("editText", 0)) * self.mapTo3d.multiplierZ}
 
     d = {}
-    d["materials"] = self.materialManager.buildAll(self.imageManager)
-
     if export_blocks:
-      d["blocks"] = [block.build() for block in self.blocks()]
+      # features are streamed into blocks, so materials are available after all blocks have been built
+      d["blocks"] = [block.build() for block in self.blocks(materialsInBlock=False)]
+    d["materials"] = self.materialManager.buildAll(self.imageManager)
 
     return {
       "type": "layer",
@@ -140,17 +139,30 @@ class VectorLayerExporter(LayerExporter):
       "PROPERTIES": properties    # debug
       }
 
-  def blocks(self):
+  def blocks(self, materialsInBlock=True):
+    """Fetches features from the layer in a single pass and yields block exporters.
+    If a sort window is set in export settings, features are sorted along Hilbert curve in windows of that size.
+    A block is closed when its vertex count or estimated size would exceed the target size in export settings,
+    so that the whole layer is never held in memory.
+    materialsInBlock: if True, each block has materials that were added while its features were processed."""
+    maxVertices, maxBytes = self.settings.vectorBlockSize()
+    packed = self.binaryBlocks and self.pathRoot is not None    # geometries are packed into binary blocks
+    bytesPerCoord = 4 if packed else 20    # rough size of a coordinate value in JSON
     index = 0
-    FEATURE_COUNT = 50    #TODO: VERTEX_COUNT
+    mtlIndex = 0
 
-    def block(blockIndex, features):
-      return FeatureBlockExporter(blockIndex, {
+    def block(blockIndex, features, bbox):
+      data = {
         "type": "block",
         "layer": self.layer.jsLayerId,
         "block": blockIndex,
         "features": features
-        }, self.pathRoot, self.urlRoot)
+        }
+      if bbox is not None:
+        data["bbox"] = bbox
+      if materialsInBlock:
+        data["materials"] = self.materialManager.buildAll(self.imageManager, start=mtlIndex)
+      return FeatureBlockExporter(blockIndex, data, self.pathRoot, self.urlRoot, self.binaryBlocks)
 
     demProvider = None
     if self.prop.isHeightRelativeToDEM():
@@ -164,68 +176,137 @@ class VectorLayerExporter(LayerExporter):
     else:
       useZM = Geometry.NotUseZM
 
-    feats = []
-    for feat in self.features or []:
-      geom = feat.geometry(self.mapTo3d, useZM, demProvider, self.clipGeom, self.hasLabel)
-      if geom is None:
-        continue
-
-      f = {}
-      f["geom"] = self.obj_mod.geometry(self.settings, self._layer, feat, geom)
-      f["mat"] = feat.material
-
-      if feat.attributes is not None:
-        f["prop"] = feat.attributes
+    triMesh = None
+    if self.geomType == QgsWkbTypes.PolygonGeometry and self.prop.type_index == 1 and self.prop.isHeightRelativeToDEM():   # Overlay
+      triMesh = self.triangleMesh()
 
-      feats.append(f)
-
-      if len(feats) == FEATURE_COUNT:
-        yield block(index, feats)
+    # features of each block are fetched and styled (geometry, attributes, color, etc.) in a rendering session of
+    # its own, which is closed before the block is yielded. the generator can be abandoned at any point.
+    renderer = self.layer.mapLayer.renderer()
+    sortWindow = self.settings.vectorSortWindow()
+    if sortWindow > 0:
+      features = self._layer.sortedFeatures(self.request, sortWindow)
+    else:
+      features = self._layer.features(self.request)
+    carried = None    # feature that did not fit in the previous block
+    finished = False
+    while not finished:
+      feats = []
+      vertexCount = byteCount = 0
+      bbox = None
+      if carried:
+        f, n, size, bounds = carried
+        feats.append(f)
+        vertexCount, byteCount, bbox = n, size, unionBounds(None, bounds)
+        carried = None
+
+      renderer.startRender(self.renderContext, self.layer.mapLayer.pendingFields())
+      self.prop.resetSymbolCache()
+      try:
+        finished = True
+        for feat in features:
+          feat.material = self.obj_mod.material(self.settings, self._layer, feat)
+
+          geom = feat.geometry(self.mapTo3d, useZM, demProvider, self.clipGeom, self.hasLabel, triMesh)
+          if geom is None:
+            continue
+          geom.packed = packed
+
+          f = {}
+          f["geom"] = self.obj_mod.geometry(self.settings, self._layer, feat, geom)
+          f["mat"] = feat.material
+
+          if feat.attributes is not None:
+            f["prop"] = feat.attributes
+
+          # close current block if this feature makes it larger than the target size
+          n = geom.vertexCount()
+          size = 3 * n * bytesPerCoord
+          if feat.attributes is not None:
+            size += sum(len(str(a)) + 4 for a in feat.attributes)
+
+          if feats and (vertexCount + n > maxVertices or byteCount + size > maxBytes):
+            carried = (f, n, size, geom.bounds())
+            finished = False
+            break
+
+          feats.append(f)
+          vertexCount += n
+          byteCount += size
+          bbox = unionBounds(bbox, geom.bounds())
+
+      finally:
+        renderer.stopRender(self.renderContext)
+
+      if feats or index == 0:
+        b = block(index, feats, bbox)
+        mtlIndex = self.materialManager.count()
+        yield b
         index += 1
-        feats = []
-
-    if len(feats) or index == 0:
-      yield block(index, feats)
 
   def triangleMesh(self, dem_width=0, dem_height=0):
     if dem_width == 0 and dem_height == 0:
-      #TODO:
-      prop = DEMPropertyReader(layerId, self.settings.get(ObjectTreeItem.ITEM_DEM))
+      layerId = self.layer.properties.get("comboBox_zDEMLayer")
+      item = self.settings.getItemByLayerId(layerId)
+      prop = DEMPropertyReader(layerId, item.properties if item else None)
       dem_size = prop.demSize(self.settings.mapSettings.outputSize())
       dem_width = dem_size.width()
       dem_height = dem_size.height()
 
-    key = "{0}x{1}".format(dem_width, dem_height)
-    if key not in self.triMesh:
-      mapTo3d = self.settings.mapTo3d()
-      hw = 0.5 * mapTo3d.planeWidth
-      hh = 0.5 * mapTo3d.planeHeight
-      self.triMesh[key] = TriangleMesh(-hw, -hh, hw, hh, dem_width - 1, dem_height - 1)
-    return self.triMesh[key]
+    mapTo3d = self.settings.mapTo3d()
+    hw = 0.5 * mapTo3d.planeWidth
+    hh = 0.5 * mapTo3d.planeHeight
+    return sharedTriangleMesh(-hw, -hh, hw, hh, dem_width - 1, dem_height - 1)
 
 
 class FeatureBlockExporter:
   
-  def __init__(self, blockIndex, data, pathRoot=None, urlRoot=None):
+  def __init__(self, blockIndex, data, pathRoot=None, urlRoot=None, binary=False):
+    """binary: write block in binary format (see geombuffer.py). valid only if pathRoot is specified"""
     self.blockIndex = blockIndex
     self.data = data
     self.pathRoot = pathRoot
     self.urlRoot = urlRoot
+    self.binary = binary
 
   def build(self):
+    if self.pathRoot is not None and self.binary:
+      with open(self.pathRoot + "_GEOM{0}.bin".format(self.blockIndex), "wb") as f:
+        writeBinaryBlock(f, self.data)
+
+      url = self.urlRoot + "_GEOM{0}.bin".format(self.blockIndex)
+      return self._blockRef({"url": url, "format": "binary"})
+
     if self.pathRoot is not None:
       with open(self.pathRoot + "_GEOM{0}.json".format(self.blockIndex), "w", encoding="UTF-8") as f:
         json.dump(self.data, f, ensure_ascii=False, indent=1)
 
       url = self.urlRoot + "_GEOM{0}.json".format(self.blockIndex)
-      return {"url": url}
+      return self._blockRef({"url": url})
 
     else:
       return self.data
 
+  def _blockRef(self, ref):
+    # bounding box of the block helps the viewer to load blocks by region
+    if "bbox" in self.data:
+      ref["bbox"] = self.data["bbox"]
+    return ref
+
+
+def unionBounds(b1, b2):
+  """union of two bounds (xmin, ymin, zmin, xmax, ymax, zmax). either can be None"""
+  if b1 is None:
+    return list(b2) if b2 else None
+  if b2 is None:
+    return b1
+  return [min(b1[0], b2[0]), min(b1[1], b2[1]), min(b1[2], b2[2]),
+          max(b1[3], b2[3]), max(b1[4], b2[4]), max(b1[5], b2[5])]
+
 class Feature:
 
-  def __init__(self, layer, qGeom, height, propValues, attrs=None):
+  def __init__(self, layer, qGeom, height, propValues, attrs=None, fid=None):
+    self.fid = fid
     self.layerProp = layer.prop
     self.geom = qGeom
     self.geomType = layer.geomType
@@ -236,16 +317,17 @@ class Feature:
 
     self.material = -1
 
-  def geometry(self, mapTo3d, useZM=Geometry.NotUseZM, demProvider=None, clipGeom=None, calcCentroid=False):
-    """calcCentroid: for polygon geometry"""
-    # z_func: function to get elevation at given point (x, y) on surface
+  def geometry(self, mapTo3d, useZM=Geometry.NotUseZM, demProvider=None, clipGeom=None, calcCentroid=False, triMesh=None):
+    """calcCentroid: for polygon geometry
+       triMesh: TriangleMesh to split overlay polygons"""
+    # z_func: function to get elevations at given points (xs, ys) on surface
     if demProvider:
-      z_func = lambda x, y: demProvider.readValue(x, y)
+      z_func = demProvider.readValues
     else:
-      z_func = lambda x, y: 0
+      z_func = zeroZFunc
 
-    # transform_func: function to transform the map coordinates to 3d coordinates
-    transform_func = lambda x, y, z: mapTo3d.transform(x, y, z + self.relativeHeight)
+    # transform_func: function to transform arrays of the map coordinates to an array of 3d coordinates
+    transform_func = lambda xs, ys, zs: mapTo3d.transformArray(xs, ys, zs + self.relativeHeight)
 
     #if useZ and False:    #TODO: use QGIS API
       # ogr_geom = ogr.CreateGeometryFromWkb(bytes(geometry.exportToWkb()))
@@ -266,10 +348,8 @@ class Feature:
 
     if self.geomType == QgsWkbTypes.PolygonGeometry:
       geom = self.geomClass.fromQgsGeometry(geom, z_func, transform_func, calcCentroid)
-      if self.layerProp.type_index == 1 and self.layerProp.isHeightRelativeToDEM():   # Overlay and relative to DEM
-        pass
-        #TODO:
-        #feat.geom.splitPolygon(self.writer.triangleMesh())
+      if triMesh is not None and self.layerProp.type_index == 1 and self.layerProp.isHeightRelativeToDEM():   # Overlay and relative to DEM
+        geom.splitPolygon(triMesh)
       return geom
 
     else:
@@ -338,6 +418,7 @@ class VectorLayer(Layer):
     return obj
 
   def features(self, request=None):
+    """generator that yields Feature objects fetched from the layer"""
     baseExtent = self.settings.baseExtent
     baseExtentGeom = baseExtent.geometry()
     rotation = baseExtent.rotation()
@@ -345,7 +426,6 @@ class VectorLayer(Layer):
 
     useZ = prop.useZ()
 
-    feats = []
     for f in self.layer.getFeatures(request or QgsFeatureRequest()):
       geometry = f.geometry()
       if geometry is None:
@@ -372,7 +452,28 @@ class VectorLayer(Layer):
       attrs = f.attributes() if self.writeAttrs else None
 
       # create a feature object
-      feat = Feature(self, geom, height, propVals, attrs)
-      feats.append(feat)
+      yield Feature(self, geom, height, propVals, attrs, f.id())
+
+  def sortedFeatures(self, request=None, windowSize=1000):
+    """generator that yields Feature objects in spatially coherent order.
+    Features are fetched in a single pass, and each window of windowSize features is sorted
+    along Hilbert curve by center of bounding box, so at most windowSize features are held in memory."""
+    rect = self.settings.baseExtent.boundingBox()
+    window = []
+    for feat in self.features(request):
+      window.append(feat)
+      if len(window) < windowSize:
+        continue
+
+      for feat in self._hilbertSorted(window, rect):
+        yield feat
+      window = []
+
+    for feat in self._hilbertSorted(window, rect):
+      yield feat
 
-    return feats
+  def _hilbertSorted(self, feats, rect):
+    if len(feats) < 3:
+      return feats
+    centers = [feat.geom.boundingBox().center() for feat in feats]
+    return [feats[i] for i in hilbertOrder([c.x() for c in centers], [c.y() for c in centers], rect)]
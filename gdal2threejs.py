@@ -19,6 +19,7 @@ import os
 import sys
 import struct
 import base64
+import numpy
 
 from osgeo import gdal
 
@@ -61,6 +62,25 @@ class Raster:
     return values
 
 
+def bilinearInterpolation(grid, xs, ys):
+  """interpolate grid values bilinearly.
+  args:
+    grid   -- 2d numpy array (rows, cols). both sizes must be 2 or larger
+    xs, ys -- numpy arrays of grid coordinates (fractional column and row indices)
+  """
+  rows, cols = grid.shape
+  ix = numpy.clip(numpy.floor(xs).astype(numpy.int64), 0, cols - 2)
+  iy = numpy.clip(numpy.floor(ys).astype(numpy.int64), 0, rows - 2)
+  sx = xs - ix
+  sy = ys - iy
+
+  z11 = grid[iy, ix]
+  z21 = grid[iy, ix + 1]
+  z12 = grid[iy + 1, ix]
+  z22 = grid[iy + 1, ix + 1]
+  return (1 - sx) * ((1 - sy) * z11 + sy * z12) + sx * ((1 - sy) * z21 + sy * z22)
+
+
 def base64image(filename):
   with open(filename, "rb") as f:
     subtype = os.path.splitext(filename)[1][1:].lower().replace("jpg", "jpeg")
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ GeometryBuffer
+                              -------------------
+        begin                : 2017-06-14
+        copyright            : (C) 2017 Minoru Akagi
+        email                : akaginch@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Binary block format (little endian):
+   magic "Q3DB" (4 bytes), header length (uint32),
+   header (UTF-8 encoded JSON, padded with spaces to a multiple of 4 bytes),
+   Uint32 array of counts and indices,
+   Float32 array of coordinates.
+
+ In the header, a point list in feature geometry is replaced with {"_b": [dim, depth, coordOffset, indexOffset]}
+ and a list of index tuples with {"_i": [dim, indexOffset]}. See Q3D.Utils.decodeBinaryBlock() in Qgis2threejs.js.
+"""
+import json
+import struct
+
+import numpy
+
+MAGIC = b"Q3DB"
+
+# depth of point list nesting: 1 = [pt, ...], 2 = [[pt, ...], ...], 3 = [[[pt, ...], ...], ...]
+COORD_KEYS = {"pts": 1, "lines": 2, "polygons": 3, "split_polygons": 3, "centroids": 1, "v": 1}
+INDEX_KEYS = {"f": 1}
+
+
+class CoordList:
+  """nested point list that refers to a coordinate array instead of holding lists of points.
+  coords: array of shape (vertex count, dim)
+  offsets: list of offset arrays of nested lists, outermost first. each array has (number of lists + 1) elements.
+  Geometries return this from asList() and asList2() if they are packed into binary blocks."""
+
+  def __init__(self, coords, offsets=()):
+    self.coords = coords
+    self.offsets = list(offsets)
+
+  def __len__(self):
+    return len(self.offsets[0]) - 1 if self.offsets else len(self.coords)
+
+  def depth(self):
+    return len(self.offsets) + 1
+
+  def counts(self):
+    """returns lengths of the list and the nested lists in depth-first order (as GeometryBuffer writes them)"""
+    if not self.offsets:
+      return numpy.array([len(self.coords)], dtype=numpy.int64)
+
+    seq = numpy.diff(self.offsets[-1])    # lengths of innermost lists
+    starts = numpy.arange(len(seq) + 1)   # positions of the lengths in seq, and the end of seq
+    for offsets in reversed(self.offsets[:-1]):
+      # put the length of each list before the lengths of its children
+      pos = starts[offsets[:-1]]
+      seq = numpy.insert(seq, pos, numpy.diff(offsets))
+      starts = numpy.append(pos + numpy.arange(len(pos)), len(seq))
+    return numpy.concatenate([[len(self)], seq])
+
+  def tolist(self):
+    items = self.coords.tolist()
+    for offsets in reversed(self.offsets):
+      offsets = offsets.tolist()
+      items = [items[s:e] for s, e in zip(offsets[:-1], offsets[1:])]
+    return items
+
+
+class GeometryBuffer:
+  """packs nested point lists into a flat Float32 coordinate array and a Uint32 count/index array"""
+
+  def __init__(self):
+    self._coords = []
+    self._coordCount = 0
+    self._indices = []
+    self._indexCount = 0
+
+  def pack(self, geom):
+    """returns a copy of geometry dict in which point lists are replaced with references to the buffers"""
+    g = {}
+    for key, value in geom.items():
+      if isinstance(value, dict):
+        g[key] = self.pack(value)
+      elif key in COORD_KEYS and len(value):
+        g[key] = self.packPoints(value, COORD_KEYS[key])
+      elif key in INDEX_KEYS and len(value):
+        g[key] = self.packIndices(value)
+      elif isinstance(value, CoordList):
+        g[key] = value.tolist()     # empty list
+      else:
+        g[key] = value
+    return g
+
+  def packPoints(self, pts, depth):
+    """pts: list of points (list or 2d array) nested depth - 1 times, or CoordList"""
+    ref = [0, depth, self._coordCount, self._indexCount]
+    ref[0] = self._addPoints(pts, depth)
+    return {"_b": ref}
+
+  def packIndices(self, tuples):
+    a = numpy.asarray(tuples, dtype=numpy.uint32)
+    ref = {"_i": [a.shape[1], self._indexCount]}
+    self._appendIndices([len(a)])
+    self._appendIndices(a.ravel())
+    return ref
+
+  def _addPoints(self, pts, depth):
+    if isinstance(pts, CoordList):
+      return self._addCoordList(pts, depth)
+
+    self._appendIndices([len(pts)])
+    if depth > 1:
+      dim = 0
+      for child in pts:
+        dim = self._addPoints(child, depth - 1) or dim
+      return dim
+
+    if len(pts) == 0:
+      return 0
+    a = numpy.asarray(pts, dtype=numpy.float32)
+    self._coords.append(a.ravel())
+    self._coordCount += a.size
+    return a.shape[1]
+
+  def _addCoordList(self, pts, depth):
+    if pts.depth() != depth:
+      raise ValueError("depth of point list is {0}, but {1} is expected".format(pts.depth(), depth))
+
+    self._appendIndices(pts.counts())
+    if len(pts.coords) == 0:
+      return 0
+    a = numpy.asarray(pts.coords, dtype=numpy.float32)
+    self._coords.append(a.ravel())
+    self._coordCount += a.size
+    return a.shape[1]
+
+  def _appendIndices(self, values):
+    a = numpy.asarray(values, dtype=numpy.uint32)
+    self._indices.append(a)
+    self._indexCount += a.size
+
+  def indexArray(self):
+    if self._indices:
+      return numpy.concatenate(self._indices)
+    return numpy.empty(0, dtype=numpy.uint32)
+
+  def coordArray(self):
+    if self._coords:
+      return numpy.concatenate(self._coords)
+    return numpy.empty(0, dtype=numpy.float32)
+
+
+def writeBinaryBlock(f, data):
+  """data: block data. feature geometries in data["features"] are packed into the buffers.
+  f: file object opened in binary mode"""
+  buf = GeometryBuffer()
+  header = dict(data)
+  header["features"] = [dict(feat, geom=buf.pack(feat["geom"])) for feat in data["features"]]
+
+  indices = buf.indexArray().astype("<u4", copy=False)
+  coords = buf.coordArray().astype("<f4", copy=False)
+  header["buffer"] = {"i": int(indices.size), "c": int(coords.size)}
+
+  h = json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode("UTF-8")
+  h += b" " * (-len(h) % 4)
+
+  f.write(MAGIC)
+  f.write(struct.pack("<I", len(h)))
+  f.write(h)
+  f.write(indices.tobytes())
+  f.write(coords.tobytes())
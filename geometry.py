@@ -18,16 +18,26 @@
  *                                                                         *
  ***************************************************************************/
 """
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import math
+import threading
+
+import numpy
 from osgeo import ogr
 from qgis.core import (
-  QgsGeometry, QgsPointXY, QgsRectangle, QgsFeature, QgsSpatialIndex, QgsCoordinateTransform, QgsFeatureRequest,
+  QgsGeometry, QgsPointXY, QgsRectangle, QgsCoordinateTransform, QgsFeatureRequest,
   QgsPoint, QgsMultiPointV2, QgsLineString, QgsMultiLineString)
 
+from .cache import layerRevision
+from .geombuffer import CoordList
 from .qgis2threejstools import logMessage
 
 
 class Point:
 
+  __slots__ = ("x", "y", "z")
+
   def __init__(self, x, y, z=0):
     self.x = x
     self.y = y
@@ -41,49 +51,151 @@ class Point:
 
 
 def pointToQgsPoint(point):
-  return QgsPointXY(point.x, point.y)
+  return QgsPointXY(point[0], point[1])
 
 
 def lineToQgsPolyline(line):
-  return [pointToQgsPoint(pt) for pt in line]
+  return [QgsPointXY(x, y) for x, y in line[:, :2].tolist()]
 
 
 def polygonToQgsPolygon(polygon):
   return [lineToQgsPolyline(line) for line in polygon]
 
 
+def zValues(z_func, pts):
+  """get elevations at the points with a z_func call"""
+  return z_func([pt.x() for pt in pts], [pt.y() for pt in pts])
+
+
+def zValuesOfParts(z_func, parts):
+  """get elevations at the points of all parts with a z_func call, and split them by part"""
+  zs = zValues(z_func, [pt for part in parts for pt in part])
+  values = []
+  i = 0
+  for part in parts:
+    values.append(zs[i:i + len(part)])
+    i += len(part)
+  return values
+
+
+def zeroZFunc(xs, ys):
+  return [0] * len(xs)
+
+
+def transformCoords(transform_func, xs, ys, zs):
+  """transforms points with transform_func and returns an array of shape (n, 3).
+  transform_func: function to transform arrays of map coordinates (xs, ys, zs) to an array of 3d coordinates"""
+  if len(xs) == 0:
+    return numpy.empty((0, 3))
+  return transform_func(numpy.asarray(xs, dtype=numpy.float64),
+                        numpy.asarray(ys, dtype=numpy.float64),
+                        numpy.asarray(zs, dtype=numpy.float64))
+
+
+def partOffsets(counts):
+  """returns offsets of parts in a flat array, which has len(counts) + 1 elements"""
+  offsets = numpy.zeros(len(counts) + 1, dtype=numpy.int64)
+  numpy.cumsum(counts, out=offsets[1:])
+  return offsets
+
+
+def splitByOffsets(items, offsets):
+  """splits a sequence (list or array) into parts at the offsets"""
+  offsets = offsets.tolist()
+  return [items[s:e] for s, e in zip(offsets[:-1], offsets[1:])]
+
+
+def hilbertIndex(xs, ys, order=16):
+  """returns distances of points along Hilbert curve.
+  xs, ys: arrays of integer coordinates in range [0, 2 ** order)"""
+  n = 1 << order
+  x = numpy.array(xs, dtype=numpy.int64)
+  y = numpy.array(ys, dtype=numpy.int64)
+  d = numpy.zeros(len(x), dtype=numpy.int64)
+  s = n >> 1
+  while s > 0:
+    rx = (x & s) > 0
+    ry = (y & s) > 0
+    d += s * s * ((3 * rx) ^ ry)
+
+    # rotate
+    flip = ~ry & rx
+    x = numpy.where(flip, n - 1 - x, x)
+    y = numpy.where(flip, n - 1 - y, y)
+    x, y = numpy.where(ry, x, y), numpy.where(ry, y, x)
+    s >>= 1
+  return d
+
+
+def hilbertOrder(xs, ys, rect=None, order=16):
+  """returns indices that sort points along Hilbert curve. points at the same distance keep their order.
+  xs, ys: arrays of coordinates
+  rect: QgsRectangle that the curve covers. points outside it are clamped to it. if None, bounding box of the points"""
+  xs = numpy.asarray(xs, dtype=numpy.float64)
+  ys = numpy.asarray(ys, dtype=numpy.float64)
+  if rect is None:
+    xmin, ymin, xmax, ymax = xs.min(), ys.min(), xs.max(), ys.max()
+  else:
+    xmin, ymin, xmax, ymax = rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum()
+
+  m = (1 << order) - 1
+  ix = numpy.clip((xs - xmin) / ((xmax - xmin) or 1), 0, 1) * m
+  iy = numpy.clip((ys - ymin) / ((ymax - ymin) or 1), 0, 1) * m
+  return numpy.argsort(hilbertIndex(ix, iy, order), kind="mergesort")
+
+
 class Geometry:
+  """Vertices are stored in an array of shape (vertex count, 3) (coords). Geometries that have
+  multiple parts have arrays of offsets of the parts in coords.
+  If packed is True, asList() and asList2() return CoordList objects that refer to the arrays
+  instead of nested lists, which are packed into binary blocks without conversion."""
 
   NotUseZM = 0
   UseZ = 1
   UseM = 2
 
+  def __init__(self):
+    self.coords = numpy.empty((0, 3))
+    self.packed = False
 
-class PointGeometry(Geometry):
+  def vertexCount(self):
+    return len(self.coords)
 
-  def __init__(self):
-    self.pts = []
+  def bounds(self):
+    """returns (xmin, ymin, zmin, xmax, ymax, zmax) of vertices. returns None if there is no vertex."""
+    if len(self.coords) == 0:
+      return None
+    return tuple(self.coords.min(axis=0).tolist() + self.coords.max(axis=0).tolist())
+
+  def _nestedList(self, coords, offsets=()):
+    lst = CoordList(coords, offsets)
+    return lst if self.packed else lst.tolist()
+
+
+class PointGeometry(Geometry):
 
   def asList(self):
-    return [[pt.x, pt.y, pt.z] for pt in self.pts]
+    return self._nestedList(self.coords)
 
   def toQgsGeometry(self):
-    count = len(self.pts)
+    count = len(self.coords)
     if count > 1:
-      pts = [pointToQgsPoint(pt) for pt in self.pts]
+      pts = [pointToQgsPoint(pt) for pt in self.coords]
       return QgsGeometry.fromMultiPoint(pts)
 
     if count == 1:
-      return QgsGeometry.fromPoint(pointToQgsPoint(self.pts[0]))
+      return QgsGeometry.fromPoint(pointToQgsPoint(self.coords[0]))
 
     return QgsGeometry()
 
   @classmethod
   def fromQgsGeometry(cls, geometry, z_func, transform_func, useZM=Geometry.NotUseZM):
+    """z_func: function to get elevations at given points (xs, ys) on surface
+       transform_func: function to transform arrays of map coordinates (xs, ys, zs) to an array of 3d coordinates"""
     geom = cls()
     if useZM == Geometry.NotUseZM:
       pts = geometry.asMultiPoint() if geometry.isMultipart() else [geometry.asPoint()]
-      geom.pts = [transform_func(pt.x(), pt.y(), z_func(pt.x(), pt.y())) for pt in pts]
+      zs = zValues(z_func, pts)
 
     else:
       g = geometry.geometry()
@@ -95,12 +207,14 @@ class PointGeometry(Geometry):
         logMessage("Unknown point geometry type: " + type(g))
         pts = []
 
+      zs = zValues(z_func, pts)
       if useZM == Geometry.UseZ:
-        geom.pts = [transform_func(pt.x(), pt.y(), pt.z() + z_func(pt.x(), pt.y())) for pt in pts]
+        zs = [pt.z() + z for pt, z in zip(pts, zs)]
 
       else:   # UseM
-        geom.pts = [transform_func(pt.x(), pt.y(), pt.m() + z_func(pt.x(), pt.y())) for pt in pts]
+        zs = [pt.m() + z for pt, z in zip(pts, zs)]
 
+    geom.coords = transformCoords(transform_func, [pt.x() for pt in pts], [pt.y() for pt in pts], zs)
     return geom
 
 
@@ -124,38 +238,49 @@ class PointGeometry(Geometry):
         pts += [geom.GetPoint(i) for i in range(geom.GetPointCount())]
 
     point_geom = PointGeometry()
-    point_geom.pts = [transform_func(pt[0], pt[1], pt[2]) for pt in pts]
+    point_geom.coords = transformCoords(transform_func, *zip(*pts)) if pts else numpy.empty((0, 3))
     return point_geom
 
 
 class LineGeometry(Geometry):
 
   def __init__(self):
-    self.lines = []
+    Geometry.__init__(self)
+    self.offsets = numpy.zeros(1, dtype=numpy.int64)    # offsets of lines in coords
+
+  def lineCount(self):
+    return len(self.offsets) - 1
+
+  def lines(self):
+    """returns a list of coordinate arrays (views of coords) of lines"""
+    return splitByOffsets(self.coords, self.offsets)
 
   def asList(self):
-    return [[[pt.x, pt.y, pt.z] for pt in line] for line in self.lines]
+    return self._nestedList(self.coords, [self.offsets])
 
   def asList2(self):
-    return [[[pt.x, pt.y] for pt in line] for line in self.lines]
+    return self._nestedList(self.coords[:, :2], [self.offsets])
 
   def toQgsGeometry(self):
-    count = len(self.lines)
+    count = self.lineCount()
     if count > 1:
-      lines = [lineToQgsPolyline(line) for line in self.lines]
+      lines = [lineToQgsPolyline(line) for line in self.lines()]
       return QgsGeometry.fromMultiPolyline(lines)
 
     if count == 1:
-      return QgsGeometry.fromPolyline(lineToQgsPolyline(self.lines[0]))
+      return QgsGeometry.fromPolyline(lineToQgsPolyline(self.coords))
 
     return QgsGeometry()
 
   @classmethod
   def fromQgsGeometry(cls, geometry, z_func, transform_func, useZM=Geometry.NotUseZM):
+    """z_func: function to get elevations at given points (xs, ys) on surface
+       transform_func: function to transform arrays of map coordinates (xs, ys, zs) to an array of 3d coordinates"""
     geom = cls()
     if useZM == Geometry.NotUseZM:
       lines = geometry.asMultiPolyline() if geometry.isMultipart() else [geometry.asPolyline()]
-      geom.lines = [[transform_func(pt.x(), pt.y(), z_func(pt.x(), pt.y())) for pt in line] for line in lines]
+      pts = [pt for line in lines for pt in line]
+      zs = zValues(z_func, pts)
 
     else:
       g = geometry.geometry()
@@ -167,12 +292,16 @@ class LineGeometry(Geometry):
         logMessage("Unknown line geometry type: " + type(g))
         lines = []
 
+      pts = [pt for line in lines for pt in line]
+      zs = zValues(z_func, pts)
       if useZM == Geometry.UseZ:
-        geom.lines = [[transform_func(pt.x(), pt.y(), pt.z() + z_func(pt.x(), pt.y())) for pt in line] for line in lines]
+        zs = [pt.z() + z for pt, z in zip(pts, zs)]
 
       else:   # UseM
-        geom.lines = [[transform_func(pt.x(), pt.y(), pt.m() + z_func(pt.x(), pt.y())) for pt in line] for line in lines]
+        zs = [pt.m() + z for pt, z in zip(pts, zs)]
 
+    geom.coords = transformCoords(transform_func, [pt.x() for pt in pts], [pt.y() for pt in pts], zs)
+    geom.offsets = partOffsets([len(line) for line in lines])
     return geom
 
   #TODO: remove
@@ -186,78 +315,120 @@ class LineGeometry(Geometry):
     else:
       return None
 
-    line_geom = LineGeometry()
+    lines = []
     for geom in geoms:
       if hasattr(geom, "GetPoints"):
-        pts = geom.GetPoints()
+        lines.append(geom.GetPoints())
       else:
-        pts = [geom.GetPoint(i) for i in range(geom.GetPointCount())]
-
-      points = [transform_func(pt[0], pt[1], pt[2]) for pt in pts]
-      line_geom.lines.append(points)
+        lines.append([geom.GetPoint(i) for i in range(geom.GetPointCount())])
 
+    pts = [pt for line in lines for pt in line]
+    line_geom = LineGeometry()
+    if pts:
+      line_geom.coords = transformCoords(transform_func, *zip(*pts))
+    line_geom.offsets = partOffsets([len(line) for line in lines])
     return line_geom
 
 
 class PolygonGeometry(Geometry):
+  """Outer boundaries are clockwise and inner boundaries are counter-clockwise."""
 
   def __init__(self):
-    self.polygons = []
-    self.centroids = []
-    self.split_polygons = []
+    Geometry.__init__(self)
+    self.ringOffsets = numpy.zeros(1, dtype=numpy.int64)      # offsets of boundaries (rings) in coords
+    self.polygonOffsets = numpy.zeros(1, dtype=numpy.int64)   # offsets of polygons in rings
+    self.centroids = numpy.empty((0, 3))
+    self.split_triangles = None   # Triangles
+    self.split_polygons = None
 
-  def splitPolygon(self, triMesh):
-    """split polygon by TriangleMesh"""
-    self.split_polygons = []
-    for polygon in triMesh.splitPolygons(self.toQgsGeometry()):
-      boundaries = []
-      # outer boundary
-      points = [Point(pt.x(), pt.y(), 0) for pt in polygon[0]]
-      if not GeometryUtils.isClockwise(points):
-        points.reverse()    # to clockwise
-      boundaries.append(points)
-
-      # inner boundaries
-      for boundary in polygon[1:]:
-        points = [Point(pt.x(), pt.y(), 0) for pt in boundary]
-        if GeometryUtils.isClockwise(points):
-          points.reverse()    # to counter-clockwise
-        boundaries.append(points)
-
-      self.split_polygons.append(boundaries)
+  def polygonCount(self):
+    return len(self.polygonOffsets) - 1
+
+  def polygons(self):
+    """returns a list of polygons. each polygon is a list of coordinate arrays (views of coords) of boundaries"""
+    return splitByOffsets(splitByOffsets(self.coords, self.ringOffsets), self.polygonOffsets)
 
   def asList(self):
-    p = []
-    for boundaries in self.polygons:
-      # outer boundary
-      pts = [[pt.x, pt.y, pt.z] for pt in boundaries[0]]
-      if not GeometryUtils.isClockwise(boundaries[0]):
-        pts.reverse()   # to clockwise
-      b = [pts]
-
-      # inner boundaries
-      for boundary in boundaries[1:]:
-        pts = [[pt.x, pt.y, pt.z] for pt in boundary]
-        if GeometryUtils.isClockwise(boundary):
-          pts.reverse()   # to counter-clockwise
-        b.append(pts)
-      p.append(b)
-    return p
+    return self._nestedList(self.coords, [self.polygonOffsets, self.ringOffsets])
+
+  def asList2(self):
+    return self._nestedList(self.coords[:, :2], [self.polygonOffsets, self.ringOffsets])
+
+  def zMeans(self):
+    """returns mean z of vertices (excluding closing vertex of each boundary) for each polygon"""
+    if self.polygonCount() == 0:
+      return []
+    z = self.coords[:, 2]
+    starts = self.ringOffsets[:-1]
+    ringSums = numpy.add.reduceat(z, starts) - z[starts]
+    ringCounts = numpy.diff(self.ringOffsets) - 1
+    po = self.polygonOffsets[:-1]
+    return (numpy.add.reduceat(ringSums, po) / numpy.add.reduceat(ringCounts, po)).tolist()
+
+  def splitPolygon(self, triMesh):
+    """split polygon by TriangleMesh. triangles in the polygon are set to split_triangles (Triangles),
+    and the other pieces to split_polygons (list of polygons in 2d coordinates)"""
+    faces, polygons = triMesh.splitPolygons(self.toQgsGeometry())
+
+    # grid triangles inside the polygon
+    triangles = Triangles()
+    used, inverse = numpy.unique(faces, return_inverse=True)
+    triangles.addTriangles(triMesh.vertexCoords(used), inverse.reshape(-1, 3))
+
+    # pieces of boundary cells
+    polygons = [[[(pt.x(), pt.y(), 0) for pt in boundary] for boundary in polygon] for polygon in polygons]
+    counts = [[len(boundary) for boundary in polygon] for polygon in polygons]
+    coords = [pt for polygon in polygons for boundary in polygon for pt in boundary]
+
+    pieces = PolygonGeometry()
+    pieces.setPolygons(numpy.array(coords, dtype=numpy.float64).reshape(-1, 3), counts)
+    self.split_triangles, self.split_polygons = pieces.separateTriangles(triangles)
+
+  def separateTriangles(self, triangles=None):
+    """returns a Triangles object that has triangle polygons, and a list of the other polygons in 2d coordinates.
+    triangles: Triangles object to which triangles are added"""
+    if triangles is None:
+      triangles = Triangles()
+    polygons = []
+    for polygon, polygon2 in zip(self.polygons(), self.asList2()):
+      boundary = polygon[0]
+      if len(polygon) == 1 and len(boundary) == 4:
+        triangles.addTriangle(boundary[0], boundary[2], boundary[1])    # vertex order should be counter-clockwise
+      else:
+        polygons.append(polygon2)
+    return triangles, polygons
+
+  def setPolygons(self, coords, counts):
+    """coords: array of shape (vertex count, 3) of all polygons
+       counts: list of lists of vertex counts of boundaries, for each polygon"""
+    self.coords = coords
+    self.ringOffsets = partOffsets([c for polygon in counts for c in polygon])
+    self.polygonOffsets = partOffsets([len(polygon) for polygon in counts])
+
+    # make outer boundaries clockwise and inner boundaries counter-clockwise
+    ro = self.ringOffsets.tolist()
+    po = set(self.polygonOffsets.tolist())
+    for i, (s, e) in enumerate(zip(ro[:-1], ro[1:])):
+      isOuter = i in po
+      if GeometryUtils.isClockwise(coords[s:e]) != isOuter:
+        coords[s:e] = coords[s:e][::-1].copy()
 
   def toQgsGeometry(self):
-    count = len(self.polygons)
+    count = self.polygonCount()
     if count > 1:
-      polys = [polygonToQgsPolygon(poly) for poly in self.polygons]
+      polys = [polygonToQgsPolygon(poly) for poly in self.polygons()]
       return QgsGeometry.fromMultiPolygon(polys)
 
     if count == 1:
-      return QgsGeometry.fromPolygon(polygonToQgsPolygon(self.polygons[0]))
+      return QgsGeometry.fromPolygon(polygonToQgsPolygon(self.polygons()[0]))
 
     return QgsGeometry()
 
   #TODO: z/m support
   @classmethod
   def fromQgsGeometry(cls, geometry, z_func, transform_func, calcCentroid=False):
+    """z_func: function to get elevations at given points (xs, ys) on surface
+       transform_func: function to transform arrays of map coordinates (xs, ys, zs) to an array of 3d coordinates"""
 
     useCentroidHeight = True
     centroidPerPolygon = True
@@ -266,43 +437,33 @@ class PolygonGeometry(Geometry):
     geom = cls()
     if calcCentroid and not centroidPerPolygon:
       pt = geometry.centroid().asPoint()
-      centroidHeight = z_func(pt.x(), pt.y())
-      geom.centroids.append(transform_func(pt.x(), pt.y(), centroidHeight))
+      centroidHeight = zValues(z_func, [pt])[0]
+      geom.centroids = transformCoords(transform_func, [pt.x()], [pt.y()], [centroidHeight])
 
-    for polygon in polygons:
-      if useCentroidHeight or calcCentroid:
+    if useCentroidHeight or calcCentroid:
+      centroids = []
+      for polygon in polygons:
         centroid = QgsGeometry.fromPolygon(polygon).centroid()
-        if centroid is None:
-          continue
-        pt = centroid.asPoint()
-        centroidHeight = z_func(pt.x(), pt.y())
-        if calcCentroid and centroidPerPolygon:
-          geom.centroids.append(transform_func(pt.x(), pt.y(), centroidHeight))
-
-      if useCentroidHeight:
-        z_func = lambda x, y: centroidHeight
-
-      boundaries = []
-      # outer boundary
-      points = []
-      for pt in polygon[0]:
-        points.append(transform_func(pt.x(), pt.y(), z_func(pt.x(), pt.y())))
-
-      if not GeometryUtils.isClockwise(points):
-        points.reverse()    # to clockwise
-      boundaries.append(points)
-
-      # inner boundaries
-      for boundary in polygon[1:]:
-        points = [transform_func(pt.x(), pt.y(), z_func(pt.x(), pt.y())) for pt in boundary]
-        if GeometryUtils.isClockwise(points):
-          points.reverse()    # to counter-clockwise
-        boundaries.append(points)
-
-      geom.polygons.append(boundaries)
+        centroids.append(None if centroid is None else centroid.asPoint())
 
-    return geom
+      polygons = [polygon for polygon, pt in zip(polygons, centroids) if pt is not None]
+      centroids = [pt for pt in centroids if pt is not None]
+
+      # elevations at the centroids of all polygons
+      centroidHeights = zValues(z_func, centroids)
+      if calcCentroid and centroidPerPolygon:
+        geom.centroids = transformCoords(transform_func, [pt.x() for pt in centroids], [pt.y() for pt in centroids], centroidHeights)
 
+    pts = [pt for polygon in polygons for boundary in polygon for pt in boundary]
+    if useCentroidHeight:
+      zs = [z for polygon, z in zip(polygons, centroidHeights) for boundary in polygon for pt in boundary]
+    else:
+      # elevations at the vertices of all polygons
+      zs = zValues(z_func, pts)
+
+    coords = transformCoords(transform_func, [pt.x() for pt in pts], [pt.y() for pt in pts], zs)
+    geom.setPolygons(coords, [[len(boundary) for boundary in polygon] for polygon in polygons])
+    return geom
 
   #TODO: remove
 #  @staticmethod
@@ -319,7 +480,11 @@ class GeometryUtils:
 
   @staticmethod
   def _signedArea(p):
-    """Calculates signed area of polygon."""
+    """Calculates signed area of polygon. p: list of Points or array of coordinates"""
+    if isinstance(p, numpy.ndarray):
+      x, y = p[:, 0], p[:, 1]
+      return float(((x[:-1] - x[1:]) * (y[:-1] + y[1:])).sum()) / 2
+
     area = 0
     for i in range(len(p) - 1):
       area += (p[i].x - p[i + 1].x) * (p[i].y + p[i + 1].y)
@@ -338,110 +503,265 @@ class TriangleMesh:
   # 1 - 2
 
   def __init__(self, xmin, ymin, xmax, ymax, x_segments, y_segments):
-    self.vbands = []
-    self.hbands = []
-    self.vidx = QgsSpatialIndex()
-    self.hidx = QgsSpatialIndex()
+    self.xmin, self.ymin, self.xmax, self.ymax = xmin, ymin, xmax, ymax
+    self.x_segments, self.y_segments = x_segments, y_segments
 
     xres = (xmax - xmin) / x_segments
     yres = (ymax - ymin) / y_segments
-    self.xmin, self.ymax, self.xres, self.yres = xmin, ymax, xres, yres
-
-    def addVBand(idx, geom):
-      f = QgsFeature(idx)
-      f.setGeometry(geom)
-      self.vbands.append(f)
-      self.vidx.insertFeature(f)
+    self.xres, self.yres = xres, yres
 
-    def addHBand(idx, geom):
-      f = QgsFeature(idx)
-      f.setGeometry(geom)
-      self.hbands.append(f)
-      self.hidx.insertFeature(f)
+    # bands form a regular grid, so band geometries are created at once and looked up by index
+    self.vbands = [QgsGeometry.fromRect(QgsRectangle(xmin + x * xres, ymin, xmin + (x + 1) * xres, ymax)) for x in range(x_segments)]
+    self.hbands = [QgsGeometry.fromRect(QgsRectangle(xmin, ymax - (y + 1) * yres, xmax, ymax - y * yres)) for y in range(y_segments)]
 
-    for x in range(x_segments):
-      addVBand(x, QgsGeometry.fromRect(QgsRectangle(xmin + x * xres, ymin, xmin + (x + 1) * xres, ymax)))
+  def _columnRange(self, rect):
+    """range of indices of vertical bands that intersect with rect (QgsRectangle)"""
+    x0 = max(0, int(math.floor((rect.xMinimum() - self.xmin) / self.xres)))
+    x1 = min(self.x_segments - 1, int(math.floor((rect.xMaximum() - self.xmin) / self.xres)))
+    return range(x0, x1 + 1)
 
-    for y in range(y_segments):
-      addHBand(y, QgsGeometry.fromRect(QgsRectangle(xmin, ymax - (y + 1) * yres, xmax, ymax - y * yres)))
+  def _rowRange(self, rect):
+    """range of indices of horizontal bands that intersect with rect (QgsRectangle)"""
+    y0 = max(0, int(math.floor((self.ymax - rect.yMaximum()) / self.yres)))
+    y1 = min(self.y_segments - 1, int(math.floor((self.ymax - rect.yMinimum()) / self.yres)))
+    return range(y0, y1 + 1)
 
   def vSplit(self, geom):
     """split polygon vertically"""
-    for idx in self.vidx.intersects(geom.boundingBox()):
-      yield idx, geom.intersection(self.vbands[idx].geometry())
+    for idx in self._columnRange(geom.boundingBox()):
+      yield idx, geom.intersection(self.vbands[idx])
 
   def hIntersects(self, geom):
     """indices of horizontal bands that intersect with geom"""
-    for idx in self.hidx.intersects(geom.boundingBox()):
-      if geom.intersects(self.hbands[idx].geometry()):
+    for idx in self._rowRange(geom.boundingBox()):
+      if geom.intersects(self.hbands[idx]):
         yield idx
 
-  def splitPolygons(self, geom):
+  OUTSIDE = 0
+  INSIDE = 1
+  BOUNDARY = 2
+
+  def vertexCoords(self, indices):
+    """returns an array of shape (n, 2) of coordinates of grid vertices.
+    index of vertex at (col, row) is row * (x_segments + 1) + col"""
+    rows, cols = numpy.divmod(numpy.asarray(indices), self.x_segments + 1)
+    return numpy.column_stack((self.xmin + cols * self.xres, self.ymax - rows * self.yres))
+
+  def classifyCells(self, geom):
+    """classifies grid cells by their relation to the polygon (QgsGeometry) without GEOS.
+    returns an array of shape (y_segments, x_segments) of OUTSIDE, INSIDE or BOUNDARY.
+    cells marked as BOUNDARY may include some cells that the boundary passes close by."""
+    cells = numpy.zeros((self.y_segments, self.x_segments), dtype=numpy.int8)
+
+    polygons = geom.asMultiPolygon() if geom.isMultipart() else [geom.asPolygon()]
+    rings = [numpy.array([(pt.x(), pt.y()) for pt in ring]) for polygon in polygons for ring in polygon if len(ring) > 1]
+    if not rings:
+      return cells
+
+    # edges of all rings
+    p0 = numpy.concatenate([ring[:-1] for ring in rings])
+    p1 = numpy.concatenate([ring[1:] for ring in rings])
+
+    # inside/outside: even-odd rule at cell centers, row by row (scan-lines)
     xmin, ymax, xres, yres = self.xmin, self.ymax, self.xres, self.yres
+    cxs = xmin + (numpy.arange(self.x_segments) + 0.5) * xres
+    for row in range(self.y_segments):
+      yc = ymax - (row + 0.5) * yres
+      crossing = (p0[:, 1] <= yc) != (p1[:, 1] <= yc)
+      if not crossing.any():
+        continue
+      a, b = p0[crossing], p1[crossing]
+      xs = numpy.sort(a[:, 0] + (yc - a[:, 1]) * (b[:, 0] - a[:, 0]) / (b[:, 1] - a[:, 1]))
+      cells[row, numpy.searchsorted(xs, cxs) % 2 == 1] = self.INSIDE
+
+    # boundary: divide edges into pieces shorter than half a cell, and mark cells that bound box of each piece overlaps
+    step = 0.5 * min(xres, yres)
+    counts = numpy.maximum(1, numpy.ceil(numpy.hypot(*(p1 - p0).T) / step).astype(numpy.int64))
+    edge = numpy.repeat(numpy.arange(len(p0)), counts)
+    t0 = (numpy.arange(len(edge)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)) / numpy.repeat(counts, counts)
+    t1 = t0 + 1 / numpy.repeat(counts, counts)
+    a = p0[edge] + (p1[edge] - p0[edge]) * t0[:, numpy.newaxis]
+    b = p0[edge] + (p1[edge] - p0[edge]) * t1[:, numpy.newaxis]
+
+    eps = 1e-9 * min(xres, yres)
+    c0 = numpy.floor((numpy.minimum(a[:, 0], b[:, 0]) - eps - xmin) / xres).astype(numpy.int64)
+    c1 = numpy.floor((numpy.maximum(a[:, 0], b[:, 0]) + eps - xmin) / xres).astype(numpy.int64)
+    r0 = numpy.floor((ymax - numpy.maximum(a[:, 1], b[:, 1]) - eps) / yres).astype(numpy.int64)
+    r1 = numpy.floor((ymax - numpy.minimum(a[:, 1], b[:, 1]) + eps) / yres).astype(numpy.int64)
+    for cols, rows in [(c0, r0), (c0, r1), (c1, r0), (c1, r1)]:
+      valid = (cols >= 0) & (cols < self.x_segments) & (rows >= 0) & (rows < self.y_segments)
+      cells[rows[valid], cols[valid]] = self.BOUNDARY
+
+    return cells
+
+  def cellTriangles(self, rows, cols):
+    """returns an array of shape (2 * n, 3) of vertex indices of triangles in the cells.
+    vertex order is counter-clockwise."""
+    w = self.x_segments + 1
+    v0 = rows * w + cols      # 0 - 3
+    v1 = v0 + w               # | / |
+    v2 = v1 + 1               # 1 - 2
+    v3 = v0 + 1
+    return numpy.concatenate((numpy.column_stack((v0, v1, v3)), numpy.column_stack((v3, v1, v2))))
+
+  def splitPolygons(self, geom):
+    """splits polygon (QgsGeometry) by the grid cells and their diagonals.
+    returns a tuple (faces, polygons). faces is an array of vertex indices (see vertexCoords) of grid triangles
+    inside the polygon, and polygons is a list of polygons (lists of rings of QgsPointXY) clipped by boundary cells.
+    only boundary cells are processed with GEOS."""
+    cells = self.classifyCells(geom)
+
+    rows, cols = numpy.nonzero(cells == self.INSIDE)
+    faces = [self.cellTriangles(rows, cols)]
 
-    for x, vi in self.vSplit(geom):
-      for y in self.hIntersects(vi):
-        pt0 = QgsPointXY(xmin + x * xres, ymax - y * yres)
-        pt1 = QgsPointXY(xmin + x * xres, ymax - (y + 1) * yres)
-        pt2 = QgsPointXY(xmin + (x + 1) * xres, ymax - (y + 1) * yres)
-        pt3 = QgsPointXY(xmin + (x + 1) * xres, ymax - y * yres)
-        quad = QgsGeometry.fromPolygon([[pt0, pt1, pt2, pt3, pt0]])
-        tris = [[[pt0, pt1, pt3, pt0]], [[pt3, pt1, pt2, pt3]]]
-
-        if geom.contains(quad):
-          yield tris[0]
-          yield tris[1]
-        else:
-          for i, tri in enumerate(map(QgsGeometry.fromPolygon, tris)):
-            if geom.contains(tri):
-              yield tris[i]
-            elif geom.intersects(tri):
-              poly = geom.intersection(tri)
-              if poly.isMultipart():
-                for sp in poly.asMultiPolygon():
-                  yield sp
-              else:
-                yield poly.asPolygon()
+    xmin, ymax, xres, yres = self.xmin, self.ymax, self.xres, self.yres
+    polygons = []
+    for y, x in zip(*numpy.nonzero(cells == self.BOUNDARY)):
+      pt0 = QgsPointXY(xmin + x * xres, ymax - y * yres)
+      pt1 = QgsPointXY(xmin + x * xres, ymax - (y + 1) * yres)
+      pt2 = QgsPointXY(xmin + (x + 1) * xres, ymax - (y + 1) * yres)
+      pt3 = QgsPointXY(xmin + (x + 1) * xres, ymax - y * yres)
+      quad = QgsGeometry.fromPolygon([[pt0, pt1, pt2, pt3, pt0]])
+
+      if geom.contains(quad):
+        faces.append(self.cellTriangles(numpy.array([y]), numpy.array([x])))
+        continue
+
+      if not geom.intersects(quad):
+        continue
+
+      tris = self.cellTriangles(numpy.array([y]), numpy.array([x]))
+      for i, tri in enumerate([[[pt0, pt1, pt3, pt0]], [[pt3, pt1, pt2, pt3]]]):
+        tri_geom = QgsGeometry.fromPolygon(tri)
+        if geom.contains(tri_geom):
+          faces.append(tris[i:i + 1])
+        elif geom.intersects(tri_geom):
+          poly = geom.intersection(tri_geom)
+          if poly.isMultipart():
+            polygons.extend(poly.asMultiPolygon())
+          else:
+            polygon = poly.asPolygon()
+            if polygon:
+              polygons.append(polygon)
+
+    return numpy.concatenate(faces), polygons
+
+
+_triangleMeshCache = OrderedDict()
+_triangleMeshCacheLock = threading.Lock()
+TRIANGLE_MESH_CACHE_SIZE = 8
+
+
+def sharedTriangleMesh(xmin, ymin, xmax, ymax, x_segments, y_segments):
+  """returns a TriangleMesh shared in the process. recently used meshes are kept in an LRU cache."""
+  key = (xmin, ymin, xmax, ymax, x_segments, y_segments)
+  with _triangleMeshCacheLock:
+    mesh = _triangleMeshCache.get(key)
+    if mesh is not None:
+      _triangleMeshCache.move_to_end(key)
+      return mesh
+
+  mesh = TriangleMesh(*key)
+  with _triangleMeshCacheLock:
+    _triangleMeshCache[key] = mesh
+    while len(_triangleMeshCache) > TRIANGLE_MESH_CACHE_SIZE:
+      _triangleMeshCache.popitem(last=False)
+  return mesh
 
 
 class Triangles:
 
   def __init__(self):
-    self.vertices = []
+    self.vertices = []    # list of [x, y]
     self.faces = []
     self.vdict = {}   # dict to find whether a vertex already exists: [y][x] = vertex index
 
+  def addTriangles(self, vertices, faces):
+    """vertices: array of shape (n, 2 or 3), faces: array of shape (m, 3) of indices into vertices"""
+    index = numpy.array([self._vertexIndex(v) for v in vertices.tolist()], dtype=numpy.int64)
+    if len(faces):
+      self.faces.extend(index[faces].tolist())
+
   def addTriangle(self, v1, v2, v3):
+    """v1, v2, v3: sequences of coordinates (x, y[, z])"""
     vi1 = self._vertexIndex(v1)
     vi2 = self._vertexIndex(v2)
     vi3 = self._vertexIndex(v3)
     self.faces.append([vi1, vi2, vi3])
 
   def _vertexIndex(self, v):
-    x_dict = self.vdict.get(v.y)
+    x, y = float(v[0]), float(v[1])
+    x_dict = self.vdict.get(y)
     if x_dict:
-      vi = x_dict.get(v.x)
+      vi = x_dict.get(x)
       if vi is not None:
         return vi
     vi = len(self.vertices)
-    self.vertices.append(v)
+    self.vertices.append([x, y])
     if x_dict:
-      x_dict[v.x] = vi
+      x_dict[x] = vi
     else:
-      self.vdict[v.y] = {v.x: vi}
+      self.vdict[y] = {x: vi}
     return vi
 
 #TODO: parameters - extent, layer, projectCrs
 
 
-def dissolvePolygonsOnCanvas(settings, layer):
-  """dissolve polygons of the layer and clip the dissolution with base extent"""
+DISSOLVE_BATCH_SIZE = 256
+DISSOLVE_CACHE_SIZE = 8
+
+_dissolveCache = OrderedDict()
+_dissolveCacheLock = threading.Lock()
+
+
+def cascadedUnion(geoms, batchSize=DISSOLVE_BATCH_SIZE, workers=1):
+  """union geometries in batches of batchSize geometries, and then union the results recursively.
+  geoms should be in spatially coherent order so that each batch covers a compact area.
+  workers: number of threads to union batches concurrently"""
+  executor = ThreadPoolExecutor(workers) if workers > 1 and len(geoms) > batchSize else None
+  try:
+    while len(geoms) > 1:
+      batches = [geoms[i:i + batchSize] for i in range(0, len(geoms), batchSize)]
+      if executor and len(batches) > 1:
+        geoms = list(executor.map(QgsGeometry.unaryUnion, batches))
+      else:
+        geoms = [QgsGeometry.unaryUnion(batch) for batch in batches]
+  finally:
+    if executor:
+      executor.shutdown()
+  return geoms[0] if geoms else None
+
+
+def dissolvePolygonsOnCanvas(settings, layer, workers=1):
+  """dissolve polygons of the layer and clip the dissolution with base extent.
+  Results are cached per layer, layer revision, base extent and crs."""
+  baseExtent = settings.baseExtent
+  key = (layer.id(), layerRevision(layer, dataOnly=True), layer.subsetString(), baseExtent.clone(), settings.crs.toWkt())    # rect is copied not to be modified while it is a key
+  with _dissolveCacheLock:
+    if key in _dissolveCache:
+      _dissolveCache.move_to_end(key)
+      geom = _dissolveCache[key]
+      return QgsGeometry(geom) if geom else None
+
+  geom = _dissolvePolygons(settings, layer, workers)
+  with _dissolveCacheLock:
+    # dissolutions of older revisions of the layer are never used again
+    for k in [k for k in _dissolveCache if k[0] == key[0] and k[1] < key[1]]:
+      del _dissolveCache[k]
+    _dissolveCache[key] = geom
+    while len(_dissolveCache) > DISSOLVE_CACHE_SIZE:
+      _dissolveCache.popitem(last=False)
+  return QgsGeometry(geom) if geom else None
+
+
+def _dissolvePolygons(settings, layer, workers):
   baseExtent = settings.baseExtent
   baseExtentGeom = baseExtent.geometry()
   rotation = baseExtent.rotation()
   transform = QgsCoordinateTransform(layer.crs(), settings.crs)
 
-  combi = None
+  geoms = []
+  centers = []
   request = QgsFeatureRequest()
   request.setFilterRect(transform.transformBoundingBox(baseExtent.boundingBox(), QgsCoordinateTransform.ReverseTransform))
   for f in layer.getFeatures(request):
@@ -460,10 +780,17 @@ def dissolvePolygonsOnCanvas(settings, layer):
     if rotation and not baseExtentGeom.intersects(geom):
       continue
 
-    if combi:
-      combi = combi.combine(geom)
-    else:
-      combi = geom
+    geoms.append(geom)
+    c = geom.boundingBox().center()
+    centers.append((c.x(), c.y()))
+
+  if not geoms:
+    return None
+
+  # sort geometries along Hilbert curve so that each batch covers a compact area
+  pts = numpy.array(centers)
+  geoms = [geoms[i] for i in hilbertOrder(pts[:, 0], pts[:, 1], baseExtent.boundingBox())]
+  combi = cascadedUnion(geoms, workers=workers)
 
   # clip geom with slightly smaller extent than base extent
   # to make sure that the clipped polygon stays within the base extent
@@ -14,6 +14,8 @@ Q3D.Options = {
     }
   },
   side: {color: 0xc7ac92, bottomZ: -1.5},
+  dem: {lodFactor: 2,      // a pyramid tile is replaced with finer tiles when camera is closer than lodFactor * tile width
+        tileLifetime: 10000},  // finer tiles are disposed of when they have not been needed for tileLifetime milliseconds
   frame: {color: 0, bottomZ: -1.5},
   label: {visible: true, connectorColor: 0xc0c0d0, autoSize: false, minFontSize: 10},
   qmarker: {r: 0.25, c: 0xffff00, o: 0.8},
@@ -220,6 +222,13 @@ Q3D.Scene.prototype.requestRender = function () {
   this.dispatchEvent({type: "renderRequest"});
 };
 
+// update level of detail of layers that stream tiles
+Q3D.Scene.prototype.updateTiles = function (camera) {
+  for (var id in this.mapLayers) {
+    if (this.mapLayers[id].updateTiles !== undefined) this.mapLayers[id].updateTiles(camera);
+  }
+};
+
 Q3D.Scene.prototype.queryableObjects = function () {
   var objs = [];
   for (var id in this.mapLayers) {
@@ -439,6 +448,17 @@ limitations:
     */
   };
 
+  app.loadBinaryBlockFromURL = function (url) {
+
+    var xhr = new XMLHttpRequest();
+    xhr.open("GET", url, true);
+    xhr.responseType = "arraybuffer";
+    xhr.onload = function () {
+      if (this.response) app.loadJSONObject(Q3D.Utils.decodeBinaryBlock(this.response));
+    };
+    xhr.send(null);
+  };
+
   app.addEventListeners = function () {
     window.addEventListener("keydown", app.eventListener.keydown);
     window.addEventListener("resize", app.eventListener.resize);
@@ -605,6 +625,7 @@ limitations:
 
   app.render = function (updateControls) {
     if (updateControls && app.controls.update()) return;    // changeEvent handler calls app.render()
+    app.scene.updateTiles(app.camera);
     app.renderer.render(app.scene, app.camera);
     app.updateLabelPosition();
   };
@@ -1313,6 +1334,16 @@ Q3D.Materials.prototype.loadJSONObject = function (jsonObject) {
   //this.opacity = sum_opacity / this.materials.length;
 };
 
+Q3D.Materials.prototype.remove = function (material) {
+  for (var i = 0, l = this.materials.length; i < l; i++) {
+    if (this.materials[i] === material) {
+      this.materials.splice(i, 1);
+      material.dispose();
+      return;
+    }
+  }
+};
+
 Q3D.Materials.prototype.dispose = function () {
   for (var i = 0, l = this.materials.length; i < l; i++) {
     this.materials[i].dispose();
@@ -1389,6 +1420,11 @@ Q3D.DEMBlock.prototype = {
         geom.computeVertexNormals();
       }
 
+      // skirts of a pyramid tile
+      if (obj.tile !== undefined && !Q3D.Options.exportMode) {
+        _this.buildSkirts(grid, obj.width, obj.tile, mesh);
+      }
+
       // build sides, bottom and frame
       if (obj.sides) {
         _this.buildSides(layer, grid, obj.width, obj.height, mesh, Q3D.Options.side.bottomZ);
@@ -1516,6 +1552,81 @@ Q3D.DEMBlock.prototype = {
     parent.updateMatrixWorld();
   },
 
+  // build skirts that hang down from the edges of a pyramid tile. they fill cracks between the tile and
+  // its neighbors of different levels, whose edge vertices are not shared with the tile.
+  // there are no skirts on the boundary of the pyramid.
+  buildSkirts: function (grid, planeWidth, tile, parent) {
+    var w = grid.width, h = grid.height, grid_values = grid.array,
+        attrs = parent.geometry.attributes, n = Math.pow(2, tile[0]), i, j, k;
+
+    // strips of edge vertex indices in counter-clockwise order (seen from above)
+    var strips = [], strip;
+    if (tile[2] < n - 1) {    // bottom
+      for (i = 0, strip = []; i < w; i++) strip.push(w * (h - 1) + i);
+      strips.push(strip);
+    }
+    if (tile[1] < n - 1) {    // right
+      for (i = h - 1, strip = []; i >= 0; i--) strip.push(w * i + w - 1);
+      strips.push(strip);
+    }
+    if (tile[2] > 0) {        // top
+      for (i = w - 1, strip = []; i >= 0; i--) strip.push(i);
+      strips.push(strip);
+    }
+    if (tile[1] > 0) {        // left
+      for (i = 0, strip = []; i < h; i++) strip.push(w * i);
+      strips.push(strip);
+    }
+    if (strips.length == 0) return;
+
+    // a crack is not deeper than the height difference between two neighboring edge vertices of the coarser tile
+    var maxStep = 0, vcount = 0;
+    strips.forEach(function (strip) {
+      for (var i = 1; i < strip.length; i++) {
+        maxStep = Math.max(maxStep, Math.abs(grid_values[strip[i]] - grid_values[strip[i - 1]]));
+      }
+      vcount += strip.length;
+    });
+    var depth = planeWidth / (w - 1) + 2 * maxStep;
+
+    // each edge vertex makes a pair of top and bottom vertices
+    var positions = new Float32Array(vcount * 6),
+        normals = new Float32Array(vcount * 6),
+        uvs = new Float32Array(vcount * 4),
+        indices = new Uint16Array((vcount - strips.length) * 6),
+        v = 0, f = 0;
+
+    strips.forEach(function (strip) {
+      for (var i = 0; i < strip.length; i++, v++) {
+        k = strip[i];
+        for (j = 0; j < 3; j++) {
+          positions[v * 6 + j] = positions[v * 6 + 3 + j] = attrs.position.array[k * 3 + j];
+          normals[v * 6 + j] = normals[v * 6 + 3 + j] = attrs.normal.array[k * 3 + j];
+        }
+        positions[v * 6 + 5] -= depth;
+
+        uvs[v * 4] = uvs[v * 4 + 2] = attrs.uv.array[k * 2];
+        uvs[v * 4 + 1] = uvs[v * 4 + 3] = attrs.uv.array[k * 2 + 1];
+
+        if (i > 0) {
+          j = (v - 1) * 2;
+          indices.set([j, j + 1, j + 2, j + 2, j + 1, j + 3], f);
+          f += 6;
+        }
+      }
+    });
+
+    var geom = new THREE.BufferGeometry();
+    geom.setIndex(new THREE.BufferAttribute(indices, 1));
+    geom.addAttribute("position", new THREE.BufferAttribute(positions, 3));
+    geom.addAttribute("normal", new THREE.BufferAttribute(normals, 3));
+    geom.addAttribute("uv", new THREE.BufferAttribute(uvs, 2));
+
+    var mesh = new THREE.Mesh(geom, this.material.mat);
+    mesh.name = "skirt";
+    parent.add(mesh);
+  },
+
   buildFrame: function (layer, grid, planeWidth, planeHeight, parent, z0) {
     var matProp = data.material.origProp,
         opacity = (matProp.o !== undefined) ? matProp.o : 1;
@@ -1694,6 +1805,17 @@ Q3D.MapLayer.prototype.queryableObjects = function () {
   return (this.visible) ? this.queryObjs : [];
 };
 
+Q3D.MapLayer.prototype.removeObject = function (object) {
+  var queryObjs = this.queryObjs;
+  object.traverse(function (obj) {
+    if (obj.geometry) obj.geometry.dispose();
+
+    var index = queryObjs.indexOf(obj);
+    if (index != -1) queryObjs.splice(index, 1);
+  });
+  this.objectGroup.remove(object);
+};
+
 Q3D.MapLayer.prototype.removeAllObjects = function () {
   // dispose of geometries
   this.objectGroup.traverse(function (obj) {
@@ -1764,7 +1886,8 @@ Q3D.DEMLayer.prototype.constructor = Q3D.DEMLayer;
 Q3D.DEMLayer.prototype.loadJSONObject = function (jsonObject, scene) {
   if (jsonObject.type == "layer") {
     Q3D.MapLayer.prototype.loadJSONObject.call(this, jsonObject, scene);
-    if (jsonObject.data !== undefined) this.build(jsonObject.data);
+    if (this.properties.pyramid !== undefined) this.loadPyramid(this.properties.pyramid);
+    else if (jsonObject.data !== undefined) this.build(jsonObject.data);
   }
   else if (jsonObject.type == "block") {
     var index = jsonObject.block;
@@ -1788,6 +1911,106 @@ Q3D.DEMLayer.prototype.build = function (blocks) {
   });
 };
 
+// load manifest of tile pyramid, and then load the top level tile.
+// finer tiles are loaded in updateTiles() depending on camera distance.
+Q3D.DEMLayer.prototype.loadPyramid = function (url) {
+  var _this = this;
+  var xhr = new XMLHttpRequest();
+  xhr.open("GET", url, true);
+  xhr.responseType = "json";
+  xhr.onload = function () {
+    if (!this.response) return;
+    _this.pyramid = this.response;
+    _this.tiles = {};     // key: "z/x/y"
+    _this.loadTile(0, 0, 0);
+  };
+  xhr.send(null);
+};
+
+Q3D.DEMLayer.prototype.loadTile = function (z, x, y) {
+  var key = z + "/" + x + "/" + y;
+  if (this.tiles[key] !== undefined) return this.tiles[key];
+
+  var obj = this.pyramid.tiles[key];
+  if (obj === undefined) return null;
+
+  var _this = this,
+      tile = {z: z, x: x, y: y, block: new Q3D.DEMBlock(), loaded: false, children: null, refined: 0};
+  this.tiles[key] = tile;
+
+  var mesh = tile.block.loadJSONObject(obj, this, function (blk) {
+    if (obj.grid.array !== undefined) tile.loaded = true;
+    _this.requestRender();
+  });
+  mesh.visible = (z == 0);   // visibility of finer tiles is set in updateTiles()
+  this.addObject(mesh);
+  if (z == 0) this.blocks.push(tile.block);
+  return tile;
+};
+
+Q3D.DEMLayer.prototype.updateTiles = function (camera) {
+  if (this.pyramid === undefined || !this.visible) return;
+  var root = this.tiles["0/0/0"];
+  if (root) this._updateTile(root, camera.position, Date.now());
+};
+
+Q3D.DEMLayer.prototype._updateTile = function (tile, cameraPosition, time) {
+  var mesh = tile.block.obj,
+      center = new THREE.Vector3().setFromMatrixPosition(mesh.matrixWorld);
+
+  if (tile.z < this.pyramid.levels && center.distanceTo(cameraPosition) < tile.block.data.width * Q3D.Options.dem.lodFactor) {
+    tile.refined = time;
+    if (tile.children === null) {
+      var z = tile.z + 1, x = tile.x * 2, y = tile.y * 2;
+      tile.children = [this.loadTile(z, x, y), this.loadTile(z, x + 1, y),
+                       this.loadTile(z, x, y + 1), this.loadTile(z, x + 1, y + 1)];
+    }
+
+    // replace the tile with finer tiles after all of them have been loaded
+    var ready = tile.children.every(function (child) { return child && child.loaded; });
+    if (ready) {
+      mesh.visible = false;
+      for (var i = 0; i < 4; i++) {
+        this._updateTile(tile.children[i], cameraPosition, time);
+      }
+      return;
+    }
+  }
+  else if (tile.children !== null && time - tile.refined > Q3D.Options.dem.tileLifetime) {
+    // finer tiles have not been needed for a while
+    this._disposeTiles(tile.children);
+    tile.children = null;
+  }
+
+  mesh.visible = true;
+  this._hideTiles(tile.children);
+};
+
+Q3D.DEMLayer.prototype._hideTiles = function (tiles) {
+  if (!tiles) return;
+  for (var i = 0; i < tiles.length; i++) {
+    if (!tiles[i]) continue;
+    tiles[i].block.obj.visible = false;
+    this._hideTiles(tiles[i].children);
+  }
+};
+
+Q3D.DEMLayer.prototype._disposeTiles = function (tiles) {
+  for (var i = 0; i < tiles.length; i++) {
+    var tile = tiles[i];
+    if (!tile) continue;
+    if (tile.children) this._disposeTiles(tile.children);
+
+    this.removeObject(tile.block.obj);
+    this.materials.remove(tile.block.material);
+
+    // grid values are kept in the manifest, so release them too. the tile is loaded again when needed.
+    var key = tile.z + "/" + tile.x + "/" + tile.y;
+    delete this.pyramid.tiles[key].grid.array;
+    delete this.tiles[key];
+  }
+};
+
 // TODO: block.plane, .getValue
 // calculate elevation at the coordinates (x, y) on triangle face
 Q3D.DEMLayer.prototype.getZ = function (x, y) {
@@ -1838,9 +2061,9 @@ Q3D.DEMLayer.prototype.segmentizeLineString = function (lineString, zFunc) {
   var ix = width / x_segments,
       iy = height / y_segments;
 
-  var pts = [];
-  for (var i = 1, l = lineString.length; i < l; i++) {
-    var pt1 = lineString[i - 1], pt2 = lineString[i];
+  var pts = [], count = Q3D.Utils.pointCount(lineString);
+  for (var i = 1; i < count; i++) {
+    var pt1 = Q3D.Utils.getPoint(lineString, i - 1), pt2 = Q3D.Utils.getPoint(lineString, i);
     var x1 = pt1[0], x2 = pt2[0], y1 = pt1[1], y2 = pt2[1], z1 = pt1[2], z2 = pt2[2];
     var nx1 = (x1 - xmin) / ix,
         nx2 = (x2 - xmin) / ix;
@@ -1881,7 +2104,7 @@ Q3D.DEMLayer.prototype.segmentizeLineString = function (lineString, zFunc) {
     }
   }
   // last point (= the first point)
-  var pt = lineString[lineString.length - 1];
+  var pt = Q3D.Utils.getPoint(lineString, count - 1);
   pts.push(new THREE.Vector3(pt[0], pt[1], (pt[2] === undefined) ? zFunc(pt[0], pt[1]) : pt[2]));
 
   /*
@@ -1964,8 +2187,8 @@ Q3D.VectorLayer.prototype.buildLabels = function (features, getPointsFunc, zFunc
     if (text === null || text === "") continue;
 
     var pts = getPointsFunc(f);
-    for (var j = 0, m = pts.length; j < m; j++) {
-      var pt = pts[j];
+    for (var j = 0, m = Q3D.Utils.pointCount(pts); j < m; j++) {
+      var pt = Q3D.Utils.getPoint(pts, j);
       // create div element for label
       var e = document.createElement("div");
       e.appendChild(document.createTextNode(text));
@@ -2011,7 +2234,10 @@ Q3D.VectorLayer.prototype.loadJSONObject = function (jsonObject, scene) {
       }
 
       (jsonObject.data.blocks || []).forEach(function (block) {
-        if (block.url !== undefined) app.loadJSONFromURL(block.url);
+        if (block.url !== undefined) {
+          if (block.format == "binary") app.loadBinaryBlockFromURL(block.url);
+          else app.loadJSONFromURL(block.url);
+        }
         else {
           this.build(block.features);
           if (this.properties.label !== undefined) this.buildLabels(block.features);
@@ -2020,6 +2246,9 @@ Q3D.VectorLayer.prototype.loadJSONObject = function (jsonObject, scene) {
     }
   }
   else if (jsonObject.type == "block") {
+    // materials added while the features of this block were exported
+    if (jsonObject.materials !== undefined) this.materials.loadJSONObject(jsonObject.materials);
+
     this.build(jsonObject.features);
     if (this.properties.label !== undefined) this.buildLabels(jsonObject.features);
   }
@@ -2081,12 +2310,12 @@ Q3D.PointLayer.prototype.build = function (features) {
     f = features[fidx];
     geom = f.geom;
     z_addend = (geom.h) ? geom.h / 2 : 0;
-    for (i = 0, l = geom.pts.length; i < l; i++) {
+    for (i = 0, l = Q3D.Utils.pointCount(geom.pts); i < l; i++) {
       geometry = createGeometry(geom);
       if (geometry === null) continue;
       mesh = new THREE.Mesh(geometry, materials.mat(f.mat));
 
-      pt = geom.pts[i];
+      pt = Q3D.Utils.getPoint(geom.pts, i, pt);
       mesh.position.set(pt[0], pt[1], pt[2] + z_addend);
       if (geom.rotateX) mesh.rotation.x = geom.rotateX * deg2rad;
       if (scaleZ != 1) mesh.scale.z = scaleZ;
@@ -2111,8 +2340,8 @@ Q3D.PointLayer.prototype.buildIcons = function (features) {
     var sx = image.width / 64 * scale,
         sy = image.height / 64 * scale;
 
-    for (var i = 0, l = geom.pts.length; i < l; i++) {
-      var pt = geom.pts[i];
+    for (var i = 0, l = Q3D.Utils.pointCount(geom.pts); i < l; i++) {
+      var pt = Q3D.Utils.getPoint(geom.pts, i);
       var sprite = new THREE.Sprite(mat);
       sprite.position.set(pt[0], pt[1], pt[2]);
       sprite.scale.set(sx, sy, scale);
@@ -2164,9 +2393,9 @@ Q3D.LineLayer.prototype.build = function (features) {
   }
   else if (objType == "Line") {
     createObject = function (f, line) {
-      var geom = new THREE.Geometry(), pt;
-      for (var i = 0, l = line.length; i < l; i++) {
-        pt = line[i];
+      var geom = new THREE.Geometry(), pt = [];
+      for (var i = 0, l = Q3D.Utils.pointCount(line); i < l; i++) {
+        pt = Q3D.Utils.getPoint(line, i, pt);
         geom.vertices.push(new THREE.Vector3(pt[0], pt[1], pt[2]));
       }
       return new THREE.Line(geom, materials.mat(f.mat));
@@ -2179,9 +2408,9 @@ Q3D.LineLayer.prototype.build = function (features) {
       var group = new Q3D.Group();
 
       var pt0 = new THREE.Vector3(), pt1 = new THREE.Vector3(), sub = new THREE.Vector3();
-      var geom, obj, pt;
-      for (var i = 0, l = line.length; i < l; i++) {
-        pt = line[i];
+      var geom, obj, pt = [];
+      for (var i = 0, l = Q3D.Utils.pointCount(line); i < l; i++) {
+        pt = Q3D.Utils.getPoint(line, i, pt);
         pt1.set(pt[0], pt[1], pt[2]);
 
         if (hasJoints) {
@@ -2229,9 +2458,11 @@ Q3D.LineLayer.prototype.build = function (features) {
           pt = new THREE.Vector3(), ptM = new THREE.Vector3(), scale1 = new THREE.Vector3(1, 1, 1),
           matrix = new THREE.Matrix4(), quat = new THREE.Quaternion();
 
-      pt0.set(line[0][0], line[0][1], line[0][2]);
-      for (var i = 1, l = line.length; i < l; i++) {
-        pt1.set(line[i][0], line[i][1], line[i][2]);
+      var p = Q3D.Utils.getPoint(line, 0, []);
+      pt0.set(p[0], p[1], p[2]);
+      for (var i = 1, l = Q3D.Utils.pointCount(line); i < l; i++) {
+        p = Q3D.Utils.getPoint(line, i, p);
+        pt1.set(p[0], p[1], p[2]);
         dist = pt0.distanceTo(pt1);
         sub.subVectors(pt1, pt0);
         rx = Math.atan2(sub.z, Math.sqrt(sub.x * sub.x + sub.y * sub.y));
@@ -2316,10 +2547,10 @@ Q3D.LineLayer.prototype.build = function (features) {
         vertices = dem.segmentizeLineString(line);          // line is list of 3D point [x, y, z]
       }
       else {    // both altitude modes are absolute
-        var pt;
+        var pt = [];
         vertices = [];
-        for (var i = 0, l = line.length; i < l; i++) {
-          pt = line[i];
+        for (var i = 0, l = Q3D.Utils.pointCount(line); i < l; i++) {
+          pt = Q3D.Utils.getPoint(line, i, pt);
           vertices.push(new THREE.Vector3(pt[0], pt[1], pt[2]));
         }
       }
@@ -2576,8 +2807,8 @@ Q3D.ModelBuilder.Base.prototype = {
       var layer = this.scene.mapLayers[fet.layerId],
           f = layer.f[fet.featureId];
 
-      for (var i = 0, l = f.pts.length; i < l; i++) {
-        var pt = f.pts[i],
+      for (var i = 0, l = Q3D.Utils.pointCount(f.pts); i < l; i++) {
+        var pt = Q3D.Utils.getPoint(f.pts, i),
             mesh = this.cloneObject(fet.layerId);
 
         // rotation
@@ -2809,10 +3040,29 @@ Q3D.Utils.createWallGeometry = function (vertices, bzFunc) {
   return geom;
 };
 
+// a point list in feature geometry is an array of points ([x, y, z] or [x, y]), or a flat array of coordinates
+// that has the number of coordinates per point in dim property (decoded from a binary block).
+// index tuple lists (e.g. triangle faces) are also arrays of tuples or flat arrays.
+Q3D.Utils.pointCount = function (points) {
+  return (points.dim === undefined) ? points.length : points.length / points.dim;
+};
+
+// returns i-th point of a point list. pt: array to store coordinates of a point of a flat array in (optional)
+Q3D.Utils.getPoint = function (points, i, pt) {
+  var dim = points.dim;
+  if (dim === undefined) return points[i];
+
+  pt = pt || [];
+  for (var k = 0; k < dim; k++) {
+    pt[k] = points[i * dim + k];
+  }
+  return pt;
+};
+
 Q3D.Utils.arrayToVec2Array = function (points) {
-  var pt, pts = [];
-  for (var i = 0, l = points.length; i < l; i++) {
-    pt = points[i];
+  var pt = [], pts = [];
+  for (var i = 0, l = Q3D.Utils.pointCount(points); i < l; i++) {
+    pt = Q3D.Utils.getPoint(points, i, pt);
     pts.push(new THREE.Vector2(pt[0], pt[1]));
   }
   return pts;
@@ -2820,18 +3070,18 @@ Q3D.Utils.arrayToVec2Array = function (points) {
 
 Q3D.Utils.arrayToVec3Array = function (points, zFunc) {
   if (zFunc === undefined) zFunc = function () { return 0; };
-  var pt, pts = [];
-  for (var i = 0, l = points.length; i < l; i++) {
-    pt = points[i];
+  var pt = [], pts = [];
+  for (var i = 0, l = Q3D.Utils.pointCount(points); i < l; i++) {
+    pt = Q3D.Utils.getPoint(points, i, pt);
     pts.push(new THREE.Vector3(pt[0], pt[1], zFunc(pt[0], pt[1])));
   }
   return pts;
 };
 
 Q3D.Utils.arrayToFace3Array = function (faces) {
-  var f, fs = [];
-  for (var i = 0, l = faces.length; i < l; i++) {
-    f = faces[i];
+  var f = [], fs = [];
+  for (var i = 0, l = Q3D.Utils.pointCount(faces); i < l; i++) {
+    f = Q3D.Utils.getPoint(faces, i, f);
     fs.push(new THREE.Face3(f[0], f[1], f[2]));
   }
   return fs;
@@ -2877,6 +3127,66 @@ Q3D.Utils.createOverlayGeometry = function (triangles, polygons, zFunc) {
   return geom;
 };
 
+// decode a feature block in binary format (see geombuffer.py)
+// innermost point lists are restored as flat Float32Array views (see Q3D.Utils.getPoint()) and index tuple lists
+// as flat Uint32Array views, so that coordinates and indices are neither copied nor split per vertex
+Q3D.Utils.decodeBinaryBlock = function (buffer) {
+  var view = new DataView(buffer),
+      headerLength = view.getUint32(4, true),
+      bytes = new Uint8Array(buffer, 8, headerLength),
+      text;
+
+  if (window.TextDecoder !== undefined) text = new TextDecoder("utf-8").decode(bytes);
+  else text = decodeURIComponent(escape(String.fromCharCode.apply(null, bytes)));
+
+  var block = JSON.parse(text),
+      offset = 8 + headerLength,
+      indices = new Uint32Array(buffer, offset, block.buffer.i),
+      coords = new Float32Array(buffer, offset + 4 * block.buffer.i, block.buffer.c);
+
+  var unpackPoints = function (ref) {
+    var dim = ref[0] || 1, c = ref[2], i = ref[3];    // dim is 0 if there is no point
+    var read = function (depth) {
+      var list, n = indices[i++];
+      if (depth == 1) {
+        list = coords.subarray(c, c + n * dim);
+        list.dim = dim;
+        c += n * dim;
+        return list;
+      }
+      list = [];
+      for (var k = 0; k < n; k++) {
+        list.push(read(depth - 1));
+      }
+      return list;
+    };
+    return read(ref[1]);
+  };
+
+  var unpackIndices = function (ref) {
+    var dim = ref[0], i = ref[1], n = indices[i++],
+        list = indices.subarray(i, i + n * dim);
+    list.dim = dim;
+    return list;
+  };
+
+  var unpack = function (obj) {
+    for (var key in obj) {
+      var v = obj[key];
+      if (v === null || typeof v != "object" || v instanceof Array) continue;
+      if (v._b !== undefined) obj[key] = unpackPoints(v._b);
+      else if (v._i !== undefined) obj[key] = unpackIndices(v._i);
+      else unpack(v);
+    }
+  };
+
+  for (var i = 0, l = block.features.length; i < l; i++) {
+    unpack(block.features[i].geom);
+  }
+  delete block.buffer;
+  return block;
+};
+
 Q3D.Utils.setGeometryUVs = function (geom, base_width, base_height) {
   var face, v, uvs = [];
   for (var i = 0, l = geom.vertices.length; i < l; i++) {
@@ -21,7 +21,6 @@
 """
 from qgis.core import QgsWkbTypes
 from Qgis2threejs.stylewidget import StyleWidget, ColorWidgetFunc, HeightWidgetFunc, LabelHeightWidgetFunc, OptionalColorWidgetFunc, ColorTextureWidgetFunc
-from Qgis2threejs.geometry import Triangles
 
 
 def geometryType():
@@ -117,22 +116,10 @@ def material(settings, layer, feat):
 
 
 def geometry(settings, layer, feat, geom):
-  polygons = []
-  zs = []
-  for polygon in geom.polygons:
-    bnds = []
-    zsum = zcount = 0
-    for boundary in polygon:
-      bnds.append([[pt.x, pt.y] for pt in boundary])
-      zsum += sum([pt.z for pt in boundary], -boundary[0].z)
-      zcount += len(boundary) - 1
-    polygons.append(bnds)
-    zs.append(zsum / zcount)
-
-  g = {"polygons": polygons}
+  g = {"polygons": geom.asList2()}
 
   if layer.prop.type_index == 0:  # Extruded
-    g["zs"] = zs
+    g["zs"] = geom.zMeans()
     g["h"] = feat.values[2] * settings.mapTo3d().multiplierZ
 
   else:   # Overlay
@@ -152,23 +139,14 @@ def geometry(settings, layer, feat, geom):
     # Vertical shift is not considered (will be shifted in JS).
     g["h"] = feat.relativeHeight() * settings.mapTo3d().multiplierZ
 
-    polygons = []
-    triangles = Triangles()
-    for polygon in geom.split_polygons:
-      boundary = polygon[0]
-      if len(polygon) == 1 and len(boundary) == 4:
-        triangles.addTriangle(boundary[0], boundary[2], boundary[1])    # vertex order should be counter-clockwise
-      else:
-        bnds = [[[pt.x, pt.y] for pt in bnd] for bnd in polygon]
-        polygons.append(bnds)
+    if geom.split_triangles is not None:
+      if geom.split_triangles.vertices:
+        g["triangles"] = {"v": geom.split_triangles.vertices, "f": geom.split_triangles.faces}
 
-    if triangles.vertices:
-      g["triangles"] = {"v": [[pt.x, pt.y] for pt in triangles.vertices], "f": triangles.faces}
+      if geom.split_polygons:
+        g["split_polygons"] = geom.split_polygons
 
-    if polygons:
-      g["split_polygons"] = polygons
-
-  if geom.centroids:
-    g["centroids"] = [[pt.x, pt.y, pt.z] for pt in geom.centroids]
+  if len(geom.centroids):
+    g["centroids"] = geom.centroids.tolist()
 
   return g
@@ -21,23 +21,51 @@
  *                                                                         *
  ***************************************************************************/
 """
+from collections import OrderedDict
 import math
+import os
+import threading
 import numpy
-import struct
 
 from osgeo import gdal
 from PyQt5.QtCore import QSettings
-from qgis.core import Qgis, QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsPoint, QgsRectangle
+from qgis.core import Qgis, QgsApplication, QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsGeometry, QgsPoint, QgsRectangle
 
-from .downloader import Downloader
+from .tilestore import ElevTileStore, NODATA_VALUE, TILE_SIZE
+from Qgis2threejs.qgis2threejscore import GridWarper, sampleValues
 from Qgis2threejs.qgis2threejstools import logMessage
 
-TILE_SIZE = 256
 TSIZE1 = 20037508.342789244
-NODATA_VALUE = 0
-NODATA_VALUE_BYTES = b"0"
 ZMAX = 14
 
+MAX_TILES = 128           # max number of tiles for a read. a coarser zoom level is used for a read that exceeds it.
+MAX_MOSAIC_TILES = 256    # max number of tiles that a mosaic of a zoom level covers
+MOSAIC_ZOOMS = 2          # number of zoom levels whose mosaics are kept
+URL_TEMPLATE = "http://cyberjapandata.gsi.go.jp/xyz/dem/{z}/{x}/{y}.txt"
+
+_tileStore = None
+_tileStoreLock = threading.Lock()
+
+
+def sharedTileStore():
+  """returns the tile store shared in the process. settings are read when the store is created."""
+  global _tileStore
+  with _tileStoreLock:
+    if _tileStore is None:
+      settings = QSettings()
+      cacheDir = None
+      if settings.value("/Qgis2threejs/GSIElevTile/diskCache", True, type=bool):
+        cacheDir = settings.value("/Qgis2threejs/GSIElevTile/cacheDir", "", type=str) or \
+                   os.path.join(QgsApplication.qgisSettingsDirPath(), "cache", "Qgis2threejs", "gsielevtile")
+
+      _tileStore = ElevTileStore(settings.value("/Qgis2threejs/GSIElevTile/url", URL_TEMPLATE, type=str),
+                                 cacheDir,
+                                 maxConnections=settings.value("/Qgis2threejs/GSIElevTile/maxConnections", 4, type=int),
+                                 memoryTiles=settings.value("/Qgis2threejs/GSIElevTile/memoryTiles", 256, type=int),
+                                 expiration=settings.value("/qgis/defaultTileExpiry", 24, type=int),
+                                 userAgent="QGIS/{0} Qgis2threejs GSIElevTileProvider".format(Qgis.QGIS_VERSION_INT))
+    return _tileStore
+
 
 class GSIElevTileProvider:
 
@@ -54,12 +82,13 @@ class GSIElevTileProvider:
     # approximate bbox of this data
     self.boundingbox = QgsRectangle(13667807, 2320477, 17230031, 5713298)
 
-    self.downloader = Downloader()
-    self.downloader.userAgent = "QGIS/{0} Qgis2threejs GSIElevTileProvider".format(Qgis.QGIS_VERSION_INT)  # will be overwritten in QgsNetworkAccessManager::createRequest() since 2.2
-    self.downloader.DEFAULT_CACHE_EXPIRATION = QSettings().value("/qgis/defaultTileExpiry", 24, type=int)
+    self.tileStore = sharedTileStore()
+
+    self.warper = GridWarper(self.crs3857.toWkt(), dest_wkt)
 
     self.driver = gdal.GetDriverByName("MEM")
-    self.last_dataset = None
+    self.mosaics = OrderedDict()    # key: zoom level, value: ZoomMosaic
+    self._lock = threading.Lock()
 
   def name(self):
     return "GSI Elevation Tile"
@@ -70,18 +99,16 @@ class GSIElevTileProvider:
     geometry.transform(self.transform)
     merc_rect = geometry.boundingBox()
 
-    # if the bounding box doesn't intersect with the bounding box of this data, return a list filled with nodata value
+    # if the bounding box doesn't intersect with the bounding box of this data, return an array filled with nodata value
     if not self.boundingbox.intersects(merc_rect):
-      return [NODATA_VALUE] * width * height
+      return numpy.full(width * height, NODATA_VALUE, dtype=numpy.float32)
 
     # get tiles
     over_smpl = 1
     segments_x = 1 if width == 1 else width - 1
     res = extent.width() / segments_x / over_smpl
-    ds = self.getDataset(merc_rect.xMinimum(), merc_rect.yMinimum(), merc_rect.xMaximum(), merc_rect.yMaximum(), res)
-
     geotransform = extent.geotransform(width, height)
-    return self._read(ds, width, height, geotransform)
+    return self._read((merc_rect.xMinimum(), merc_rect.yMinimum(), merc_rect.xMaximum(), merc_rect.yMaximum()), res, width, height, geotransform)
 
   def readValue(self, x, y):
     """Get value at the position using 1px * 1px memory raster. The value is calculated using a tile of max zoom level"""
@@ -94,24 +121,42 @@ class GSIElevTileProvider:
 
     res = 0.1
     hres = res / 2
-    ds = self.getDataset(pt.x() - hres, pt.y() - hres, pt.x() + hres, pt.y() + hres, res)
-
     geotransform = [x - hres, res, 0, y + hres, 0, -res]
-    return self._read(ds, 1, 1, geotransform)[0]
-
-  def _read(self, ds, width, height, geotransform):
-    # create a memory dataset
-    warped_ds = self.driver.Create("", width, height, 1, gdal.GDT_Float32)
-    warped_ds.SetProjection(self.dest_wkt)
-    warped_ds.SetGeoTransform(geotransform)
-
-    # reproject image
-    gdal.ReprojectImage(ds, warped_ds, None, None, gdal.GRA_Bilinear)
-
-    # load values into an array
-    band = warped_ds.GetRasterBand(1)
-    fs = "f" * width * height
-    return struct.unpack(fs, band.ReadRaster(0, 0, width, height, buf_type=gdal.GDT_Float32))
+    return float(self._read((pt.x() - hres, pt.y() - hres, pt.x() + hres, pt.y() + hres), res, 1, 1, geotransform)[0])
+
+  def readValues(self, xs, ys):
+    """Get values at the positions. The values are calculated using tiles of max zoom level, and
+       each window that covers a group of the points is warped only once."""
+    if len(xs) == 0:
+      return numpy.zeros(0)
+
+    # resolution of max zoom level tiles in EPSG:3857 and its approximate value in destination CRS
+    merc_res = 2 * TSIZE1 / (2 ** ZMAX * TILE_SIZE)
+    pt = self.transform.transform(QgsPoint(numpy.mean(xs), numpy.mean(ys)))
+    pt2 = self.transform.transform(QgsPoint(pt.x() + merc_res, pt.y()), QgsCoordinateTransform.ReverseTransform)
+    pt = self.transform.transform(pt, QgsCoordinateTransform.ReverseTransform)
+    res = ((pt2.x() - pt.x()) ** 2 + (pt2.y() - pt.y()) ** 2) ** 0.5
+
+    def read(width, height, geotransform):
+      # calculate bounding box of the window in EPSG:3857
+      xmin, ymax = geotransform[0], geotransform[3]
+      geometry = QgsGeometry.fromRect(QgsRectangle(xmin, ymax + geotransform[5] * height, xmin + geotransform[1] * width, ymax))
+      geometry.transform(self.transform)
+      merc_rect = geometry.boundingBox()
+
+      if not self.boundingbox.intersects(merc_rect):
+        return numpy.full(width * height, NODATA_VALUE, dtype=numpy.float32)
+
+      return self._read((merc_rect.xMinimum(), merc_rect.yMinimum(), merc_rect.xMaximum(), merc_rect.yMaximum()), merc_res, width, height, geotransform)
+
+    return sampleValues(read, xs, ys, res)
+
+  def _read(self, merc_bounds, mapUnitsPerPixel, width, height, geotransform):
+    """reads grid values from the mosaic that covers the bounds in EPSG:3857.
+    mosaics and the warper are shared by all reads, so a read is done in the lock."""
+    with self._lock:
+      ds = self.getDataset(*merc_bounds, mapUnitsPerPixel)
+      return self.warper.read(ds, width, height, geotransform)
 
   def getDataset(self, xmin, ymin, xmax, ymax, mapUnitsPerPixel):
     # calculate zoom level
@@ -119,69 +164,107 @@ class GSIElevTileProvider:
     zoom = int(math.ceil(math.log(mpp1 / mapUnitsPerPixel, 2) + 1))
     zoom = max(0, min(zoom, ZMAX))
 
-    # calculate tile range (yOrigin is top)
+    # use coarser zoom level while number of tiles to fetch exceeds the limit
+    tileRange = tileRangeForBounds(zoom, xmin, ymin, xmax, ymax)
+    while zoom > 0 and tileCount(tileRange) > MAX_TILES:
+      zoom -= 1
+      tileRange = tileRangeForBounds(zoom, xmin, ymin, xmax, ymax)
+
+    return self.mosaic(zoom, tileRange).fill(tileRange)
+
+  def mosaic(self, zoom, tileRange):
+    """returns the mosaic of the zoom level that covers the tile range. If the current mosaic doesn't cover it,
+    a new mosaic is created over both ranges (or over the tile range only if the union is too large),
+    and the tiles already filled are copied into it."""
+    mosaic = self.mosaics.pop(zoom, None)
+    if mosaic is None or not mosaic.contains(tileRange):
+      newRange = tileRange
+      if mosaic is not None:
+        union = unionTileRange(mosaic.tileRange, tileRange)
+        if tileCount(union) <= MAX_MOSAIC_TILES:
+          newRange = union
+
+      newMosaic = ZoomMosaic(self.driver, self.tileStore, zoom, newRange, str(self.crs3857.toWkt()))
+      if mosaic is not None:
+        newMosaic.copyFrom(mosaic)
+      mosaic = newMosaic
+
+    self.mosaics[zoom] = mosaic
+    while len(self.mosaics) > MOSAIC_ZOOMS:
+      self.mosaics.popitem(last=False)
+    return mosaic
+
+
+class ZoomMosaic:
+  """Sparse mosaic of tiles of a zoom level. It covers a range of tiles, but only tiles that have been
+  requested are filled with elevation data. The other tiles are left filled with nodata value."""
+
+  def __init__(self, driver, tileStore, zoom, tileRange, crsWkt):
+    """tileRange: tuple (ulx, uly, lrx, lry). y origin is top."""
+    self.tileStore = tileStore
+    self.zoom = zoom
+    self.tileRange = tileRange
+    self.filled = set()     # tuples (x, y) of tiles filled with data
+
+    ulx, uly, lrx, lry = tileRange
     size = TSIZE1 / 2 ** (zoom - 1)
-    matrixSize = 2 ** zoom
-    ulx = max(0, int((xmin + TSIZE1) / size))
-    uly = max(0, int((TSIZE1 - ymax) / size))
-    lrx = min(int((xmax + TSIZE1) / size), matrixSize - 1)
-    lry = min(int((TSIZE1 - ymin) / size), matrixSize - 1)
-
-    cols = lrx - ulx + 1
-    rows = lry - uly + 1
-
-    # download count limit
-    if cols * rows > 128:
-      logMessage("Number of tiles to fetch is too large!")
-      width = height = 1
-      return self.driver.Create("", width, height, 1, gdal.GDT_Float32, [])
-
-    if self.last_dataset and self.last_dataset[0] == [zoom, ulx, uly, lrx, lry]:    # if same as last tile set, return cached dataset
-      return self.last_dataset[1]
-
-    urltmpl = "http://cyberjapandata.gsi.go.jp/xyz/dem/{z}/{x}/{y}.txt"
-    #urltmpl = "http://localhost/xyz/dem/{z}/{x}/{y}.txt"
-    tiles = self.fetchFiles(urltmpl, zoom, ulx, uly, lrx, lry)
-
-    # create a memory dataset
-    width = cols * TILE_SIZE
-    height = rows * TILE_SIZE
     res = size / TILE_SIZE
-    geotransform = [ulx * size - TSIZE1, res, 0, TSIZE1 - uly * size, 0, -res]
-
-    #mem_driver = gdal.GetDriverByName("GTiff")
-    #ds = mem_driver.Create("D:/fetched_tile.tif", width, height, 1, gdal.GDT_Float32, [])
-
-    ds = self.driver.Create("", width, height, 1, gdal.GDT_Float32, [])
-    ds.SetProjection(str(self.crs3857.toWkt()))
-    ds.SetGeoTransform(geotransform)
-
-    band = ds.GetRasterBand(1)
-    for i, tile in enumerate(tiles):
-      if tile:
-        col = i % cols
-        row = i // cols
-        band.WriteRaster(col * TILE_SIZE, row * TILE_SIZE, TILE_SIZE, TILE_SIZE, tile)
-
-    ds.FlushCache()
-
-    self.last_dataset = [[zoom, ulx, uly, lrx, lry], ds]   # cache dataset
-    return ds
-
-  def fetchFiles(self, urltmpl, zoom, xmin, ymin, xmax, ymax):
-    downloadTimeout = 60
-
-    urls = []
-    for y in range(ymin, ymax + 1):
-      for x in range(xmin, xmax + 1):
-        urls.append(urltmpl.replace("{x}", str(x)).replace("{y}", str(y)).replace("{z}", str(zoom)))
-    files = self.downloader.fetchFiles(urls, downloadTimeout)
-
-    for url in urls:
-      data = files[url]
-      if data:
-        yield numpy.fromstring(data.replace(b"e", NODATA_VALUE_BYTES).replace(b"\n", b","), dtype=numpy.float32, sep=",").tostring()   # to byte array
-      else:
-        array = numpy.empty(TILE_SIZE * TILE_SIZE, dtype=numpy.float32)
-        array.fill(NODATA_VALUE)
-        yield array.tostring()
+
+    self.ds = driver.Create("", (lrx - ulx + 1) * TILE_SIZE, (lry - uly + 1) * TILE_SIZE, 1, gdal.GDT_Float32, [])
+    self.ds.SetProjection(crsWkt)
+    self.ds.SetGeoTransform([ulx * size - TSIZE1, res, 0, TSIZE1 - uly * size, 0, -res])
+    self.band = self.ds.GetRasterBand(1)
+    self.band.Fill(NODATA_VALUE)
+
+  def contains(self, tileRange):
+    ulx, uly, lrx, lry = self.tileRange
+    return ulx <= tileRange[0] and uly <= tileRange[1] and tileRange[2] <= lrx and tileRange[3] <= lry
+
+  def fill(self, tileRange):
+    """fills tiles in the tile range that haven't been filled yet, and returns the dataset"""
+    ulx, uly, lrx, lry = tileRange
+    missing = [(x, y) for y in range(uly, lry + 1) for x in range(ulx, lrx + 1) if (x, y) not in self.filled]
+    if missing:
+      # tiles are downloaded and decoded by workers of the tile store, and written as they are ready.
+      # tiles that failed to load are written as nodata but not marked as filled, so that they are requested again
+      for i, tile, cacheable in self.tileStore.completed([(self.zoom, x, y) for x, y in missing]):
+        x, y = missing[i]
+        self.band.WriteArray(tile, (x - self.tileRange[0]) * TILE_SIZE, (y - self.tileRange[1]) * TILE_SIZE)
+        if cacheable:
+          self.filled.add((x, y))
+      self.ds.FlushCache()
+    return self.ds
+
+  def copyFrom(self, mosaic):
+    """copies filled tiles of another mosaic of the same zoom level within the tile range of this mosaic"""
+    tiles = [(x, y) for x, y in mosaic.filled if self.contains((x, y, x, y))]
+    if not tiles:
+      return
+
+    # copy bounding range of the tiles at once
+    xs = [x for x, y in tiles]
+    ys = [y for x, y in tiles]
+    ulx, uly, lrx, lry = min(xs), min(ys), max(xs), max(ys)
+    data = mosaic.band.ReadAsArray((ulx - mosaic.tileRange[0]) * TILE_SIZE, (uly - mosaic.tileRange[1]) * TILE_SIZE,
+                                   (lrx - ulx + 1) * TILE_SIZE, (lry - uly + 1) * TILE_SIZE)
+    self.band.WriteArray(data, (ulx - self.tileRange[0]) * TILE_SIZE, (uly - self.tileRange[1]) * TILE_SIZE)
+    self.filled.update(tiles)
+
+
+def tileRangeForBounds(zoom, xmin, ymin, xmax, ymax):
+  """returns range of tiles (ulx, uly, lrx, lry) that covers the bounds in EPSG:3857. y origin is top."""
+  size = TSIZE1 / 2 ** (zoom - 1)
+  matrixSize = 2 ** zoom
+  ulx = max(0, int((xmin + TSIZE1) / size))
+  uly = max(0, int((TSIZE1 - ymax) / size))
+  lrx = min(int((xmax + TSIZE1) / size), matrixSize - 1)
+  lry = min(int((TSIZE1 - ymin) / size), matrixSize - 1)
+  return (ulx, uly, lrx, lry)
+
+
+def tileCount(tileRange):
+  return (tileRange[2] - tileRange[0] + 1) * (tileRange[3] - tileRange[1] + 1)
+
+
+def unionTileRange(r1, r2):
+  return (min(r1[0], r2[0]), min(r1[1], r2[1]), max(r1[2], r2[2]), max(r1[3], r2[3]))
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ElevTileStore
+   fetches elevation tiles with a pool of connections, and caches decoded
+ tiles in memory and on disk
+                              -------------------
+        begin                : 2017-06-26
+        copyright            : (C) 2017 Minoru Akagi
+        email                : akaginch@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+import io
+import os
+import threading
+import time
+
+import numpy
+from PyQt5.QtCore import QUrl
+from PyQt5.QtNetwork import QNetworkRequest
+from qgis.core import QgsBlockingNetworkRequest
+
+from Qgis2threejs.qgis2threejstools import logMessage
+
+TILE_SIZE = 256
+NODATA_VALUE = 0
+_NODATA_TOKEN = str(NODATA_VALUE).encode("ascii")
+
+# numpy.loadtxt has a fast C parser since numpy 1.23. it is faster than numpy.fromstring
+# (1.3x to 2x, depending on numpy version and data)
+_fastTextParser = numpy.lib.NumpyVersion(numpy.__version__) >= "1.23.0"
+
+
+def decodeTextTile(data):
+  """decodes a GSI elevation tile in text format (comma separated values, "e" for nodata)
+  into a float32 array of shape (TILE_SIZE, TILE_SIZE).
+  Decoded tiles are cached, so each tile is decoded into an array of its own and copied into mosaics."""
+  if b"e" in data:
+    data = data.replace(b"e", _NODATA_TOKEN)
+
+  if _fastTextParser:
+    values = numpy.loadtxt(io.BytesIO(data), dtype=numpy.float32, delimiter=",", ndmin=2)
+  else:
+    values = numpy.fromstring(data.replace(b"\n", b","), dtype=numpy.float32, sep=",")
+
+  if values.size != TILE_SIZE * TILE_SIZE:
+    raise ValueError("number of values in the tile is {0}".format(values.size))
+  return values.reshape(TILE_SIZE, TILE_SIZE)
+
+
+def nodataTile():
+  return numpy.full((TILE_SIZE, TILE_SIZE), NODATA_VALUE, dtype=numpy.float32)
+
+
+class ElevTileStore:
+  """Tiles are looked up in a memory LRU cache of decoded tiles, in a disk cache of decoded tiles
+  (cacheDir/z/x/y.npy) and then fetched from the server with up to maxConnections concurrent requests.
+  Downloaded tiles are decoded by the worker that fetched them, so decoding runs concurrently with other downloads.
+  Requests for a tile that is already being fetched share the fetch.
+  Tiles that do not exist on the server (HTTP 404) are treated as nodata tiles and cached."""
+
+  def __init__(self, urlTemplate, cacheDir=None, maxConnections=4, memoryTiles=256, expiration=24, userAgent="", decoder=decodeTextTile):
+    """urlTemplate: url with {z}, {x} and {y} placeholders
+       cacheDir: directory of disk cache. None disables disk cache.
+       memoryTiles: max number of tiles kept in memory
+       expiration: expiration of tiles in disk cache in hours. 0 means that tiles never expire.
+    Requests time out after the network timeout in QGIS settings."""
+    self.urlTemplate = urlTemplate
+    self.cacheDir = cacheDir
+    self.memoryTiles = memoryTiles
+    self.expiration = expiration
+    self.userAgent = userAgent
+    self.decoder = decoder
+
+    self._executor = ThreadPoolExecutor(max(1, maxConnections))
+    self._lock = threading.Lock()
+    self._memory = OrderedDict()    # key: (z, x, y), value: decoded tile
+    self._inflight = {}             # key: (z, x, y), value: Future
+
+    self.hits = self.diskHits = self.downloads = self.errors = 0
+
+  def tile(self, z, x, y):
+    """returns a decoded tile (float32 array of shape (TILE_SIZE, TILE_SIZE))"""
+    return self.tiles([(z, x, y)])[0]
+
+  def tiles(self, keys):
+    """returns a list of decoded tiles. keys: list of tuples (z, x, y)
+    tiles are shared with the cache, so they should not be modified."""
+    return [f.result()[0] for f in [self.request(key) for key in keys]]
+
+  def completed(self, keys):
+    """yields tuples (index of key, decoded tile, whether the tile can be cached) in the order in which tiles become ready.
+    Tiles that failed to load are nodata tiles that cannot be cached. keys: list of tuples (z, x, y)"""
+    futures = {}
+    for i, key in enumerate(keys):
+      futures.setdefault(self.request(key), []).append(i)
+
+    for future in as_completed(futures):
+      tile, cacheable = future.result()
+      for i in futures[future]:
+        yield i, tile, cacheable
+
+  def request(self, key):
+    """returns a Future of a tuple (decoded tile, whether the tile can be cached). key: tuple (z, x, y)"""
+    with self._lock:
+      tile = self._memory.get(key)
+      if tile is not None:
+        self._memory.move_to_end(key)
+        self.hits += 1
+        future = Future()
+        future.set_result((tile, True))
+        return future
+
+      future = self._inflight.get(key)
+      if future is None:
+        future = self._inflight[key] = self._executor.submit(self._load, key)
+      return future
+
+  def _load(self, key):
+    try:
+      tile, cacheable = self._loadFromDisk(key), True
+      if tile is None:
+        tile, cacheable = self._fetch(key)
+        if cacheable:
+          self._saveToDisk(key, tile)
+
+      # tiles that failed to load are not cached so that they are requested again next time
+      if cacheable:
+        with self._lock:
+          self._memory[key] = tile
+          while len(self._memory) > self.memoryTiles:
+            self._memory.popitem(last=False)
+      return tile, cacheable
+
+    finally:
+      with self._lock:
+        self._inflight.pop(key, None)
+
+  def _fetch(self, key):
+    """returns a tuple (decoded tile, whether the tile can be cached on disk).
+    Tiles are requested through QGIS network access manager, so that QGIS proxy, authentication and SSL settings apply."""
+    z, x, y = key
+    url = self.urlTemplate.replace("{z}", str(z)).replace("{x}", str(x)).replace("{y}", str(y))
+    request = QNetworkRequest(QUrl(url))
+    if self.userAgent:
+      request.setRawHeader(b"User-Agent", self.userAgent.encode("ascii", "ignore"))
+
+    # blocking request runs its own event loop in the worker thread
+    blockingRequest = QgsBlockingNetworkRequest()
+    err = blockingRequest.get(request)
+    reply = blockingRequest.reply()
+    if err != QgsBlockingNetworkRequest.NoError:
+      if reply.attribute(QNetworkRequest.HttpStatusCodeAttribute) == 404:     # no tile at the position
+        return nodataTile(), True
+      self._count("errors")
+      logMessage("Failed to fetch a GSI elevation tile: {0} ({1})".format(url, blockingRequest.errorMessage()))
+      return nodataTile(), False
+
+    self._count("downloads")
+    try:
+      return self.decoder(bytes(reply.content())), True
+    except ValueError as e:
+      self._count("errors")
+      logMessage("Failed to decode a GSI elevation tile: {0} ({1})".format(url, e))
+      return nodataTile(), False
+
+  def _diskPath(self, key):
+    return os.path.join(self.cacheDir, str(key[0]), str(key[1]), "{0}.npy".format(key[2]))
+
+  def _loadFromDisk(self, key):
+    if not self.cacheDir:
+      return None
+    path = self._diskPath(key)
+    try:
+      if self.expiration and time.time() - os.path.getmtime(path) > self.expiration * 3600:
+        return None
+      tile = numpy.load(path)
+    except (OSError, ValueError):
+      return None
+
+    self._count("diskHits")
+    return tile
+
+  def _count(self, name):
+    """increments a counter. counters are updated from worker threads"""
+    with self._lock:
+      setattr(self, name, getattr(self, name) + 1)
+
+  def _saveToDisk(self, key, tile):
+    if not self.cacheDir:
+      return
+    path = self._diskPath(key)
+    try:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      tmp = "{0}.{1}.tmp".format(path, threading.get_ident())
+      with open(tmp, "wb") as f:
+        numpy.save(f, tile)
+      os.replace(tmp, path)
+    except OSError:
+      pass
+
+  def clearMemory(self):
+    with self._lock:
+      self._memory.clear()
+
+  def shutdown(self):
+    self._executor.shutdown()
+
+  def stats(self):
+    return {"hits": self.hits,
+            "diskHits": self.diskHits,
+            "downloads": self.downloads,
+            "errors": self.errors,
+            "memoryTiles": len(self._memory)}
+
@@ -23,7 +23,7 @@ import os
 import random
 from PyQt5.QtCore import QSize
 from PyQt5.QtGui import QColor
-from qgis.core import NULL, QgsExpression, QgsExpressionContext, QgsExpressionContextUtils
+from qgis.core import NULL, QgsExpression, QgsExpressionContext, QgsExpressionContextUtils, QgsExpressionNode, QgsFeatureRequest
 
 from .qgis2threejscore import calculateDEMSize
 from .qgis2threejstools import logMessage
@@ -57,6 +57,7 @@ class VectorPropertyReader:
     self.renderContext = renderContext
     self.expressionContext = QgsExpressionContext()
     self.expressionContext.appendScope(QgsExpressionContextUtils.layerScope(layer))
+    self.expressionContext.setFields(layer.fields())
     self.layer = layer
     properties = properties or {}
     self.properties = properties
@@ -72,14 +73,50 @@ class VectorPropertyReader:
       self.visible = False
 
     self._exprs = {}
-    self.exprZ = QgsExpression(properties.get("fieldExpressionWidget_zCoordinate") or "0")
+    self._attrNames = set()     # names of attributes referenced by expressions and height widgets
+    self._usesRenderer = False  # whether feature colors are read from the renderer
+    self.resetSymbolCache()
+
+    self.exprZ = self.expression(properties.get("fieldExpressionWidget_zCoordinate") or "0")
+    self._constZ = self._constantValue(self.exprZ)
+
+    self._plan = self._compileStylePlan() if properties else []
+
+  def expression(self, expr_str):
+    """returns a prepared expression. attributes referenced by the expression are recorded."""
+    expr = self._exprs.get(expr_str)
+    if expr is None:
+      expr = QgsExpression(expr_str)
+      if expr.hasParserError():
+        logMessage("Failed to parse expression: {0} ({1})".format(expr_str, expr.parserErrorString()))
+      expr.prepare(self.expressionContext)
+      self._attrNames.update(expr.referencedColumns())
+      self._exprs[expr_str] = expr
+    return expr
+
+  def _constantValue(self, expr):
+    """returns a tuple (value,) if the expression is a literal, otherwise None"""
+    node = expr.rootNode()
+    if node is None:
+      return None
+    if node.nodeType() == QgsExpressionNode.ntLiteral or (node.nodeType() == QgsExpressionNode.ntUnaryOperator and
+                                                           node.operand().nodeType() == QgsExpressionNode.ntLiteral):
+      return (expr.evaluate(self.expressionContext),)
+    return None
 
   def evaluateExpression(self, expr_str, f):
-    if expr_str not in self._exprs:
-      self._exprs[expr_str] = QgsExpression(expr_str)
-
     self.expressionContext.setFeature(f)
-    return self._exprs[expr_str].evaluate(self.expressionContext)
+    return self.expression(expr_str).evaluate(self.expressionContext)
+
+  def referencedAttributes(self):
+    """returns a list of attribute names required to read values from features,
+    or None if all attributes may be required"""
+    names = set(self._attrNames)
+    if self._usesRenderer:
+      names.update(self.layer.renderer().usedAttributes(self.renderContext))
+    if QgsFeatureRequest.ALL_ATTRIBUTES in names:
+      return None
+    return sorted(names)
 
   def readFillColor(self, vals, f):
     return self._readColor(vals, f)
@@ -106,26 +143,8 @@ class VectorPropertyReader:
       return QColor(colorName).name().replace("#", "0x")
 
     # feature color
-    symbol = self.layer.renderer().symbolForFeature(f, self.renderContext)
-    if symbol is None:
-      logMessage('Symbol for feature cannot be found: {0}'.format(self.layer.name()))
-      symbol = self.layer.renderer().symbols()[0]
-    else:
-      sl = symbol.symbolLayer(0)
-      if sl and isBorder:
-        return sl.strokeColor().name().replace("#", "0x")
-
-      if sl and symbol.hasDataDefinedProperties():
-        expr = sl.dataDefinedProperty("color")    #TODO: QGIS 3
-        if expr:
-          # data defined color
-          rgb = expr.evaluate(f, f.fields())
-
-          # "rrr,ggg,bbb" (dec) to "0xRRGGBB" (hex)
-          r, g, b = [max(0, min(int(c), 255)) for c in rgb.split(",")[:3]]
-          return "0x{0:02x}{1:02x}{2:02x}".format(r, g, b)
-
-    return symbol.color().name().replace("#", "0x")
+    color, strokeColor, alpha = self.symbolStyle(f)
+    return strokeColor if isBorder else color
 
   def readOpacity(self, widgetValues, f):
     vals = widgetValues
@@ -137,27 +156,70 @@ class VectorPropertyReader:
       except ValueError:
         return 1
 
-    alpha = None
-    symbol = self.layer.renderer().symbolForFeature(f, self.renderContext)
+    color, strokeColor, alpha = self.symbolStyle(f)
+    return self.layer.opacity() * alpha    # opacity = layer_opacity * feature_opacity
+
+  def resetSymbolCache(self):
+    """call this at the start of each render pass. symbols are owned by the renderer and may change between passes."""
+    self._symbolStyles = {}
+    self._featureStyle = (None, None)
+
+  def symbolStyle(self, f):
+    """returns a tuple (color, stroke color, alpha) of the symbol for the feature.
+    The symbol is resolved once per feature object, and styles of symbols are cached unless their
+    data defined color depends on features."""
+    if self._featureStyle[0] is f:
+      return self._featureStyle[1]
+
+    renderer = self.layer.renderer()
+    symbol = renderer.symbolForFeature(f, self.renderContext)
     if symbol is None:
       logMessage('Symbol for feature cannot be found: {0}'.format(self.layer.name()))
-      symbol = self.layer.renderer().symbols()[0]
+      symbol = renderer.symbols()[0]
+      color = symbol.color().name().replace("#", "0x")
+      style = (color, color, 1)
     else:
-      sl = symbol.symbolLayer(0)
-      if sl and symbol.hasDataDefinedProperties():
-        expr = sl.dataDefinedProperty("color")    #TODO: QGIS 3
-        if expr:
-          # data defined opacity
-          cs_rgba = expr.evaluate(f, f.fields())
-          rgba = cs_rgba.split(",")
-          if len(rgba) == 4:
-            alpha = rgba[3] / 255
-
-    if alpha is None:
-      alpha = 1         #TODO: QGIS 3 symbol.alpha()
-                        # 'QgsMarkerSymbol' object has no attribute 'alpha'
-
-    return self.layer.opacity() * alpha    # opacity = layer_opacity * feature_opacity
+      # a reference to the symbol is kept in the cache, so that the id is not reused during the render pass
+      entry = self._symbolStyles.get(id(symbol))
+      if entry is None:
+        entry = self._symbolStyles[id(symbol)] = (symbol,) + self._symbolStyleEntry(symbol)
+      style, expr = entry[1:]
+      if expr:
+        style = self._dataDefinedStyle(style, expr, f)
+        if not self._dependsOnFeature(expr):
+          # the color is the same for every feature, so it is evaluated only once in the render pass
+          self._symbolStyles[id(symbol)] = (symbol, style, None)
+
+    # the feature is referenced so that the style is not reused for another feature
+    self._featureStyle = (f, style)
+    return style
+
+  def _symbolStyleEntry(self, symbol):
+    """returns a tuple (style, data defined color expression or None)"""
+    color = symbol.color().name().replace("#", "0x")
+    alpha = 1         #TODO: QGIS 3 symbol.alpha()
+                      # 'QgsMarkerSymbol' object has no attribute 'alpha'
+
+    sl = symbol.symbolLayer(0)
+    if sl is None:
+      return (color, color, alpha), None
+
+    expr = None
+    if symbol.hasDataDefinedProperties():
+      expr = sl.dataDefinedProperty("color")    #TODO: QGIS 3
+
+    return (color, sl.strokeColor().name().replace("#", "0x"), alpha), expr or None
+
+  def _dependsOnFeature(self, expr):
+    """whether the data defined property references fields or geometry of features"""
+    return bool(expr.referencedColumns()) or expr.needsGeometry()
+
+  def _dataDefinedStyle(self, style, expr, f):
+    # "rrr,ggg,bbb[,aaa]" (dec) to "0xRRGGBB" (hex) and alpha
+    rgba = [max(0, min(int(c), 255)) for c in expr.evaluate(f, f.fields()).split(",")[:4]]
+    color = "0x{0:02x}{1:02x}{2:02x}".format(*rgba[:3])
+    alpha = rgba[3] / 255 if len(rgba) == 4 else style[2]
+    return (color, style[1], alpha)
 
   @classmethod
   def toFloat(cls, val):
@@ -178,6 +240,8 @@ class VectorPropertyReader:
     return self.properties.get("radioButton_Relative", False)
 
   def relativeHeight(self):
+    if self._constZ is not None:
+      return self._constZ[0]
     return self.exprZ.evaluate(self.expressionContext)
 
   def setContextFeature(self, f):
@@ -187,7 +251,13 @@ class VectorPropertyReader:
   #TODO: rename this to styleValues
   def values(self, f):
     assert(f is not None)
-    vals = []
+    self.expressionContext.setFeature(f)
+    return [read(f) for read in self._plan]
+
+  def _compileStylePlan(self):
+    """returns a list of functions, each of which reads a value of a style widget from a feature.
+    expressions are prepared, field indices are resolved and constant values are folded."""
+    plan = []
     for i in range(32):   # big number for style count
       p = "styleWidget" + str(i)
       if p not in self.properties:
@@ -197,45 +267,86 @@ class VectorPropertyReader:
       if len(widgetValues) == 0:
         break
 
-      widgetType = widgetValues["type"]
-      comboData = widgetValues.get("comboData")
-      if widgetType == StyleWidget.COLOR:
-        vals.append(self.readFillColor(widgetValues, f))
-
-      elif widgetType == StyleWidget.OPTIONAL_COLOR:
-        vals.append(self.readBorderColor(widgetValues, f))
-
-      elif widgetType == StyleWidget.COLOR_TEXTURE:
-        if comboData == ColorTextureWidgetFunc.MAP_CANVAS:
-          vals.append(comboData)
-        elif comboData == ColorTextureWidgetFunc.LAYER:
-          vals.append(widgetValues.get("layerIds", []))
-        else:
-          vals.append(self.readFillColor(widgetValues, f))
-
-      elif widgetType == StyleWidget.OPACITY:
-        vals.append(self.readOpacity(widgetValues, f))
-
-      elif widgetType == StyleWidget.CHECKBOX:
-        vals.append(widgetValues["checkBox"])
-
-      elif widgetType == StyleWidget.HEIGHT:
-        #TODO
-        if widgetValues["comboData"] in [HeightWidgetFunc.RELATIVE, HeightWidgetFunc.ABSOLUTE, HeightWidgetFunc.Z_VALUE] or f is None:
-          vals.append(self.toFloat(widgetValues["editText"]))
-        else:
-          # attribute value + addend
-          fieldName = widgetValues["comboText"].lstrip("+").strip(' "')
-          vals.append(self.toFloat(f.attribute(fieldName)) + self.toFloat(widgetValues["editText"]))
-
-      else:
-        expr = widgetValues["editText"]
-        val = self.evaluateExpression(expr, f)
-        if val is None:
-          logMessage("Failed to evaluate expression: " + expr)
-          if widgetType == StyleWidget.FILEPATH:
-            val = ""
-          else:
-            val = 0
-        vals.append(val)
-    return vals
+      plan.append(self._compileWidget(widgetValues))
+    return plan
+
+  def _compileWidget(self, widgetValues):
+    widgetType = widgetValues["type"]
+    comboData = widgetValues.get("comboData")
+
+    if widgetType == StyleWidget.CHECKBOX:
+      return constant(widgetValues["checkBox"])
+
+    if widgetType == StyleWidget.COLOR_TEXTURE:
+      if comboData == ColorTextureWidgetFunc.MAP_CANVAS:
+        return constant(comboData)
+      if comboData == ColorTextureWidgetFunc.LAYER:
+        return constant(widgetValues.get("layerIds", []))
+
+    if widgetType in (StyleWidget.COLOR, StyleWidget.OPTIONAL_COLOR, StyleWidget.COLOR_TEXTURE):
+      isBorder = (widgetType == StyleWidget.OPTIONAL_COLOR)
+      if comboData == OptionalColorWidgetFunc.NONE:
+        return constant(None)
+
+      if comboData == ColorWidgetFunc.EXPRESSION:
+        return self._compileExpression(widgetValues["editText"])
+
+      if comboData != ColorWidgetFunc.RANDOM:
+        self._usesRenderer = True
+      return lambda f: self._readColor(widgetValues, f, isBorder)
+
+    if widgetType == StyleWidget.OPACITY:
+      if comboData != OpacityWidgetFunc.VALUE:
+        self._usesRenderer = True
+        return lambda f: self.readOpacity(widgetValues, f)
+
+      toOpacity = lambda val: min(max(0, val), 100) / 100
+      expr = self.expression(widgetValues["editText"])
+      const = self._constantValue(expr)
+      if const is not None:
+        return constant(toOpacity(const[0]))
+
+      def readOpacity(f):
+        try:
+          return toOpacity(expr.evaluate(self.expressionContext))
+        except ValueError:
+          return 1
+      return readOpacity
+
+    if widgetType == StyleWidget.HEIGHT:
+      addend = self.toFloat(widgetValues["editText"])
+      if comboData in [HeightWidgetFunc.RELATIVE, HeightWidgetFunc.ABSOLUTE, HeightWidgetFunc.Z_VALUE]:
+        return constant(addend)
+
+      # attribute value + addend
+      fieldName = widgetValues["comboText"].lstrip("+").strip(' "')
+      idx = self.layer.fields().lookupField(fieldName)
+      if idx == -1:
+        logMessage("Field not found: {0}".format(fieldName))
+        return constant(addend)
+
+      self._attrNames.add(fieldName)
+      return lambda f: self.toFloat(f.attribute(idx)) + addend
+
+    expr_str = widgetValues["editText"]
+    default = "" if widgetType == StyleWidget.FILEPATH else 0
+    return self._compileExpression(expr_str, default)
+
+  def _compileExpression(self, expr_str, default=None):
+    expr = self.expression(expr_str)
+    const = self._constantValue(expr)
+    if const is not None:
+      return constant(const[0] if const[0] is not None or default is None else default)
+
+    def evaluate(f):
+      val = expr.evaluate(self.expressionContext)
+      if val is None and default is not None:
+        logMessage("Failed to evaluate expression: " + expr_str)
+        return default
+      return val
+    return evaluate
+
+
+def constant(value):
+  """returns a function that returns the value regardless of the feature"""
+  return lambda f: value
@@ -19,13 +19,16 @@
  *                                                                         *
  ***************************************************************************/
 """
-import struct
+import math
+import os
+import threading
+import numpy
 
-from osgeo import gdal
+from osgeo import gdal, osr
 from PyQt5.QtCore import QSize
 from qgis.core import QgsMapLayer, QgsRectangle, QgsWkbTypes
 
-from .gdal2threejs import Raster
+from .gdal2threejs import Raster, bilinearInterpolation
 from .geometry import Point
 from .rotatedrect import RotatedRect
 from .quadtree import DEMQuadTree
@@ -89,6 +92,8 @@ class MapTo3D:
     self.multiplier = planeWidth / self.mapExtent.width()
     self.multiplierZ = self.multiplier * verticalExaggeration
 
+    self._matrix = None
+
   def transform(self, x, y, z=0):
     n = self.mapExtent.normalizePoint(x, y)
     return Point((n.x() - 0.5) * self.planeWidth,
@@ -98,10 +103,38 @@ class MapTo3D:
   def transformPoint(self, pt):
     return self.transform(pt.x, pt.y, pt.z)
 
+  def matrix(self):
+    """returns a 3x4 affine matrix M that transforms map coordinates to 3d coordinates: [X, Y, Z] = M . [x, y, z, 1]"""
+    if self._matrix is not None:
+      return self._matrix
+
+    n = self.mapExtent.normalizationMatrix()
+    m = numpy.zeros((3, 4))
+    m[0, [0, 1, 3]] = n[0] * self.planeWidth
+    m[0, 3] -= 0.5 * self.planeWidth
+    m[1, [0, 1, 3]] = n[1] * self.planeHeight
+    m[1, 3] -= 0.5 * self.planeHeight
+    m[2, 2] = self.multiplierZ
+    m[2, 3] = self.verticalShift * self.multiplierZ
+    self._matrix = m
+    return m
+
+  def transformArray(self, xs, ys, zs):
+    """batch version of transform. returns an array of shape (n, 3)"""
+    coords = numpy.empty((len(xs), 4))
+    coords[:, 0] = xs
+    coords[:, 1] = ys
+    coords[:, 2] = zs
+    coords[:, 3] = 1
+    return coords.dot(self.matrix().T)
+
 
 class GDALDEMProvider(Raster):
 
-  def __init__(self, filename, dest_wkt, source_wkt=None):
+  threadSafe = True
+
+  def __init__(self, filename, dest_wkt, source_wkt=None, tileCache=None):
+    """tileCache: TileCache object to store warped grids in. If None, every read warps the source."""
     Raster.__init__(self, filename)
     self.driver = gdal.GetDriverByName("MEM")
     self.dest_wkt = dest_wkt
@@ -109,32 +142,74 @@ class GDALDEMProvider(Raster):
     if source_wkt:
       self.ds.SetProjection(str(source_wkt))
 
-  def _read(self, width, height, geotransform):
-    # create a memory dataset
-    warped_ds = self.driver.Create("", width, height, 1, gdal.GDT_Float32)
-    warped_ds.SetProjection(self.dest_wkt)
-    warped_ds.SetGeoTransform(geotransform)
-
-    # reproject image
-    gdal.ReprojectImage(self.ds, warped_ds, None, None, gdal.GRA_Bilinear)
+    self.tileCache = tileCache
+    self._resolution = None
+
+    # dataset handles per thread (a GDAL dataset must not be used by multiple threads at the same time)
+    self._local = threading.local()
+    self._local.ds = self.ds
+
+    # key to identify source and destination of warped grids
+    mtime = os.path.getmtime(filename) if os.path.exists(filename) else None
+    self._tileKey = (filename, mtime, source_wkt, dest_wkt)
+
+  def dataset(self):
+    """returns the source dataset opened for the calling thread"""
+    ds = getattr(self._local, "ds", None)
+    if ds is None:
+      ds = gdal.Open(self.filename, gdal.GA_ReadOnly)
+      if self.source_wkt:
+        ds.SetProjection(str(self.source_wkt))
+      self._local.ds = ds
+    return ds
+
+  def warper(self):
+    """returns the grid warper for the calling thread"""
+    warper = getattr(self._local, "warper", None)
+    if warper is None:
+      warper = self._local.warper = GridWarper(self.dataset().GetProjection(), self.dest_wkt)
+    return warper
 
-    # load values into an array
-    band = warped_ds.GetRasterBand(1)
-    fs = "f" * width * height
-    return struct.unpack(fs, band.ReadRaster(0, 0, width, height, buf_type=gdal.GDT_Float32))
+  def _read(self, width, height, geotransform):
+    return self.warper().read(self.dataset(), width, height, geotransform)
 
   def read(self, width, height, extent):
-    return self._read(width, height, extent.geotransform(width, height))
+    """returns a 1d numpy.float32 array of width * height grid values"""
+    geotransform = extent.geotransform(width, height)
+    if self.tileCache is None:
+      return self._read(width, height, geotransform)
+
+    # warped grids are cached per grid size and geotransform, so cached values are the same as values read directly
+    key = self._tileKey + (width, height, tuple(geotransform))
+    values = self.tileCache.get(key)
+    if values is None:
+      values = self._read(width, height, geotransform)
+      self.tileCache.put(key, values)
+    return values.copy()    # callers may modify values in place
 
   def readValue(self, x, y):
     """get value at the position using 1px * 1px memory raster"""
     res = 0.1
     geotransform = [x - res / 2, res, 0, y + res / 2, 0, -res]
-    return self._read(1, 1, geotransform)[0]
+    return float(self._read(1, 1, geotransform)[0])
+
+  def readValues(self, xs, ys):
+    """get values at the positions. each window that covers a group of the points is warped only once"""
+    return sampleValues(self._read, xs, ys, self.resolution())
+
+  def resolution(self):
+    """approximate resolution of the source raster in destination CRS"""
+    if self._resolution is None:
+      vrt = gdal.AutoCreateWarpedVRT(self.dataset(), None, self.dest_wkt)
+      geotransform = vrt.GetGeoTransform() if vrt else self.geotransform
+      self._resolution = abs(geotransform[1])
+    return self._resolution
 
 
 class FlatDEMProvider:
 
+  threadSafe = True
+
   def __init__(self, value=0):
     self.value = value
 
@@ -142,11 +217,155 @@ class FlatDEMProvider:
     return "Flat Plane"
 
   def read(self, width, height, extent):
-    return [self.value] * width * height
+    return numpy.full(width * height, self.value, dtype=numpy.float32)
 
   def readValue(self, x, y):
     return self.value
 
+  def readValues(self, xs, ys):
+    return numpy.full(len(xs), self.value, dtype=numpy.float64)
+
+
+class GridWarper:
+  """Reads values of a source raster on grids in destination CRS with bilinear interpolation.
+  The coordinate transformation is created once and reused for every read. Source pixel coordinates are
+  calculated at a coarse lattice of grid points and interpolated between them (like GDAL approximate transformer),
+  and only the source window that covers the grid is read."""
+
+  LATTICE_STEP = 16
+  OVERSAMPLING = 2    # density of source values read for a grid, relative to grid points
+
+  def __init__(self, source_wkt, dest_wkt):
+    self.ct = None
+    if source_wkt and dest_wkt:
+      source_srs = osr.SpatialReference()
+      dest_srs = osr.SpatialReference()
+      if source_srs.ImportFromWkt(str(source_wkt)) == 0 and dest_srs.ImportFromWkt(str(dest_wkt)) == 0 and not source_srs.IsSame(dest_srs):
+        if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):    # GDAL >= 3.0
+          source_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+          dest_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        self.ct = osr.CoordinateTransformation(dest_srs, source_srs)
+
+  def read(self, ds, width, height, geotransform):
+    """returns a 1d numpy.float32 array of width * height grid values. grid points outside the source raster are 0."""
+    px, py = self.pixelCoordinates(ds.GetGeoTransform(), width, height, geotransform)
+
+    # interval of grid points in source pixels (in the finer direction)
+    gpx, gpy = px.reshape(height, width), py.reshape(height, width)
+    interval = min(numpy.hypot(numpy.diff(gpx, axis=1), numpy.diff(gpy, axis=1)).mean() if width > 1 else numpy.inf,
+                   numpy.hypot(numpy.diff(gpx, axis=0), numpy.diff(gpy, axis=0)).mean() if height > 1 else numpy.inf)
+
+    # source window that covers the grid (pixel centers are at half pixels)
+    cols, rows = ds.RasterXSize, ds.RasterYSize
+    inside = (px >= 0) & (px <= cols) & (py >= 0) & (py <= rows)
+    values = numpy.zeros(width * height, dtype=numpy.float32)
+    if not inside.any():
+      return values
+
+    # if grid points are sparser than source pixels, the window is read into a smaller buffer (twice as dense as
+    # grid points) with resampling, and the window is extended by a buffer pixel so that buffer pixel centers cover the grid.
+    scale = interval / self.OVERSAMPLING if numpy.isfinite(interval) else 1
+    margin = int(math.ceil(scale)) if scale > 1 else 0
+
+    px, py = px[inside], py[inside]
+    x0 = min(max(int(math.floor(px.min() - 0.5)) - margin, 0), max(cols - 2, 0))
+    y0 = min(max(int(math.floor(py.min() - 0.5)) - margin, 0), max(rows - 2, 0))
+    x1 = min(max(int(math.floor(px.max() - 0.5)) + 1 + margin, x0 + 1), cols - 1)
+    y1 = min(max(int(math.floor(py.max() - 0.5)) + 1 + margin, y0 + 1), rows - 1)
+    win_width, win_height = x1 - x0 + 1, y1 - y0 + 1
+
+    # GDAL uses overviews of the source raster if available
+    band = ds.GetRasterBand(1)
+    if scale > 1:
+      buf_width = max(2, int(math.ceil(win_width / scale)))
+      buf_height = max(2, int(math.ceil(win_height / scale)))
+      grid = band.ReadAsArray(x0, y0, win_width, win_height, buf_width, buf_height, resample_alg=gdal.GRIORA_Bilinear)
+    else:
+      grid = band.ReadAsArray(x0, y0, win_width, win_height)
+    grid = grid.astype(numpy.float64)
+    if grid.shape[0] < 2 or grid.shape[1] < 2:    # source raster of 1 pixel width or height
+      grid = numpy.pad(grid, ((0, 2 - min(grid.shape[0], 2)), (0, 2 - min(grid.shape[1], 2))), "edge")
+
+    # positions in the buffer (buffer pixel centers are at half buffer pixels)
+    gx = numpy.clip((px - x0) * grid.shape[1] / win_width - 0.5, 0, grid.shape[1] - 1)
+    gy = numpy.clip((py - y0) * grid.shape[0] / win_height - 0.5, 0, grid.shape[0] - 1)
+
+    nodata = band.GetNoDataValue()
+    if nodata is None:
+      values[inside] = bilinearInterpolation(grid, gx, gy)
+    else:
+      # interpolate valid pixels only. grid points surrounded by nodata pixels are 0.
+      valid = (grid != nodata).astype(numpy.float64)
+      weights = bilinearInterpolation(valid, gx, gy)
+      sums = bilinearInterpolation(grid * valid, gx, gy)
+      values[inside] = numpy.where(weights > 0, sums / numpy.maximum(weights, 1e-12), 0)
+    return values
+
+  def pixelCoordinates(self, source_geotransform, width, height, geotransform):
+    """returns source pixel coordinates (px, py) of grid points (centers of grid cells) in 1d arrays"""
+    step = self.LATTICE_STEP
+    lcols = numpy.append(numpy.arange(0, max(width - 1, 1), step), max(width - 1, 1))
+    lrows = numpy.append(numpy.arange(0, max(height - 1, 1), step), max(height - 1, 1))
+
+    # transform lattice points to source CRS
+    col, row = numpy.meshgrid(lcols + 0.5, lrows + 0.5)
+    x = geotransform[0] + col * geotransform[1] + row * geotransform[2]
+    y = geotransform[3] + col * geotransform[4] + row * geotransform[5]
+    if self.ct is not None:
+      pts = numpy.array(self.ct.TransformPoints(numpy.column_stack((x.ravel(), y.ravel())).tolist()), dtype=numpy.float64)
+      x = pts[:, 0].reshape(x.shape)
+      y = pts[:, 1].reshape(y.shape)
+
+    # source CRS to source pixel coordinates
+    g = source_geotransform
+    inv = numpy.linalg.inv([[g[1], g[2]], [g[4], g[5]]])
+    x = x - g[0]
+    y = y - g[3]
+    lpx = inv[0, 0] * x + inv[0, 1] * y
+    lpy = inv[1, 0] * x + inv[1, 1] * y
+
+    # interpolate pixel coordinates of lattice points
+    fx = numpy.interp(numpy.arange(width), lcols, numpy.arange(len(lcols)))
+    fy = numpy.interp(numpy.arange(height), lrows, numpy.arange(len(lrows)))
+    fx, fy = numpy.meshgrid(fx, fy)
+    return bilinearInterpolation(lpx, fx.ravel(), fy.ravel()), bilinearInterpolation(lpy, fx.ravel(), fy.ravel())
+
+
+def sampleValues(read_func, xs, ys, res, block_size=1024):
+  """sample grid values at many points with bilinear interpolation. points are grouped by windows of
+  block_size x block_size grid points at most, and grid values of each window are read only once.
+  args:
+    read_func -- function(width, height, geotransform) that returns grid values in a 1d array
+    xs, ys    -- sequences of coordinates of the points
+    res       -- grid resolution of the windows
+  """
+  xs = numpy.asarray(xs, dtype=numpy.float64)
+  ys = numpy.asarray(ys, dtype=numpy.float64)
+  values = numpy.zeros(len(xs))
+  if len(xs) == 0:
+    return values
+
+  # group points by window
+  span = res * (block_size - 1)
+  bx = ((xs - xs.min()) // span).astype(numpy.int64)
+  by = ((ys.max() - ys) // span).astype(numpy.int64)
+  keys = by * (bx.max() + 1) + bx
+  order = numpy.argsort(keys, kind="stable")
+  starts = numpy.flatnonzero(numpy.diff(keys[order])) + 1
+
+  for indices in numpy.split(order, starts):
+    px, py = xs[indices], ys[indices]
+    x0, y0 = px.min(), py.max()
+    width = int((px.max() - x0) / res) + 2
+    height = int((y0 - py.min()) / res) + 2
+
+    # top-left grid point is at (x0, y0)
+    geotransform = [x0 - res / 2, res, 0, y0 + res / 2, 0, -res]
+    grid = read_func(width, height, geotransform).reshape(height, width)
+    values[indices] = bilinearInterpolation(grid, (px - x0) / res, (y0 - py) / res)
+
+  return values
+
 
 #TODO; move to propertyreader.py
 def calculateDEMSize(canvasSize, sizeLevel, roughening=0):
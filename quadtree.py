@@ -19,8 +19,11 @@
  *                                                                         *
  ***************************************************************************/
 """
+import numpy
 from qgis.core import QgsPoint, QgsRectangle
 
+from .gdal2threejs import bilinearInterpolation
+
 
 class QuadNode:
 
@@ -81,6 +84,7 @@ class QuadTree:
     self.root = self.NodeClass(self, rect, 0)
     self.focusRect = None
     self.height = 0
+    self._neighbors = {}
 
   def buildTreeByRect(self, rect, height):
     if not self.rect.intersects(rect):
@@ -88,6 +92,7 @@ class QuadTree:
     self.focusRect = QgsRectangle(rect)
     self.height = height
     self.root.subdivideRecursively(self.focusRect, height)
+    self.buildNeighborTable()
     return True
 
   def buildTreeByPoint(self, point, height):
@@ -106,17 +111,46 @@ class QuadTree:
 
   def neighbors(self, quad):
     # if neighbor count of one direction is not only one, returns one of neighbors. so totally returns 4 neighbors.
-    quads = [None] * 4
-    if len(quad.parent.subNodes) == 0:
-      return quads
-    rect = quad.rect
-    center = rect.center()
+    return self._neighbors.get(quad, [None] * 4)
+
+  def buildNeighborTable(self):
+    """find neighbors of every top quad and store them in the table"""
+    self._neighbors = {}
+    quads = self.quads()
+    if len(quads) < 2:
+      return
+
+    # top quads indexed by height and position (column and row) in the level of the height
+    rect = self.rect
+    index = {}
+    for quad in quads:
+      n = 2 ** quad.height
+      col = int((quad.rect.xMinimum() - rect.xMinimum()) / rect.width() * n + 0.5)
+      row = int((rect.yMaximum() - quad.rect.yMaximum()) / rect.height() * n + 0.5)
+      index[(quad.height, col, row)] = quad
+
+    def quadByPosition(x, y):
+      if not (rect.xMinimum() <= x <= rect.xMaximum() and rect.yMinimum() <= y <= rect.yMaximum()):
+        return None
+      nx = (x - rect.xMinimum()) / rect.width()
+      ny = (rect.yMaximum() - y) / rect.height()
+      for height in range(self.height + 1):
+        n = 2 ** height
+        quad = index.get((height, min(int(nx * n), n - 1), min(int(ny * n), n - 1)))
+        if quad:
+          return quad
+      return None
+
     m = 0.5 ** self.height
-    quads[self.UP] = self.quadByPosition(QgsPoint(center.x(), rect.yMaximum() + m * rect.height()))
-    quads[self.LEFT] = self.quadByPosition(QgsPoint(rect.xMinimum() - m * rect.width(), center.y()))
-    quads[self.RIGHT] = self.quadByPosition(QgsPoint(rect.xMaximum() + m * rect.width(), center.y()))
-    quads[self.DOWN] = self.quadByPosition(QgsPoint(center.x(), rect.yMinimum() - m * rect.height()))
-    return quads
+    for quad in quads:
+      r = quad.rect
+      cx, cy = r.center().x(), r.center().y()
+      neighbors = [None] * 4
+      neighbors[self.UP] = quadByPosition(cx, r.yMaximum() + m * r.height())
+      neighbors[self.LEFT] = quadByPosition(r.xMinimum() - m * r.width(), cy)
+      neighbors[self.RIGHT] = quadByPosition(r.xMaximum() + m * r.width(), cy)
+      neighbors[self.DOWN] = quadByPosition(cx, r.yMinimum() - m * r.height())
+      self._neighbors[quad] = neighbors
 
 
 class QuadList:
@@ -196,12 +230,20 @@ class DEMQuadNode(QuadNode):
 
     return 0    # as safe null value
 
+  def getValues(self, xs, ys):
+    """vectorized version of getValue(). xs and ys are numpy arrays of grid coordinates"""
+    values = bilinearInterpolation(self.dem_values.reshape(self.dem_height, self.dem_width), xs, ys)
+    values[(xs < 0) | (xs > self.dem_width - 1) | (ys < 0) | (ys > self.dem_height - 1)] = 0    # as safe null value
+    return values
+
   def gridPointToPoint(self, x, y):
+    """x and y can be numpy arrays"""
     x = self.rect.xMinimum() + self.rect.width() / (self.dem_width - 1) * x
     y = self.rect.yMaximum() - self.rect.height() / (self.dem_height - 1) * y
     return x, y
 
   def pointToGridPoint(self, x, y):
+    """x and y can be numpy arrays"""
     x = (x - self.rect.xMinimum()) / self.rect.width() * (self.dem_width - 1)
     y = (self.rect.yMaximum() - y) / self.rect.height() * (self.dem_height - 1)
     return x, y
@@ -215,27 +257,23 @@ class DEMQuadTree(QuadTree):
     """ fit edges of every block with next block of different resolution"""
 
     for quad in self.quads(sorted=True):
-      if quad == 1:
-        continue
-
-      dem_width, dem_height, dem_values = quad.dem_width, quad.dem_height, quad.dem_values
+      dem_width, dem_height = quad.dem_width, quad.dem_height
+      grid = quad.dem_values.reshape(dem_height, dem_width)    # view of dem_values
       for direction, neighbor in enumerate(self.neighbors(quad)):
         if neighbor is None or quad.height <= neighbor.height:
           continue
 
         if direction in [DEMQuadTree.UP, DEMQuadTree.DOWN]:
           y = 0 if direction == DEMQuadTree.UP else dem_height - 1
-          for x in range(dem_width):
-            gx, gy = quad.gridPointToPoint(x, y)
-            gx, gy = neighbor.pointToGridPoint(gx, gy)
-            dem_values[x + dem_width * y] = neighbor.getValue(gx, gy)
+          edge = grid[y]
+          gx, gy = quad.gridPointToPoint(numpy.arange(dem_width), numpy.full(dem_width, y))
 
         else:   # LEFT or RIGHT
           x = 0 if direction == DEMQuadTree.LEFT else dem_width - 1
-          for y in range(dem_height):
-            gx, gy = quad.gridPointToPoint(x, y)
-            gx, gy = neighbor.pointToGridPoint(gx, gy)
-            dem_values[x + dem_width * y] = neighbor.getValue(gx, gy)
+          edge = grid[:, x]
+          gx, gy = quad.gridPointToPoint(numpy.full(dem_height, x), numpy.arange(dem_height))
+
+        edge[:] = neighbor.getValues(*neighbor.pointToGridPoint(gx, gy))
 
 
 class DEMQuadList(QuadList):
@@ -249,15 +287,16 @@ class DEMQuadList(QuadList):
     QuadList.addQuad(self, quad)
 
   def unitedDEM(self):
+    """returns a 1d numpy.float32 array of grid values of all quads united. shared edges are taken from upper/left quads"""
     self.sort()
     width = self.width()
     height = self.height()
-    dem_values = []
+    w, h = self.dem_width - 1, self.dem_height - 1
+    dem_values = numpy.empty((h * height + 1, w * width + 1), dtype=numpy.float32)
     for row in range(height):
       y0 = 0 if row == 0 else 1
-      for y in range(y0, self.dem_height):
-        for col in range(width):
-          x0 = 0 if col == 0 else 1
-          i = y * self.dem_width + x0
-          dem_values += self.quads[col + row * width].dem_values[i:i + self.dem_width - x0]
-    return dem_values
+      for col in range(width):
+        x0 = 0 if col == 0 else 1
+        grid = self.quads[col + row * width].dem_values.reshape(self.dem_height, self.dem_width)
+        dem_values[row * h + y0:(row + 1) * h + 1, col * w + x0:(col + 1) * w + 1] = grid[y0:, x0:]
+    return dem_values.ravel()
@@ -18,6 +18,8 @@
  ***************************************************************************/
 """
 import math
+
+import numpy
 from qgis.core import QgsPointXY, QgsRectangle, QgsGeometry
 
 
@@ -80,6 +82,27 @@ class RotatedRect:
     return QgsPointXY((pt.x() - rect.xMinimum()) / rect.width(),
                     (pt.y() - rect.yMinimum()) / rect.height())
 
+  def normalizationMatrix(self):
+    """returns a 2x3 affine matrix M that normalizes points: [nx, ny] = M . [x, y, 1]
+    (same as normalizePoint(x, y), where lower-left is (0, 0) and upper-right is (1, 1))"""
+    theta = self._rotation * math.pi / 180
+    c = math.cos(theta)
+    s = math.sin(theta)
+    cx, cy = self._center.x(), self._center.y()
+
+    # rotate clockwise around center, and then scale and translate
+    a, b = c / self._width, s / self._width
+    d, e = -s / self._height, c / self._height
+    return numpy.array([[a, b, 0.5 - a * cx - b * cy],
+                        [d, e, 0.5 - d * cx - e * cy]])
+
+  def normalizePoints(self, xs, ys):
+    """batch version of normalizePoint. returns a tuple of arrays (nxs, nys)"""
+    m = self.normalizationMatrix()
+    xs = numpy.asarray(xs, dtype=numpy.float64)
+    ys = numpy.asarray(ys, dtype=numpy.float64)
+    return m[0, 0] * xs + m[0, 1] * ys + m[0, 2], m[1, 0] * xs + m[1, 1] * ys + m[1, 2]
+
   def scale(self, s):
     self._width *= s
     self._height *= s
@@ -231,8 +254,21 @@ class RotatedRect:
 
     return pts
 
+  def _key(self):
+    return (self._center.x(), self._center.y(), self._width, self._height, self._rotation)
+
+  def __eq__(self, other):
+    return isinstance(other, RotatedRect) and self._key() == other._key()
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def __hash__(self):
+    # note: do not modify a rect (scale/rotate) while it is used as a key
+    return hash(self._key())
+
   def __repr__(self):
-    return "RotatedRect(c:{0}, w:{1}, h:{2}, r:{3})".format(self._center.toString(), self._width, self._height, self._rotation)
+    return "RotatedRect(c:{0!r},{1!r}, w:{2!r}, h:{3!r}, r:{4!r})".format(self._center.x(), self._center.y(), self._width, self._height, self._rotation)
 
     # print coordinates of vertices
     pts = self.verticies()
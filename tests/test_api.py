@@ -9,9 +9,10 @@ the Free Software Foundation; either version 2 of the License, or
 (at your option) any later version.
 """
 # TODO: version >= 2.4
+import json
 import os
 from unittest import TestCase
-from PyQt5.QtCore import QSize
+from PyQt5.QtCore import QSettings, QSize
 from qgis.core import QgsCoordinateReferenceSystem, QgsMapSettings, QgsRectangle
 
 from Qgis2threejs.api import Exporter
@@ -62,6 +63,107 @@ class TestApi(TestCase):
     err = exporter.export(outputPath(os.path.join("testproject1", "flatplane.html")))
     assert err == Exporter.NO_ERROR, err
 
+  def test03_export_clipped_dem(self):
+    """test exporting a DEM clipped by a polygon layer and overlay polygons relative to the DEM"""
+    projectPath = dataPath("testproject1.qgs")
+    mapSettings = loadProject(projectPath)
+
+    # output size
+    width = 800
+    height = width * mapSettings.extent().height() / mapSettings.extent().width()
+    mapSettings.setOutputSize(QSize(width, height))
+
+    exporter = Exporter(None, dataPath("testproject1.qto3settings"))
+    exporter.setMapSettings(mapSettings)
+
+    settings = exporter.settings
+    settings.updateLayerList()
+    demId = "dem_srtm3020150914165149263"
+    clipId = "polygon120150915163203246"
+    overlayId = "polygon220150915163203903"
+    for layer in settings.getLayerList():
+      layer.visible = layer.layerId in [demId, overlayId]
+
+    dem = settings.getItemByLayerId(demId)
+    dem.properties = dict(settings.data[ObjectTreeItem.ITEM_DEM], checkBox_Clip=True, comboBox_ClipLayer=clipId)
+
+    overlay = settings.getItemByLayerId(overlayId)
+    overlay.properties = dict(settings.data["POLYGON"][overlayId], radioButton_Relative=True, comboBox_zDEMLayer=demId)
+
+    err = exporter.export(outputPath(os.path.join("testproject1", "clippeddem.html")))
+    assert err == Exporter.NO_ERROR, err
+
+    with open(os.path.join(settings.outputdatadir, "scene.json")) as f:
+      layers = json.load(f)["layers"]
+    assert len(layers) == 2, layers
+    dem = [layer for layer in layers if layer["properties"]["type"] == "dem"][0]
+    assert dem["data"], "no DEM blocks"
+
+  def test04_export_layers_concurrently(self):
+    """test that exporting layers concurrently writes the same scene as exporting them one by one"""
+    projectPath = dataPath("testproject1.qgs")
+    mapSettings = loadProject(projectPath)
+
+    # output size
+    width = 800
+    height = width * mapSettings.extent().height() / mapSettings.extent().width()
+    mapSettings.setOutputSize(QSize(width, height))
+
+    exporter = Exporter(None, dataPath("testproject1.qto3settings"))
+    exporter.setMapSettings(mapSettings)
+
+    scenes = []
+    settings = QSettings()
+    try:
+      for layerWorkers in [1, 3]:
+        settings.setValue("/Qgis2threejs/layerWorkers", layerWorkers)
+        err = exporter.export(outputPath(os.path.join("layerworkers{0}".format(layerWorkers), "testproject1.html")))
+        assert err == Exporter.NO_ERROR, err
+
+        with open(os.path.join(exporter.settings.outputdatadir, "scene.json")) as f:
+          scenes.append(json.load(f))
+    finally:
+      settings.remove("/Qgis2threejs/layerWorkers")
+
+    assert scenes[0]["layers"] == scenes[1]["layers"]
+
+  def test05_export_dem_pyramid(self):
+    """test that a DEM is exported as a tile pyramid, and as blocks if it is clipped"""
+    projectPath = dataPath("testproject1.qgs")
+    mapSettings = loadProject(projectPath)
+
+    # output size
+    width = 800
+    height = width * mapSettings.extent().height() / mapSettings.extent().width()
+    mapSettings.setOutputSize(QSize(width, height))
+
+    exporter = Exporter(None, dataPath("testproject1.qto3settings"))
+    exporter.setMapSettings(mapSettings)
+
+    settings = exporter.settings
+    settings.updateLayerList()
+    demId = "dem_srtm3020150914165149263"
+    clipId = "polygon120150915163203246"
+    for layer in settings.getLayerList():
+      layer.visible = (layer.layerId == demId)
+    dem = settings.getItemByLayerId(demId)
+
+    qsettings = QSettings()
+    try:
+      qsettings.setValue("/Qgis2threejs/demPyramidLevels", 1)
+      for clip in [False, True]:
+        dem.properties = dict(settings.data[ObjectTreeItem.ITEM_DEM], checkBox_Clip=clip, comboBox_ClipLayer=clipId)
+        err = exporter.export(outputPath(os.path.join("pyramid{0}".format(int(clip)), "testproject1.html")))
+        assert err == Exporter.NO_ERROR, err
+
+        with open(os.path.join(settings.outputdatadir, "scene.json")) as f:
+          layer = json.load(f)["layers"][0]
+        assert ("pyramid" in layer["properties"]) != clip, layer["properties"]
+        assert bool(layer["data"]) == clip    # DEM blocks
+    finally:
+      qsettings.remove("/Qgis2threejs/demPyramidLevels")
+
+
 if __name__ == "__main__":
   import unittest
   unittest.main()
@@ -0,0 +1,503 @@
+# -*- coding: utf-8 -*-
+"""
+author : Minoru Akagi
+begin  : 2017-07-01
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+import io
+import json
+import math
+import shutil
+import struct
+import tempfile
+import threading
+from types import SimpleNamespace
+from unittest import TestCase
+
+import numpy
+from osgeo import gdal, osr
+from PyQt5.QtGui import QImage
+from qgis.core import QgsFeature, QgsGeometry, QgsPointXY, QgsRectangle, QgsRenderContext, QgsVectorLayer
+
+from Qgis2threejs.cache import LRUCache
+from Qgis2threejs.datamanager import DataManager, ImageManager, TextureWriter
+from Qgis2threejs.exportscheduler import ExportScheduler
+from Qgis2threejs.exportvector import VectorLayer
+from Qgis2threejs.gdal2threejs import bilinearInterpolation
+from Qgis2threejs.geombuffer import MAGIC, CoordList, writeBinaryBlock
+from Qgis2threejs.geometry import TriangleMesh, hilbertIndex, hilbertOrder, sharedTriangleMesh
+from Qgis2threejs.plugins.gsielevtile.tilestore import NODATA_VALUE, TILE_SIZE, decodeTextTile
+from Qgis2threejs.propertyreader import VectorPropertyReader
+from Qgis2threejs.qgis2threejscore import GDALDEMProvider, GridWarper, sampleValues
+from Qgis2threejs.rotatedrect import RotatedRect
+from Qgis2threejs.stylewidget import HeightWidgetFunc, StyleWidget
+from Qgis2threejs.texturecache import TextureCache
+from Qgis2threejs.tilecache import TileCache
+from Qgis2threejs.vectorobject import objectTypeManager
+
+
+def readBinaryBlock(data):
+  """decodes a binary block into a block with nested lists, in the same way as Q3D.Utils.decodeBinaryBlock()"""
+  assert data[:4] == MAGIC
+  headerLength = struct.unpack("<I", data[4:8])[0]
+  block = json.loads(data[8:8 + headerLength].decode("UTF-8"))
+  offset = 8 + headerLength
+  indices = numpy.frombuffer(data, dtype="<u4", count=block["buffer"]["i"], offset=offset).tolist()
+  coords = numpy.frombuffer(data, dtype="<f4", count=block["buffer"]["c"], offset=offset + 4 * len(indices)).tolist()
+
+  def unpackPoints(ref):
+    dim, depth, c, i = ref
+    pos = [c, i]
+
+    def read(depth):
+      n = indices[pos[1]]
+      pos[1] += 1
+      if depth > 1:
+        return [read(depth - 1) for _ in range(n)]
+      pts = [coords[pos[0] + k * dim:pos[0] + (k + 1) * dim] for k in range(n)]
+      pos[0] += n * dim
+      return pts
+
+    return read(depth)
+
+  def unpackIndices(ref):
+    dim, i = ref
+    n = indices[i]
+    return [indices[i + 1 + k * dim:i + 1 + (k + 1) * dim] for k in range(n)]
+
+  def unpack(obj):
+    for key, value in obj.items():
+      if isinstance(value, dict):
+        if "_b" in value:
+          obj[key] = unpackPoints(value["_b"])
+        elif "_i" in value:
+          obj[key] = unpackIndices(value["_i"])
+        else:
+          unpack(value)
+
+  for feat in block["features"]:
+    unpack(feat["geom"])
+  return block
+
+
+class TestCore(TestCase):
+
+  def test01_hilbertOrder(self):
+    """points are sorted along Hilbert curve in the rect, and points outside the rect are clamped"""
+    # corners of the rect
+    xs = numpy.array([10, 0, 10, 0])
+    ys = numpy.array([0, 0, 10, 10])
+    self.assertEqual(hilbertOrder(xs, ys, QgsRectangle(0, 0, 10, 10), order=1).tolist(), [1, 3, 2, 0])
+
+    # bounding box of the points is used if rect is not given
+    self.assertEqual(hilbertOrder(xs + 100, ys, order=1).tolist(), [1, 3, 2, 0])
+
+    # points at the same position keep their order
+    self.assertEqual(hilbertOrder([-5, 10, -1, 0], [-5, 0, -1, 0], QgsRectangle(0, 0, 10, 10), order=1).tolist(), [0, 2, 3, 1])
+
+  def test02_hilbertIndex(self):
+    """hilbert index visits all cells once, and consecutive cells are adjacent"""
+    self.assertEqual(hilbertIndex([0, 0, 1, 1], [0, 1, 1, 0], order=1).tolist(), [0, 1, 2, 3])
+
+    order = 3
+    n = 1 << order
+    ys, xs = numpy.mgrid[0:n, 0:n]
+    d = hilbertIndex(xs.ravel(), ys.ravel(), order)
+    self.assertEqual(sorted(d.tolist()), list(range(n * n)))
+
+    path = numpy.argsort(d)
+    steps = numpy.abs(numpy.diff(xs.ravel()[path])) + numpy.abs(numpy.diff(ys.ravel()[path]))
+    self.assertTrue((steps == 1).all())
+
+  def test03_sortedFeatures(self):
+    """features are sorted within windows, and read from the layer only as far as needed"""
+    # features at the corners of the base extent, in the order of the first order curve reversed
+    corners = [(0, 10), (10, 10), (10, 0), (0, 0)] * 3
+    fetched = []
+
+    def features(request=None):
+      for i, (x, y) in enumerate(corners):
+        fetched.append(i)
+        yield SimpleNamespace(fid=i, geom=QgsGeometry.fromPointXY(QgsPointXY(x, y)))
+
+    layer = VectorLayer.__new__(VectorLayer)
+    layer.settings = SimpleNamespace(baseExtent=RotatedRect(QgsPointXY(5, 5), 10, 10))
+    layer.features = features
+
+    feats = layer.sortedFeatures(windowSize=4)
+    self.assertEqual([next(feats).fid for _ in range(4)], [3, 0, 1, 2])
+    self.assertEqual(len(fetched), 4)
+    self.assertEqual([feat.fid for feat in feats], [7, 4, 5, 6, 11, 8, 9, 10])
+
+  def test04_demGridCache(self):
+    """cached DEM reads return the values read directly, and the values can be modified by callers"""
+    reads = []
+
+    def read(width, height, geotransform):
+      reads.append(geotransform)
+      return numpy.arange(width * height, dtype=numpy.float32) + geotransform[0]
+
+    provider = GDALDEMProvider.__new__(GDALDEMProvider)
+    provider._read = read
+    provider._tileKey = ("dem.tif", 0, None, "")
+    extent = RotatedRect(QgsPointXY(5, 5), 10, 10)
+
+    provider.tileCache = None
+    direct = provider.read(4, 3, extent)
+
+    provider.tileCache = TileCache(1024 * 1024)
+    values = provider.read(4, 3, extent)
+    numpy.testing.assert_array_equal(values, direct)
+    values += 100
+
+    numpy.testing.assert_array_equal(provider.read(4, 3, extent), direct)
+    self.assertEqual(len(reads), 2)
+
+    provider.read(5, 3, extent)
+    self.assertEqual(len(reads), 3)
+
+  def test05_tileCache(self):
+    """least recently used grids are evicted from memory, spilled to disk and loaded again"""
+    spillDir = tempfile.mkdtemp()
+    try:
+      grid = lambda v: numpy.full(100, v, dtype=numpy.float32)    # 400 bytes
+      cache = TileCache(1000, spillDir)
+      cache.put(0, grid(0))
+      cache.put(1, grid(1))
+      cache.get(0)          # 1 is the least recently used
+      cache.put(2, grid(2))
+
+      self.assertEqual(len(cache), 2)
+      self.assertEqual(cache.memoryUsage(), 800)
+      self.assertEqual(cache.get(0)[0], 0)
+      self.assertEqual(cache.get(1)[0], 1)    # loaded from disk. 2 is evicted and spilled
+      self.assertEqual(cache.get(2)[0], 2)    # loaded from disk
+      self.assertIsNone(cache.get(3))
+      self.assertEqual((cache.hits, cache.misses), (4, 1))
+
+      cache.clear()
+      self.assertEqual(len(cache), 0)
+      self.assertIsNone(cache.get(2))
+
+      # without spilling
+      cache = TileCache(1000)
+      for i in range(3):
+        cache.put(i, grid(i))
+      self.assertIsNone(cache.get(0))
+      self.assertEqual(cache.get(2)[0], 2)
+    finally:
+      shutil.rmtree(spillDir)
+
+  def test06_textureCache(self):
+    """texture cache evicts images by pixel memory, and the cache base class cannot be used without item methods"""
+    image = QImage(16, 16, QImage.Format_ARGB32)   # 1024 bytes
+    cache = TextureCache(2048)
+    for i in range(3):
+      cache.put(i, image)
+    self.assertEqual(cache.memoryUsage(), 2048)
+    self.assertIsNone(cache.get(0))
+    self.assertIsNotNone(cache.get(1))
+    self.assertIsNotNone(cache.get(2))
+
+    with self.assertRaises(TypeError):
+      LRUCache(1024)
+
+  def test07_symbolStyle(self):
+    """styles are resolved per feature object, and constant data defined colors are evaluated once"""
+    class Expression:
+
+      def __init__(self, columns):
+        self.columns = columns
+        self.evaluations = 0
+
+      def evaluate(self, f, fields):
+        self.evaluations += 1
+        return f.color
+
+      def referencedColumns(self):
+        return self.columns
+
+      def needsGeometry(self):
+        return False
+
+    class Feature(SimpleNamespace):
+
+      def id(self):
+        return -1     # features without valid ids
+
+      def fields(self):
+        return None
+
+    def symbol(expr):
+      color = SimpleNamespace(name=lambda: "#000000")
+      layer = SimpleNamespace(strokeColor=lambda: color, dataDefinedProperty=lambda name: expr)
+      return SimpleNamespace(color=lambda: color, symbolLayer=lambda i: layer, hasDataDefinedProperties=lambda: True)
+
+    reader = VectorPropertyReader.__new__(VectorPropertyReader)
+    reader.renderContext = None
+    f1, f2 = Feature(color="255,0,0"), Feature(color="0,0,255,51")
+
+    for columns, colors in [(["color"], ["0xff0000", "0x0000ff"]), ([], ["0xff0000", "0xff0000"])]:
+      expr = Expression(columns)
+      sym = symbol(expr)
+      reader.layer = SimpleNamespace(renderer=lambda: SimpleNamespace(symbolForFeature=lambda f, context: sym))
+      reader.resetSymbolCache()
+
+      styles = [reader.symbolStyle(f) for f in [f1, f1, f2, f2]]
+      self.assertEqual([style[0] for style in styles[::2]], colors)
+      self.assertEqual(expr.evaluations, len(set(colors)))
+
+  def test08_textureWriter(self):
+    """PNG compression levels are converted to qualities that Qt maps back to the same levels,
+    and worker threads of the texture writer are stopped after the writes"""
+    for level in list(range(10)) + [-1]:
+      writer = TextureWriter("PNG", compression=level, workers=1)
+      qualities = []
+      writer._write = lambda image, path, format, quality: qualities.append(quality)
+      writer.write(None, "dummy")
+      writer.shutdown()
+      if level < 0:
+        self.assertEqual(qualities, [-1])
+      else:
+        self.assertEqual((100 - qualities[0]) * 9 // 91, level)
+
+    with self.assertRaises(RuntimeError):
+      writer.write(None, "dummy")   # executor has been shut down
+
+    manager = ImageManager.__new__(ImageManager)
+    manager._lock = threading.Lock()
+    manager._textureWriter = writer = TextureWriter(workers=1)
+    manager.waitForWrites()
+    self.assertIsNone(manager._textureWriter)
+    with self.assertRaises(RuntimeError):
+      writer.write(None, "dummy")
+
+  def test09_dataManager(self):
+    """equal items share an index. lists and tuples are different items, and items with dicts or
+    unhashable values are indexed too"""
+    manager = DataManager()
+    items = [(1, ["a", "b"]), (1, ("a", "b")), (1, {"x": [1], "y": 2}), (2, {1, 2}), (3, bytearray(b"a"))]
+    self.assertEqual([manager._index(item) for item in items], [0, 1, 2, 3, 4])
+    self.assertEqual([manager._index(item) for item in items], [0, 1, 2, 3, 4])
+    self.assertEqual(manager._index((1, {"y": 2, "x": [1]})), 2)
+    self.assertEqual(manager._index((1, {"x": (1,), "y": 2})), 5)
+    self.assertEqual(manager.count(), 6)
+
+  def test10_gridWarper(self):
+    """GridWarper reads the same values as gdal.ReprojectImage with bilinear resampling, also around nodata pixels,
+    and grid points outside the source raster are 0"""
+    def wkt(epsg):
+      srs = osr.SpatialReference()
+      srs.ImportFromEPSG(epsg)
+      return srs.ExportToWkt()
+
+    R = 6378137
+    lonToX = lambda lon: R * math.radians(lon)
+    latToY = lambda lat: R * math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+
+    # source raster: 40 x 40 pixels of 0.025 degrees (lon 139 - 140, lat 35 - 36) with a block of nodata pixels
+    driver = gdal.GetDriverByName("MEM")
+    cols = rows = 40
+    src = driver.Create("", cols, rows, 1, gdal.GDT_Float32)
+    src.SetProjection(wkt(4326))
+    src.SetGeoTransform([139, 0.025, 0, 36, 0, -0.025])
+    row, col = numpy.mgrid[0:rows, 0:cols]
+    data = (10 * col + 3 * row + 100).astype(numpy.float32)
+    data[18:21, 18:21] = -9999
+    band = src.GetRasterBand(1)
+    band.SetNoDataValue(-9999)
+    band.WriteArray(data)
+
+    # destination grid: 1 km in EPSG:3857 (finer than the source), and it extends beyond the east edge of the source
+    res = 1000
+    width, height = 122, 109
+    geotransform = [lonToX(139.1), res, 0, latToY(35.9), 0, -res]
+    values = GridWarper(wkt(4326), wkt(3857)).read(src, width, height, geotransform).reshape(height, width)
+
+    dst = driver.Create("", width, height, 1, gdal.GDT_Float32)
+    dst.SetProjection(wkt(3857))
+    dst.SetGeoTransform(geotransform)
+    gdal.ReprojectImage(src, dst, None, None, gdal.GRA_Bilinear)
+    expected = dst.GetRasterBand(1).ReadAsArray()
+
+    # longitudes of grid point columns. columns near the east edge are not compared
+    lons = numpy.degrees((geotransform[0] + (numpy.arange(width) + 0.5) * res) / R)
+    inside, outside = lons < 140 - 0.005, lons > 140 + 0.005
+    self.assertTrue(inside.any() and outside.any())
+
+    numpy.testing.assert_allclose(values[:, inside], expected[:, inside], atol=0.5)
+    self.assertTrue((values[:, outside] == 0).all())
+    self.assertTrue((expected[:, outside] == 0).all())
+
+    # grid points surrounded by nodata pixels are 0
+    self.assertTrue((values == 0)[:, inside].any())
+
+  def test11_bilinearInterpolation(self):
+    """bilinear interpolation of a plane is exact, also on the last row and column"""
+    rows, cols = 5, 7
+    ys, xs = numpy.mgrid[0:rows, 0:cols]
+    grid = 2 * xs + 3 * ys + 1.
+
+    px = numpy.array([0, 0.5, 2.25, 5.9, cols - 1])
+    py = numpy.array([0, 3.75, 1.5, rows - 1, rows - 1])
+    values = bilinearInterpolation(grid, px, py)
+    numpy.testing.assert_allclose(values, 2 * px + 3 * py + 1)
+
+  def test12_sampleValues(self):
+    """points are sampled from windows of grid values, and each window is read once"""
+    plane = lambda x, y: 2 * x - 3 * y + 1
+    reads = []
+
+    def read(width, height, geotransform):
+      reads.append((width, height))
+      col, row = numpy.meshgrid(numpy.arange(width) + 0.5, numpy.arange(height) + 0.5)
+      return plane(geotransform[0] + col * geotransform[1], geotransform[3] + row * geotransform[5]).ravel()
+
+    xs = numpy.array([0, 3.3, 17.25, 40, 40.5, 0.1])
+    ys = numpy.array([0, -2, 21.5, 39.9, 1, 38])
+    values = sampleValues(read, xs, ys, 0.5, block_size=32)
+    numpy.testing.assert_allclose(values, plane(xs, ys))
+    self.assertEqual(len(reads), 5)     # points are in 5 windows of 15.5 x 15.5
+    self.assertTrue(all(w <= 32 and h <= 32 for w, h in reads))
+
+    self.assertEqual(len(sampleValues(read, [], [], 0.5)), 0)
+
+  def test13_binaryBlock(self):
+    """geometries packed into a binary block are restored, both from nested lists and from CoordList"""
+    coords = numpy.arange(42, dtype=numpy.float64).reshape(14, 3) / 4
+    polygonOffsets, ringOffsets = numpy.array([0, 2, 2, 3]), numpy.array([0, 4, 8, 14])
+    lineOffsets = numpy.array([0, 6, 6, 14])
+
+    geoms = [{"pts": CoordList(coords[:3])},
+             {"lines": CoordList(coords, [lineOffsets])},
+             {"polygons": CoordList(coords[:, :2], [polygonOffsets, ringOffsets]), "h": 1.5,
+              "triangles": {"v": [[0, 0, 0], [1, 0, 0], [0, 1, 0]], "f": [[0, 1, 2]]}},
+             {"pts": CoordList(coords[:0])}]
+    nested = [dict((k, v.tolist() if isinstance(v, CoordList) else v) for k, v in g.items()) for g in geoms]
+
+    for g in [geoms, nested]:
+      f = io.BytesIO()
+      writeBinaryBlock(f, {"type": "block", "layer": 0, "block": 0, "features": [{"geom": geom, "mat": 0} for geom in g]})
+      block = readBinaryBlock(f.getvalue())
+      self.assertEqual([feat["geom"] for feat in block["features"]], nested)
+
+  def test14_triangleMesh(self):
+    """meshes are shared, and bands that intersect a rect are found arithmetically"""
+    mesh = sharedTriangleMesh(0, 0, 10, 5, 10, 5)
+    self.assertIs(sharedTriangleMesh(0, 0, 10, 5, 10, 5), mesh)
+    self.assertIsNot(sharedTriangleMesh(0, 0, 10, 5, 20, 10), mesh)
+
+    # bands are 1 x 5 (vertical) and 10 x 1 (horizontal). rows are counted from top
+    self.assertEqual(list(mesh._columnRange(QgsRectangle(2.5, 1, 4.5, 2))), [2, 3, 4])
+    self.assertEqual(list(mesh._rowRange(QgsRectangle(2.5, 1, 4.5, 2))), [3, 4])
+    self.assertEqual(list(mesh._columnRange(QgsRectangle(-5, -5, 20, 20))), list(range(10)))
+    self.assertEqual(list(mesh._rowRange(QgsRectangle(-5, -5, 20, 20))), list(range(5)))
+    self.assertEqual(list(mesh._columnRange(QgsRectangle(11, 0, 12, 1))), [])
+
+    # vertex index is row * (x_segments + 1) + col
+    numpy.testing.assert_array_equal(mesh.vertexCoords([0, 12, 65]), [[0, 5], [1, 4], [10, 0]])
+
+  def test15_classifyCells(self):
+    """cells of a square polygon with a hole"""
+    mesh = TriangleMesh(0, 0, 10, 10, 10, 10)
+    geom = QgsGeometry.fromRect(QgsRectangle(1.5, 1.5, 8.5, 8.5)).difference(QgsGeometry.fromRect(QgsRectangle(4.5, 4.5, 5.5, 5.5)))
+    cells = mesh.classifyCells(geom)
+    self.assertEqual(cells.shape, (10, 10))
+
+    # outer boundary passes through rows and columns 1 and 8, and the hole boundary through 4 and 5
+    expected = numpy.full((10, 10), TriangleMesh.OUTSIDE)
+    expected[1:9, 1:9] = TriangleMesh.BOUNDARY
+    expected[2:8, 2:8] = TriangleMesh.INSIDE
+    expected[4:6, 4:6] = TriangleMesh.BOUNDARY
+    numpy.testing.assert_array_equal(cells, expected)
+
+  def test16_decodeTextTile(self):
+    """values in a text tile are decoded, and "e" is decoded as nodata"""
+    values = numpy.arange(TILE_SIZE * TILE_SIZE, dtype=numpy.float32).reshape(TILE_SIZE, TILE_SIZE) / 4
+    rows = [",".join(repr(float(v)) for v in row) for row in values]
+    rows[3] = "e," + rows[3].split(",", 1)[1]
+    tile = decodeTextTile("\n".join(rows).encode("ascii") + b"\n")
+
+    values[3, 0] = NODATA_VALUE
+    self.assertEqual(tile.dtype, numpy.float32)
+    numpy.testing.assert_array_equal(tile, values)
+
+    with self.assertRaises(ValueError):
+      decodeTextTile(b"1,2,3\n")
+
+  def test17_stylePlan(self):
+    """style widgets are compiled into readers, constants are folded and only referenced attributes are requested"""
+    layer = QgsVectorLayer("Point?field=height:double&field=name:string&field=unused:integer", "points", "memory")
+    properties = {"comboBox_ObjectType": 0,
+                  "fieldExpressionWidget_zCoordinate": "10",
+                  "styleWidget0": {"type": StyleWidget.FIELD_VALUE, "editText": '"height" * 2'},
+                  "styleWidget1": {"type": StyleWidget.FIELD_VALUE, "editText": "3"},
+                  "styleWidget2": {"type": StyleWidget.HEIGHT, "comboData": HeightWidgetFunc.ABSOLUTE, "editText": "4"},
+                  "styleWidget3": {"type": StyleWidget.HEIGHT, "comboData": HeightWidgetFunc.FIRST_ATTR_ABS, "comboText": '+"height"', "editText": "1"},
+                  "styleWidget4": {}}
+    reader = VectorPropertyReader(objectTypeManager(), QgsRenderContext(), layer, properties)
+    self.assertEqual(len(reader._plan), 4)
+    self.assertEqual(reader.referencedAttributes(), ["height"])
+
+    # constant widgets and height are read without feature
+    self.assertEqual(reader._plan[1](None), 3)
+    self.assertEqual(reader._plan[2](None), 4)
+    self.assertEqual(reader.relativeHeight(), 10)
+
+    f = QgsFeature(layer.fields())
+    f.setAttributes([2.5, "a", 7])
+    self.assertEqual(reader.values(f), [5, 3, 4, 3.5])
+
+  def test18_exportScheduler(self):
+    """export tasks start after their dependencies and results are returned in the order of tasks"""
+    for workers in [1, 3]:
+      events = []
+      lock = threading.Lock()
+      demDone = threading.Event()
+      messages = []
+
+      def task(name, value, event=None):
+        def func():
+          if event:
+            event.wait(5)   # task blocks until the event is set, to overlap with other tasks
+          with lock:
+            events.append(name)
+          scheduler.progress(None, name)
+          return value
+        return func
+
+      def demTask():
+        with lock:
+          events.append("dem")
+        demDone.set()
+        return "dem result"
+
+      scheduler = ExportScheduler(workers, lambda p=None, m=None: messages.append((threading.current_thread(), m)))
+      scheduler.add("slow", task("slow", 1, demDone if workers > 1 else None))
+      dem = scheduler.add("dem", demTask)
+      scheduler.add("overlay", task("overlay", 2), deps=[dem])
+      self.assertRaises(ValueError, scheduler.add, "invalid", task("invalid", 0), deps=[5])
+
+      self.assertEqual(scheduler.run(), [1, "dem result", 2])
+      self.assertLess(events.index("dem"), events.index("overlay"))
+      if workers > 1:
+        self.assertLess(events.index("dem"), events.index("slow"))    # slow task did not block the others
+
+      # progress is reported in the thread that runs the scheduler
+      self.assertTrue(all(thread is threading.current_thread() for thread, _ in messages))
+      self.assertIn((threading.current_thread(), "overlay"), messages)
+
+    # an error in a task is raised by run()
+    scheduler = ExportScheduler(2)
+    scheduler.add("ok", lambda: 1)
+    scheduler.add("error", lambda: 1 / 0)
+    self.assertRaises(ZeroDivisionError, scheduler.run)
+
+
+if __name__ == "__main__":
+  import unittest
+  unittest.main()
@@ -8,16 +8,69 @@ it under the terms of the GNU General Public License as published by
 the Free Software Foundation; either version 2 of the License, or
 (at your option) any later version.
 """
+import http.server
 import os
+import shutil
+import tempfile
+import threading
 from unittest import TestCase
 from PyQt5.QtCore import QSize
-from qgis.core import QgsRectangle
+from qgis.core import QgsCoordinateReferenceSystem, QgsRectangle
 
 from Qgis2threejs.api import Exporter
 from Qgis2threejs.pluginmanager import PluginManager
+from Qgis2threejs.plugins.gsielevtile.gsielevtileprovider import GSIElevTileProvider, MAX_TILES, TSIZE1
+from Qgis2threejs.plugins.gsielevtile.tilestore import ElevTileStore, TILE_SIZE
 from .utilities import dataPath, outputPath, loadProject
 
 
+class ElevTileHandler(http.server.BaseHTTPRequestHandler):
+  """serves text elevation tiles whose values are x + column index. tiles of x = 9 do not exist.
+  requests for tiles of x in failingColumns fail with a server error."""
+
+  requests = []
+  failingColumns = set()
+
+  def do_GET(self):
+    self.requests.append(self.path)
+    z, x, y = self.path.split(".")[0].strip("/").split("/")
+    if x == "9":
+      self.send_response(404)
+      self.end_headers()
+      return
+
+    if int(x) in self.failingColumns:
+      self.send_response(500)
+      self.end_headers()
+      return
+
+    row = ",".join(["e"] + [str(int(x) + i) for i in range(1, TILE_SIZE)])
+    body = ("\n".join([row] * TILE_SIZE) + "\n").encode("ascii")
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class ElevTileServer:
+
+  def __init__(self):
+    ElevTileHandler.requests = []
+    ElevTileHandler.failingColumns = set()
+    self.server = http.server.HTTPServer(("127.0.0.1", 0), ElevTileHandler)
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.start()
+    self.url = "http://127.0.0.1:{0}/{{z}}/{{x}}/{{y}}.txt".format(self.server.server_port)
+
+  def stop(self):
+    self.server.shutdown()
+    self.thread.join()
+    self.server.server_close()
+
+
 class TestPlugins(TestCase):
 
   def setUp(self):
@@ -42,6 +95,97 @@ class TestPlugins(TestCase):
     err = exporter.export(outputPath(os.path.join("testproject1", "gsielevtile.html")))
     assert err == Exporter.NO_ERROR, err
 
+  def test02_tilestore(self):
+    """test fetching and caching elevation tiles with a local HTTP server"""
+    server = ElevTileServer()
+    url = server.url
+    cacheDir = tempfile.mkdtemp()
+    try:
+      keys = [(10, x, y) for y in range(2) for x in range(3)] + [(10, 9, 0)]
+
+      store = ElevTileStore(url, cacheDir, maxConnections=4)
+      futures = [store.request(key) for key in keys + keys]   # second requests share fetches
+      tiles = [f.result()[0] for f in futures]
+      assert len(ElevTileHandler.requests) == len(keys), ElevTileHandler.requests
+      assert tiles[1].shape == (TILE_SIZE, TILE_SIZE)
+      assert tiles[1][0, 0] == 0 and tiles[1][5, 2] == 3, tiles[1][5, :3]   # "e" is nodata
+      assert tiles[len(keys) - 1].max() == 0    # tile that does not exist
+
+      # tiles in memory
+      store.tiles(keys)
+      assert store.stats()["hits"] == len(keys)
+
+      # tiles in disk cache
+      store2 = ElevTileStore(url, cacheDir)
+      tiles2 = store2.tiles(keys)
+      assert store2.stats()["diskHits"] == len(keys)
+      assert len(ElevTileHandler.requests) == len(keys)
+      assert (tiles2[4] == tiles[4]).all()
+    finally:
+      server.stop()
+      shutil.rmtree(cacheDir)
+
+  def test03_gsielevtile_mosaic(self):
+    """test reusing mosaics of GSI elevation tiles and selecting coarser zoom level for a wide extent"""
+    server = ElevTileServer()
+    try:
+      provider = GSIElevTileProvider(QgsCoordinateReferenceSystem(3857).toWkt())
+      provider.tileStore = ElevTileStore(server.url)
+
+      zoom = 10
+      size = TSIZE1 / 2 ** (zoom - 1)
+      res = size / TILE_SIZE
+
+      def bounds(ulx, uly, lrx, lry):
+        # bounds of a tile range in EPSG:3857 (slightly shrunk not to touch neighboring tiles)
+        return (ulx * size - TSIZE1 + 1, TSIZE1 - (lry + 1) * size + 1, (lrx + 1) * size - TSIZE1 - 1, TSIZE1 - uly * size - 1)
+
+      provider.getDataset(*bounds(2, 3, 4, 4), res)
+      assert len(ElevTileHandler.requests) == 6, ElevTileHandler.requests
+
+      # only tiles that are not in the mosaic are fetched
+      ds = provider.getDataset(*bounds(3, 4, 5, 5), res)
+      assert len(ElevTileHandler.requests) == 10, ElevTileHandler.requests
+      assert provider.mosaics[zoom].tileRange == (2, 3, 5, 5)
+      assert ds.RasterXSize == 4 * TILE_SIZE and ds.RasterYSize == 3 * TILE_SIZE
+
+      # value in the tile (x, y) = (5, 5)
+      assert ds.GetRasterBand(1).ReadAsArray(3 * TILE_SIZE + 10, 2 * TILE_SIZE, 1, 1)[0, 0] == 15
+
+      # a wide extent is read at a coarser zoom level instead of returning no data
+      ds = provider.getDataset(*bounds(0, 0, 40, 40), res)
+      assert len(ElevTileHandler.requests) - 10 <= MAX_TILES
+      assert ds.GetGeoTransform()[1] > res
+    finally:
+      server.stop()
+
+  def test04_gsielevtile_failed_tiles(self):
+    """test that tiles that failed to download are requested again by the next read"""
+    server = ElevTileServer()
+    try:
+      provider = GSIElevTileProvider(QgsCoordinateReferenceSystem(3857).toWkt())
+      provider.tileStore = ElevTileStore(server.url)
+
+      zoom = 10
+      size = TSIZE1 / 2 ** (zoom - 1)
+      res = size / TILE_SIZE
+      bounds = (2 * size - TSIZE1 + 1, TSIZE1 - 4 * size + 1, 4 * size - TSIZE1 - 1, TSIZE1 - 3 * size - 1)    # tiles (2, 3) - (3, 3)
+
+      ElevTileHandler.failingColumns = {3}
+      ds = provider.getDataset(*bounds, res)
+      assert provider.tileStore.stats()["errors"] == 1
+      assert provider.mosaics[zoom].filled == {(2, 3)}, provider.mosaics[zoom].filled
+      assert ds.GetRasterBand(1).ReadAsArray(TILE_SIZE + 10, 0, 1, 1)[0, 0] == 0
+
+      ElevTileHandler.failingColumns = set()
+      ds = provider.getDataset(*bounds, res)
+      assert len(ElevTileHandler.requests) == 3, ElevTileHandler.requests
+      assert provider.mosaics[zoom].filled == {(2, 3), (3, 3)}
+      assert ds.GetRasterBand(1).ReadAsArray(TILE_SIZE + 10, 0, 1, 1)[0, 0] == 13
+    finally:
+      server.stop()
+
+
 if __name__ == "__main__":
   import unittest
   unittest.main()
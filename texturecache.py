@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ TextureCache
+                              -------------------
+        begin                : 2017-06-20
+        copyright            : (C) 2017 Minoru Akagi
+        email                : akaginch@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from PyQt5.QtCore import QSettings
+from PyQt5.QtGui import QImage
+
+from .cache import LRUCache
+from .conf import def_vals
+
+
+class TextureCache(LRUCache):
+  """LRU cache of rendered images (QImage) with a pixel memory budget.
+  If diskDir is set, images evicted from memory are saved to the directory in PNG format and loaded again when requested.
+  Layer revisions in keys are valid only in the current session, so the directory is cleared when the cache is created."""
+
+  EXTENSION = ".png"
+
+  def __init__(self, maxBytes=64 * 1024 * 1024, diskDir=None):
+    LRUCache.__init__(self, maxBytes, diskDir)
+    self.clear()
+
+  def sizeOf(self, image):
+    return imageBytes(image)
+
+  def save(self, path, image):
+    image.save(path, "PNG")
+
+  def load(self, path):
+    image = QImage(path)
+    return None if image.isNull() else image
+
+
+def imageBytes(image):
+  return image.bytesPerLine() * image.height()
+
+
+_sharedTextureCache = None
+
+
+def sharedTextureCache():
+  """returns the texture cache shared in the process, or None if disabled (cache size is 0)"""
+  global _sharedTextureCache
+  if _sharedTextureCache is None:
+    settings = QSettings()
+    size = settings.value("/Qgis2threejs/textureCacheSize", def_vals.textureCacheSize, type=int)    # MB
+    if size <= 0:
+      return None
+    diskDir = settings.value("/Qgis2threejs/textureCacheDir", "", type=str)
+    _sharedTextureCache = TextureCache(size * 1024 * 1024, diskDir or None)
+  return _sharedTextureCache
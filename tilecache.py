@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ TileCache
+                              -------------------
+        begin                : 2017-06-12
+        copyright            : (C) 2017 Minoru Akagi
+        email                : akaginch@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import numpy
+from PyQt5.QtCore import QSettings
+
+from .cache import LRUCache
+from .conf import def_vals
+
+
+class TileCache(LRUCache):
+  """LRU cache of grids (numpy arrays) with a memory budget.
+  If spillDir is set, grids evicted from memory are saved to the directory and loaded again when requested."""
+
+  EXTENSION = ".npy"
+
+  def __init__(self, maxBytes=128 * 1024 * 1024, spillDir=None):
+    LRUCache.__init__(self, maxBytes, spillDir)
+
+  def sizeOf(self, tile):
+    return tile.nbytes
+
+  def save(self, path, tile):
+    numpy.save(path, tile)
+
+  def load(self, path):
+    return numpy.load(path)
+
+
+_sharedTileCache = None
+
+
+def sharedTileCache():
+  """returns the tile cache shared in the process, or None if disabled (cache size is 0)"""
+  global _sharedTileCache
+  if _sharedTileCache is None:
+    settings = QSettings()
+    size = settings.value("/Qgis2threejs/DEMCacheSize", def_vals.demCacheSize, type=int)    # MB
+    if size <= 0:
+      return None
+    spillDir = settings.value("/Qgis2threejs/DEMCacheDir", def_vals.demCacheDir, type=str)
+    _sharedTileCache = TileCache(size * 1024 * 1024, spillDir or None)
+  return _sharedTileCache
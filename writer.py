@@ -25,7 +25,7 @@ from qgis.core import QgsCoordinateTransform, QgsFeatureRequest, QgsGeometry, Qg
 
 from .datamanager import ImageManager, ModelManager, MaterialManager
 #from .demblock import DEMBlock, DEMBlocks
-from .geometry import PointGeometry, LineGeometry, PolygonGeometry, TriangleMesh, dissolvePolygonsOnCanvas
+from .geometry import PointGeometry, LineGeometry, PolygonGeometry, dissolvePolygonsOnCanvas, sharedTriangleMesh, zeroZFunc
 from .propertyreader import DEMPropertyReader, VectorPropertyReader
 from .qgis2threejscore import ObjectTreeItem, GDALDEMProvider
 from .qgis2threejstools import getLayersInProject, logMessage, pyobj2js
@@ -52,7 +52,6 @@ class ThreejsJSWriter(QObject):
     self.attrs = []
     self.imageManager = ImageManager(settings)
     self.modelManager = ModelManager()
-    self.triMesh = {}
 
     self.isCanceled = False   # for writing vector features
 
@@ -183,13 +182,10 @@ class ThreejsJSWriter(QObject):
       dem_width = dem_size.width()
       dem_height = dem_size.height()
 
-    key = "{0}x{1}".format(dem_width, dem_height)
-    if key not in self.triMesh:
-      mapTo3d = self.settings.mapTo3d()
-      hw = 0.5 * mapTo3d.planeWidth
-      hh = 0.5 * mapTo3d.planeHeight
-      self.triMesh[key] = TriangleMesh(-hw, -hh, hw, hh, dem_width - 1, dem_height - 1)
-    return self.triMesh[key]
+    mapTo3d = self.settings.mapTo3d()
+    hw = 0.5 * mapTo3d.planeWidth
+    hh = 0.5 * mapTo3d.planeHeight
+    return sharedTriangleMesh(-hw, -hh, hw, hh, dem_width - 1, dem_height - 1)
 
   def log(self, message):
     logMessage(message)
@@ -439,16 +435,16 @@ def writeMultiResDEM(writer, properties, progress=None):
     dem_values = provider.read(dem_width, dem_height, extent)
 
     if stats is None:
-      stats = {"max": max(dem_values), "min": min(dem_values)}
+      stats = {"max": float(dem_values.max()), "min": float(dem_values.min())}
     else:
-      stats["max"] = max(max(dem_values), stats["max"])
-      stats["min"] = min(min(dem_values), stats["min"])
+      stats["max"] = max(float(dem_values.max()), stats["max"])
+      stats["min"] = min(float(dem_values.min()), stats["min"])
 
-    # shift and scale
+    # shift and scale in place
     if mapTo3d.verticalShift != 0:
-      dem_values = [x + mapTo3d.verticalShift for x in dem_values]
+      dem_values += mapTo3d.verticalShift
     if mapTo3d.multiplierZ != 1:
-      dem_values = [x * mapTo3d.multiplierZ for x in dem_values]
+      dem_values *= mapTo3d.multiplierZ
 
     quad.setData(dem_width, dem_height, dem_values)
 
@@ -594,15 +590,15 @@ class VectorLayer(Layer):
       ogr_clipGeom = ogr.CreateGeometryFromWkb(clipGeomWkb) if clipGeomWkb else None
 
     else:
-      # z_func: function to get elevation at given point (x, y) on surface
+      # z_func: function to get elevations at given points (xs, ys) on surface
       if prop.isHeightRelativeToDEM():
         if self.geomType == QgsWkbTypes.PolygonGeometry and prop.type_index == 1:  # Overlay
-          z_func = lambda x, y: 0
+          z_func = zeroZFunc
         else:
-          # get elevation from DEM
-          z_func = lambda x, y: self.writer.demProvider.readValue(x, y)
+          # get elevations from DEM
+          z_func = self.writer.demProvider.readValues
       else:
-        z_func = lambda x, y: 0
+        z_func = zeroZFunc
 
     feats = []
     request = request or QgsFeatureRequest()
@@ -628,8 +624,8 @@ class VectorLayer(Layer):
       # transform_func: function to transform the map coordinates to 3d coordinates
       relativeHeight = prop.relativeHeight(f)
 
-      def transform_func(x, y, z):
-        return mapTo3d.transform(x, y, z + relativeHeight)
+      def transform_func(xs, ys, zs):
+        return mapTo3d.transformArray(xs, ys, zs + relativeHeight)
 
       if useZ:
         ogr_geom = ogr.CreateGeometryFromWkb(bytes(geometry.exportToWkb()))